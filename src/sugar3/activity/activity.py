@@ -75,6 +75,7 @@ from telepathy.constants import CONNECTION_HANDLE_TYPE_ROOM
 
 from sugar3 import util
 from sugar3 import power
+from sugar3 import startuptrace
 from sugar3.presence import presenceservice
 from sugar3.activity.activityservice import ActivityService
 from sugar3.graphics import style
@@ -122,16 +123,38 @@ class _ActivitySession(GObject.GObject):
 
         self._activities = []
         self._will_quit = []
+        self._idle_timeout = 0
+        self._idle_timeout_id = None
+
+    def set_idle_timeout(self, timeout):
+        self._idle_timeout = timeout
 
     def register(self, activity):
         self._activities.append(activity)
 
+        if self._idle_timeout_id is not None:
+            GObject.source_remove(self._idle_timeout_id)
+            self._idle_timeout_id = None
+
     def unregister(self, activity):
         self._activities.remove(activity)
 
         if len(self._activities) == 0:
-            logging.debug('Quitting the activity process.')
-            Gtk.main_quit()
+            if self._idle_timeout > 0:
+                logging.debug('No more instances, waiting for new ones.')
+                self._idle_timeout_id = GObject.timeout_add_seconds(
+                    self._idle_timeout, self.__idle_timeout_cb)
+            else:
+                self._quit()
+
+    def _quit(self):
+        logging.debug('Quitting the activity process.')
+        Gtk.main_quit()
+
+    def __idle_timeout_cb(self):
+        self._idle_timeout_id = None
+        self._quit()
+        return False
 
     def will_quit(self, activity, will_quit):
         if will_quit:
@@ -153,6 +176,9 @@ class _ActivitySession(GObject.GObject):
     def __sm_quit_cb(self, client):
         self.emit('quit')
 
+        if not self._activities:
+            self._quit()
+
 
 class Activity(Window, Gtk.Container):
     """This is the base Activity class that all other Activities derive from.
@@ -299,13 +325,15 @@ class Activity(Window, Gtk.Container):
 
         # This code can be removed when we grow an xsettings daemon (the GTK+
         # init routines will then automatically figure out the font settings)
-        settings = Gtk.Settings.get_default()
-        settings.set_property('gtk-theme-name', sugar_theme)
-        settings.set_property('gtk-icon-theme-name', 'sugar')
-        settings.set_property('gtk-font-name',
-                              '%s %f' % (style.FONT_FACE, style.FONT_SIZE))
+        with startuptrace.phase('theme-settings'):
+            settings = Gtk.Settings.get_default()
+            settings.set_property('gtk-theme-name', sugar_theme)
+            settings.set_property('gtk-icon-theme-name', 'sugar')
+            settings.set_property('gtk-font-name', '%s %f' %
+                                  (style.FONT_FACE, style.FONT_SIZE))
 
-        Window.__init__(self)
+        with startuptrace.phase('window-init'):
+            Window.__init__(self)
 
         if 'SUGAR_ACTIVITY_ROOT' in os.environ:
             # If this activity runs inside Sugar, we want it to take all the
@@ -339,7 +367,8 @@ class Activity(Window, Gtk.Container):
         self._jobject = None
         self._read_file_called = False
 
-        self._session = _get_session()
+        with startuptrace.phase('session'):
+            self._session = _get_session()
         self._session.register(self)
         self._session.connect('quit-requested',
                               self.__session_quit_requested_cb)
@@ -349,13 +378,15 @@ class Activity(Window, Gtk.Container):
         self.sugar_accel_group = accel_group
         self.add_accel_group(accel_group)
 
-        self._bus = ActivityService(self)
+        with startuptrace.phase('activity-service'):
+            self._bus = ActivityService(self)
         self._owns_file = False
 
         share_scope = SCOPE_PRIVATE
 
         if handle.object_id:
-            self._jobject = datastore.get(handle.object_id)
+            with startuptrace.phase('datastore-get'):
+                self._jobject = datastore.get(handle.object_id)
 
             if 'share-scope' in self._jobject.metadata:
                 share_scope = self._jobject.metadata['share-scope']
@@ -372,7 +403,8 @@ class Activity(Window, Gtk.Container):
 
         if handle.object_id is None and create_jobject:
             logging.debug('Creating a jobject.')
-            self._jobject = self._initialize_journal_object()
+            with startuptrace.phase('journal-object'):
+                self._jobject = self._initialize_journal_object()
 
         if handle.invited:
             wait_loop = GObject.MainLoop()
@@ -382,12 +414,14 @@ class Activity(Window, Gtk.Container):
             # FIXME: The current API requires that self.shared_activity is set
             # before exiting from __init__, so we wait until we have got the
             # shared activity. http://bugs.sugarlabs.org/ticket/2168
-            wait_loop.run()
+            with startuptrace.phase('invite-wait'):
+                wait_loop.run()
         else:
-            pservice = presenceservice.get_instance()
-            mesh_instance = pservice.get_activity(self._activity_id,
-                                                  warn_if_none=False)
-            self._set_up_sharing(mesh_instance, share_scope)
+            with startuptrace.phase('presence'):
+                pservice = presenceservice.get_instance()
+                mesh_instance = pservice.get_activity(self._activity_id,
+                                                      warn_if_none=False)
+                self._set_up_sharing(mesh_instance, share_scope)
 
         if not create_jobject:
             self.set_title(get_bundle_name())
@@ -573,7 +607,8 @@ class Activity(Window, Gtk.Container):
         logging.debug('Activity.__canvas_map_cb')
         if self._jobject and self._jobject.file_path and \
                 not self._read_file_called:
-            self.read_file(self._jobject.file_path)
+            with startuptrace.phase('read-file'):
+                self.read_file(self._jobject.file_path)
             self._read_file_called = True
         canvas.disconnect_by_func(self.__canvas_map_cb)
 
@@ -1103,6 +1138,12 @@ def _get_session():
     return _session
 
 
+def set_idle_timeout(timeout):
+    """Keep the process running timeout seconds after its last instance
+    closed, so that it can host new instances"""
+    _get_session().set_idle_timeout(timeout)
+
+
 def get_bundle_name():
     """Return the bundle name for the current process' bundle"""
     return os.environ['SUGAR_BUNDLE_NAME']
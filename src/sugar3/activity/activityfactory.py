@@ -26,10 +26,13 @@ import logging
 
 import dbus
 from gi.repository import GObject
+from gi.repository import GLib
 
 from sugar3.activity.activityhandle import ActivityHandle
+from sugar3.activity import zygote
 from sugar3 import util
 from sugar3 import env
+from sugar3 import startuptrace
 from sugar3.datastore import datastore
 
 from errno import EEXIST, ENOSPC
@@ -38,6 +41,7 @@ import os
 import tempfile
 import subprocess
 import pwd
+import threading
 
 _SHELL_SERVICE = 'org.laptop.Shell'
 _SHELL_PATH = '/org/laptop/Shell'
@@ -52,14 +56,53 @@ try:
 except ValueError:
     MAXFD = 256
 
+_CLOSE_RANGE_CLOEXEC = 1 << 2
+_SYS_CLOSE_RANGE = 436
+_MAX_FD_NUMBER = 0xffffffff
 
-def _close_fds():
-    for i in xrange(3, MAXFD):
-        try:
-            os.close(i)
-        # pylint: disable=W0704
-        except Exception:
-            pass
+
+def _get_close_fds():
+    """Return a preexec_fn marking every descriptor above 2 close-on-exec
+
+    It runs in the forked child of a threaded process, where another
+    thread may hold locks such as the one of malloc. So everything is
+    prepared here, before any fork, and the child only does a single
+    close_range() call through ctypes with prebuilt arguments: no
+    import, no file listing, no Python error handling. Descriptors
+    already marked close-on-exec are unchanged, which keeps the error
+    pipe of subprocess working.
+
+    Returns None when close_range() with CLOSE_RANGE_CLOEXEC is not
+    available, before Linux 5.11, and close_fds=True must be used.
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    except OSError:
+        return None
+
+    if hasattr(libc, 'close_range'):
+        close_range = libc.close_range
+        prefix = ()
+    else:
+        close_range = libc.syscall
+        prefix = (ctypes.c_long(_SYS_CLOSE_RANGE),)
+
+    last = ctypes.c_uint(_MAX_FD_NUMBER)
+    flags = ctypes.c_uint(_CLOSE_RANGE_CLOEXEC)
+    # Only accepted by kernels supporting the flag, and changes nothing
+    if close_range(*(prefix + (last, last, flags))) != 0:
+        return None
+
+    args = prefix + (ctypes.c_uint(3), last, flags)
+
+    def close_fds():
+        close_range(*args)
+
+    return close_fds
+
+
+_close_fds = _get_close_fds()
 
 
 def create_activity_id():
@@ -67,26 +110,23 @@ def create_activity_id():
     return util.unique_id()
 
 
-def get_environment(activity):
-    environ = os.environ.copy()
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != EEXIST:
+            raise
 
-    bin_path = os.path.join(activity.get_path(), 'bin')
 
-    activity_root = env.get_profile_path(activity.get_bundle_id())
-    if not os.path.exists(activity_root):
-        os.mkdir(activity_root)
+def _prepare_activity_root(activity_root):
+    for name in ('instance', 'data', 'tmp'):
+        _makedirs(os.path.join(activity_root, name))
 
-    data_dir = os.path.join(activity_root, 'instance')
-    if not os.path.exists(data_dir):
-        os.mkdir(data_dir)
 
-    data_dir = os.path.join(activity_root, 'data')
-    if not os.path.exists(data_dir):
-        os.mkdir(data_dir)
+def _build_environment(activity, activity_root):
+    environ = os.environ.copy()
 
-    tmp_dir = os.path.join(activity_root, 'tmp')
-    if not os.path.exists(tmp_dir):
-        os.mkdir(tmp_dir)
+    bin_path = os.path.join(activity.get_path(), 'bin')
 
     environ['SUGAR_BUNDLE_PATH'] = activity.get_path()
     environ['SUGAR_BUNDLE_ID'] = activity.get_bundle_id()
@@ -100,6 +140,38 @@ def get_environment(activity):
     return environ
 
 
+def get_environment(activity):
+    activity_root = env.get_profile_path(activity.get_bundle_id())
+    _prepare_activity_root(activity_root)
+    return _build_environment(activity, activity_root)
+
+
+def get_environment_async(activity, reply_handler, error_handler):
+    """Like get_environment(), creating the directories in a thread
+
+    reply_handler(environ) or error_handler(error) is called from the
+    main loop once the activity directories exist.
+    """
+    activity_root = env.get_profile_path(activity.get_bundle_id())
+    environ = _build_environment(activity, activity_root)
+
+    def deliver(handler, result):
+        handler(result)
+        return False
+
+    def run():
+        try:
+            _prepare_activity_root(activity_root)
+        except OSError, e:
+            GLib.idle_add(deliver, error_handler, e)
+        else:
+            GLib.idle_add(deliver, reply_handler, environ)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+
 def get_command(activity, activity_id=None, object_id=None, uri=None,
                 activity_invite=False):
     if not activity_id:
@@ -129,22 +201,63 @@ def get_command(activity, activity_id=None, object_id=None, uri=None,
     return command
 
 
-def open_log_file(activity):
-    i = 1
-    while True:
-        path = env.get_logs_path('%s-%s.log' % (activity.get_bundle_id(), i))
+class _LogFileAllocator(object):
+    """Allocate the numbered log files of the activities
+
+    The logs directory is listed once, then the next free index of
+    every bundle is kept in memory, instead of probing the files left
+    by every previous launch.
+    """
+
+    def __init__(self):
+        self._logs_path = None
+        self._next_index = {}
+
+    def _scan(self, logs_path):
+        self._logs_path = logs_path
+        self._next_index = {}
         try:
-            fd = os.open(path, os.O_EXCL | os.O_CREAT | os.O_WRONLY, 0644)
-            f = os.fdopen(fd, 'w', 0)
-            return (path, f)
-        except OSError, e:
-            if e.errno == EEXIST:
-                i += 1
-            elif e.errno == ENOSPC:
-                # not the end of the world; let's try to keep going.
-                return ('/dev/null', open('/dev/null', 'w'))
-            else:
-                raise e
+            names = os.listdir(logs_path)
+        except OSError:
+            return
+
+        for name in names:
+            if not name.endswith('.log'):
+                continue
+            bundle_id, separator, index = name[:-4].rpartition('-')
+            if separator and index.isdigit():
+                index = int(index) + 1
+                if index > self._next_index.get(bundle_id, 1):
+                    self._next_index[bundle_id] = index
+
+    def open(self, bundle_id):
+        logs_path = env.get_logs_path()
+        if logs_path != self._logs_path:
+            self._scan(logs_path)
+
+        i = self._next_index.get(bundle_id, 1)
+        while True:
+            path = os.path.join(logs_path, '%s-%s.log' % (bundle_id, i))
+            try:
+                fd = os.open(path, os.O_EXCL | os.O_CREAT | os.O_WRONLY, 0644)
+                self._next_index[bundle_id] = i + 1
+                return (path, os.fdopen(fd, 'w', 0))
+            except OSError, e:
+                if e.errno == EEXIST:
+                    # Created behind our back
+                    i += 1
+                elif e.errno == ENOSPC:
+                    # not the end of the world; let's try to keep going.
+                    return ('/dev/null', open('/dev/null', 'w'))
+                else:
+                    raise e
+
+
+_log_files = _LogFileAllocator()
+
+
+def open_log_file(activity):
+    return _log_files.open(activity.get_bundle_id())
 
 
 class ActivityCreationHandler(GObject.GObject):
@@ -216,12 +329,20 @@ class ActivityCreationHandler(GObject.GObject):
             reply_handler=self._no_reply_handler,
             error_handler=self._notify_launch_error_handler)
 
-        environ = get_environment(self._bundle)
+        get_environment_async(self._bundle,
+                              reply_handler=self._environment_reply_handler,
+                              error_handler=self._create_error_handler)
+
+    def _environment_reply_handler(self, environ):
         (log_path, log_file) = open_log_file(self._bundle)
         command = get_command(self._bundle, self._handle.activity_id,
                               self._handle.object_id, self._handle.uri,
                               self._handle.invited)
 
+        if environ.get(startuptrace.ENABLE_ENV):
+            environ[startuptrace.LAUNCH_TIME_ENV] = \
+                '%.6f' % startuptrace.monotonic()
+
         environment_dir = None
         if os.path.exists('/etc/olpc-security') \
                 and os.access('/usr/bin/rainbow-run', os.X_OK):
@@ -245,12 +366,20 @@ class ActivityCreationHandler(GObject.GObject):
                 open(file_path, 'w').write(str(value))
 
             log_file.write(' '.join(command) + '\n\n')
+        elif environ.get(zygote.ENABLE_ENV):
+            user_data = (environment_dir, log_file, self._handle.activity_id)
+            pid = zygote.launch(command, environ,
+                                self._bundle.get_path(), log_path,
+                                _zygote_exit_cb, user_data)
+            if pid is not None:
+                return
 
         dev_null = file('/dev/null', 'r')
         child = subprocess.Popen([str(s) for s in command],
                                  env=environ,
                                  cwd=str(self._bundle.get_path()),
-                                 close_fds=True,
+                                 preexec_fn=_close_fds,
+                                 close_fds=_close_fds is None,
                                  stdin=dev_null.fileno(),
                                  stdout=log_file.fileno(),
                                  stderr=log_file.fileno())
@@ -318,7 +447,15 @@ def create_with_object_id(bundle, object_id):
     return ActivityCreationHandler(bundle, activity_handle)
 
 
-def _child_watch_cb(pid, condition, user_data):
+def _zygote_exit_cb(pid, condition, user_data):
+    # The activity appended its output to the log file
+    log_file = user_data[1]
+    log_file.seek(0, os.SEEK_END)
+    # The zygote forked the activity, it is not our child to reap
+    _child_watch_cb(pid, condition, user_data, reap=False)
+
+
+def _child_watch_cb(pid, condition, user_data, reap=True):
     # FIXME we use standalone method here instead of ActivityCreationHandler's
     # member to have workaround code, see #1123
     environment_dir, log_file, activity_id = user_data
@@ -344,11 +481,12 @@ def _child_watch_cb(pid, condition, user_data):
         log_file.close()
 
     # try to reap zombies in case SIGCHLD has not been set to SIG_IGN
-    try:
-        os.waitpid(pid, 0)
-    except OSError:
-        # SIGCHLD = SIG_IGN, no zombies
-        pass
+    if reap:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            # SIGCHLD = SIG_IGN, no zombies
+            pass
 
     if status or signum:
         # XXX have to recreate dbus object since we can't reuse
@@ -0,0 +1,236 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Run several instances of an activity in one process
+
+An ActivityHost owns the D-Bus name of its bundle and creates the
+instances that later launches of the same bundle ask it for, so that
+they do not each cost an interpreter. A host accepts a bounded number
+of instances; when it is full it gives up the name, so that the next
+launch starts a new host, and takes it back when one of its instances
+closes. A host without instances stays around for a while, ready to be
+reused.
+
+With isolation enabled, every instance runs a fresh copy of the modules
+of the bundle, so that their module level state is not shared. The
+toolkit and the environment are shared by all the instances. Bundles
+whose GObject classes have an explicit __gtype_name__ can not register
+them twice; their instances share the modules imported first.
+
+UNSTABLE.
+"""
+
+import logging
+import os
+import resource
+import sys
+import time
+
+import dbus
+import dbus.service
+
+from sugar3.activity import activityhandle
+
+SERVICE_INTERFACE = 'org.laptop.SingleProcess'
+
+# Seconds an idle host waits for new instances before quitting
+IDLE_TIMEOUT = 60
+
+_DBUS_SERVICE = 'org.freedesktop.DBus'
+_DBUS_PATH = '/org/freedesktop/DBus'
+
+
+def get_service_name(bundle_id):
+    return bundle_id
+
+
+def get_service_path(bundle_id):
+    return '/' + bundle_id.replace('.', '/')
+
+
+def get_rss():
+    """Return the resident memory of the process, in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return 0
+
+
+def delegate(bundle_id, handle):
+    """Ask the host of bundle_id to create an instance
+
+    Returns True if a host created it, False if the caller has to.
+    """
+    bus = dbus.SessionBus()
+    service_name = get_service_name(bundle_id)
+
+    bus_object = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
+    try:
+        bus_object.GetNameOwner(service_name, dbus_interface=_DBUS_SERVICE)
+    except dbus.DBusException:
+        return False
+
+    try:
+        host = bus.get_object(service_name, get_service_path(bundle_id))
+        created = host.create(handle.get_dict(),
+                              dbus_interface=SERVICE_INTERFACE)
+    except (TypeError, dbus.DBusException), e:
+        logging.warning('Could not communicate with the host of %s: %s',
+                        bundle_id, e)
+        return False
+
+    # Hosts of older versions do not reply
+    return created is None or bool(created)
+
+
+class ActivityHost(dbus.service.Object):
+    """Create activity instances on behalf of other launches
+
+    max_instances -- number of instances the host accepts, 0 for no
+        limit
+    isolate -- give every instance its own copy of the bundle modules
+    idle_timeout -- seconds to keep the process once its last instance
+        closed, 0 to quit immediately
+    """
+
+    def __init__(self, bundle_id, module_name, class_name,
+                 max_instances=0, isolate=False, idle_timeout=0):
+        self._bus = dbus.SessionBus()
+        self._service_name = get_service_name(bundle_id)
+        self._module_name = module_name
+        self._class_name = class_name
+        self._max_instances = max_instances
+        self._isolate = isolate
+        self._bundle_path = os.path.abspath(os.environ['SUGAR_BUNDLE_PATH'])
+        self._instances = {}
+        self._constructor = None
+
+        # Exported on the connection, so that the name can come and go
+        # with the BusName object
+        self._bus_name = dbus.service.BusName(self._service_name,
+                                              bus=self._bus)
+        dbus.service.Object.__init__(self, self._bus,
+                                     get_service_path(bundle_id))
+
+        from sugar3.activity import activity
+        activity.set_idle_timeout(idle_timeout)
+
+    def _purge_modules(self):
+        """Remove the modules of the bundle from sys.modules, return them"""
+        prefix = self._bundle_path + os.sep
+        purged = {}
+        for name, module in sys.modules.items():
+            path = getattr(module, '__file__', None)
+            if path and os.path.abspath(path).startswith(prefix):
+                purged[name] = sys.modules.pop(name)
+        return purged
+
+    def _import_constructor(self):
+        module = __import__(self._module_name)
+        for comp in self._module_name.split('.')[1:]:
+            module = getattr(module, comp)
+        return getattr(module, self._class_name)
+
+    def _get_constructor(self):
+        if self._constructor is None:
+            self._constructor = self._import_constructor()
+        elif self._isolate:
+            purged = self._purge_modules()
+            try:
+                self._constructor = self._import_constructor()
+            except RuntimeError, e:
+                # Registering a GType name twice fails
+                logging.warning('Cannot isolate the instances of %s: %s',
+                                self._service_name, e)
+                self._purge_modules()
+                sys.modules.update(purged)
+                self._isolate = False
+        return self._constructor
+
+    def is_full(self):
+        return self._max_instances > 0 and \
+            len(self._instances) >= self._max_instances
+
+    def create_instance(self, handle):
+        """Create an instance in this process and return it"""
+        rss = get_rss()
+        instance = self._get_constructor()(handle)
+        instance.show()
+
+        activity_id = handle.activity_id
+        self._instances[activity_id] = {
+            'rss': max(get_rss() - rss, 0),
+            'created': time.time(),
+        }
+        logging.debug('Hosting %s, %d instances, %d KiB more',
+                      activity_id, len(self._instances),
+                      self._instances[activity_id]['rss'] // 1024)
+        instance.connect('destroy', self.__instance_destroy_cb, activity_id)
+        self._update_name()
+        return instance
+
+    def __instance_destroy_cb(self, instance, activity_id):
+        self._instances.pop(activity_id, None)
+        self._update_name()
+
+    def _update_name(self):
+        # A full host leaves the name to the next one, queued hosts
+        # are handed the name in turn. Dropping the BusName releases
+        # the name.
+        if self.is_full() and self._bus_name is not None:
+            self._bus_name = None
+        elif not self.is_full() and self._bus_name is None:
+            self._bus_name = dbus.service.BusName(self._service_name,
+                                                  bus=self._bus)
+
+    def get_stats(self):
+        """Return the memory used by the process and its instances
+
+        The memory of an instance is the growth of the resident memory
+        of the process while it was created.
+        """
+        return {
+            'rss': get_rss(),
+            'max_instances': self._max_instances,
+            'instances': dict((activity_id, info['rss'])
+                              for activity_id, info in
+                              self._instances.items()),
+        }
+
+    @dbus.service.method(SERVICE_INTERFACE, in_signature='a{sv}',
+                         out_signature='b')
+    def create(self, handle_dict):
+        if self.is_full():
+            return False
+        handle = activityhandle.create_from_dict(handle_dict)
+        self.create_instance(handle)
+        return True
+
+    @dbus.service.method(SERVICE_INTERFACE, in_signature='',
+                         out_signature='a{sv}')
+    def GetStats(self):
+        stats = self.get_stats()
+        instances = dbus.Dictionary(
+            dict((activity_id, dbus.UInt64(rss))
+                 for activity_id, rss in stats['instances'].items()),
+            signature='st')
+        return {
+            'rss': dbus.UInt64(stats['rss']),
+            'max-instances': dbus.UInt32(stats['max_instances']),
+            'instances': instances,
+        }
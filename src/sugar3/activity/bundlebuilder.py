@@ -20,49 +20,343 @@ STABLE.
 """
 
 import argparse
+import ast
+import collections
+import errno
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.util
 import operator
 import os
+import stat
+import struct
 import sys
+import time
 import zipfile
+import zlib
 import tarfile
 import unittest
 import shutil
 import subprocess
 import re
 import gettext
+import itertools
 import logging
-from fnmatch import fnmatch
+import fnmatch
+from multiprocessing.pool import ThreadPool
 
 from sugar3 import env
-from sugar3.bundle.activitybundle import ActivityBundle
+from sugar3.bundle import bundledelta
+from sugar3.bundle.bundle import MANIFEST_NAME
+from sugar3.bundle.activitybundle import ActivityBundle, InstallTransaction
 
 
 IGNORE_DIRS = ['dist', '.git']
-IGNORE_FILES = ['.gitignore', 'MANIFEST', '*.pyc', '*~', '*.bak', 'pseudo.po']
+IGNORE_FILES = ['.gitignore', 'MANIFEST', '*.pyc', '*~', '*.bak', 'pseudo.po',
+                '.locale-cache', '.genpot-cache', '.manifest-cache']
 
+LOCALE_CACHE_NAME = '.locale-cache'
+GENPOT_CACHE_NAME = '.genpot-cache'
+MANIFEST_CACHE_NAME = '.manifest-cache'
 
-def list_files(base_dir, ignore_dirs=None, ignore_files=None):
+XGETTEXT_ARGS = ['xgettext', '--language=Python', '--keyword=_',
+                 '--add-comments=TRANS:']
+
+POT_HEADER = """# SOME DESCRIPTIVE TITLE.
+# Copyright (C) YEAR THE PACKAGE'S COPYRIGHT HOLDER
+# This file is distributed under the same license as the PACKAGE package.
+# FIRST AUTHOR <EMAIL@ADDRESS>, YEAR.
+#
+#, fuzzy
+msgid ""
+msgstr ""
+"Project-Id-Version: PACKAGE VERSION\\n"
+"Report-Msgid-Bugs-To: \\n"
+"POT-Creation-Date: %s\\n"
+"PO-Revision-Date: YEAR-MO-DA HO:MI+ZONE\\n"
+"Last-Translator: FULL NAME <EMAIL@ADDRESS>\\n"
+"Language-Team: LANGUAGE <LL@li.org>\\n"
+"Language: \\n"
+"MIME-Version: 1.0\\n"
+"Content-Type: text/plain; charset=UTF-8\\n"
+"Content-Transfer-Encoding: 8bit\\n"
+"""
+
+# Formats that are already compressed, deflating them again only
+# costs time
+STORED_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.ogg', '.oga', '.ogv',
+                     '.spx', '.mp3', '.mp4', '.webm', '.webp', '.svgz', '.xo',
+                     '.zip', '.gz', '.bz2', '.xz', '.jar', '.odt', '.epub']
+
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def _compile_patterns(patterns):
+    """Combine shell patterns in a single compiled regular expression"""
+    if not patterns:
+        return None
+
+    expressions = []
+    for pattern in patterns:
+        expression = fnmatch.translate(pattern)
+        # Python 2 appends the flags at the end, which is not allowed
+        # inside a group
+        if expression.endswith('(?ms)'):
+            expression = expression[:-len('(?ms)')]
+        expressions.append('(?:%s)' % expression)
+    return re.compile('|'.join(expressions), re.M | re.S)
+
+
+def _list_dir(path):
+    """Return the (dirs, files) in path, symlinks to dirs count as dirs
+    but are not walked, like os.walk() does"""
+    dirs = []
+    files = []
+    walk_dirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                dirs.append(entry.name)
+                if not entry.is_symlink():
+                    walk_dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path):
+                dirs.append(name)
+                if not os.path.islink(full_path):
+                    walk_dirs.append(name)
+            else:
+                files.append(name)
+    return dirs, walk_dirs, files
+
+
+def _walk_files(base_dir, dir_matcher, file_matcher, dir_mtimes):
     result = []
+    pending = ['']
+    while pending:
+        rel_path = pending.pop()
+        path = os.path.join(base_dir, rel_path)
+        if dir_mtimes is not None:
+            dir_mtimes[rel_path] = os.stat(path).st_mtime
+
+        dirs_, walk_dirs, files = _list_dir(path)
+        for f in files:
+            if file_matcher is None or not file_matcher.match(f):
+                result.append(os.path.join(rel_path, f))
+        for d in reversed(walk_dirs):
+            if dir_matcher is None or not dir_matcher.match(d):
+                pending.append(os.path.join(rel_path, d))
+    return result
+
+
+def _read_manifest_cache(cache_path, base_dir, key):
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if cache.get('key') != key:
+        return None
+    for rel_path, mtime in cache['dirs'].items():
+        try:
+            if os.stat(os.path.join(base_dir, rel_path)).st_mtime != mtime:
+                return None
+        except OSError:
+            return None
+    return cache['files']
 
+
+def list_files(base_dir, ignore_dirs=None, ignore_files=None,
+               cache_path=None):
+    """List the files in base_dir, relative to it
+
+    ignore_dirs -- shell patterns of directory names to skip, at any depth
+    ignore_files -- shell patterns of file names to skip
+    cache_path -- optional file where the list is stored, it is reused
+        as long as none of the walked directories has been modified
+    """
     base_dir = os.path.abspath(base_dir)
 
-    for root, dirs, files in os.walk(base_dir):
-        if ignore_files:
-            for pattern in ignore_files:
-                files = [f for f in files if not fnmatch(f, pattern)]
+    if cache_path is not None:
+        key = [base_dir, ignore_dirs or [], ignore_files or []]
+        result = _read_manifest_cache(cache_path, base_dir, key)
+        if result is not None:
+            return result
+        dir_mtimes = {}
+    else:
+        dir_mtimes = None
 
-        rel_path = root[len(base_dir) + 1:]
-        for f in files:
-            result.append(os.path.join(rel_path, f))
+    if not os.path.isdir(base_dir):
+        return []
+
+    result = _walk_files(base_dir, _compile_patterns(ignore_dirs),
+                         _compile_patterns(ignore_files), dir_mtimes)
 
-        if ignore_dirs and root == base_dir:
-            for ignore in ignore_dirs:
-                if ignore in dirs:
-                    dirs.remove(ignore)
+    if cache_path is not None:
+        with open(cache_path, 'w') as f:
+            json.dump({'key': key, 'dirs': dir_mtimes, 'files': result}, f)
 
     return result
 
 
+def _list_source_files(config):
+    """List the files of the source tree, through a cache in build_dir"""
+    return list_files(config.source_dir, IGNORE_DIRS, IGNORE_FILES,
+                      cache_path=os.path.join(config.build_dir,
+                                              MANIFEST_CACHE_NAME))
+
+
+def _parse_po(po_path):
+    """Parse a .po file into a {msgid: msgstr} dictionary
+
+    Untranslated and fuzzy entries are skipped, except for the header.
+    Keys and values are encoded the way they are stored in .mo files.
+    """
+    messages = {}
+
+    def add(msgctxt, msgid, msgstr, fuzzy):
+        if fuzzy and msgid:
+            return
+        if not msgstr.strip('\0'):
+            return
+        if msgctxt is not None:
+            msgid = msgctxt + '\x04' + msgid
+        messages[msgid] = msgstr
+
+    section = None
+    fuzzy = False
+    msgctxt = None
+    msgid = msgstr = ''
+
+    po_file = open(po_path, 'rb')
+    for line in po_file:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith('#'):
+            if section == 'msgstr':
+                add(msgctxt, msgid, msgstr, fuzzy)
+                section = msgctxt = None
+                fuzzy = False
+            if line.startswith('#,') and 'fuzzy' in line:
+                fuzzy = True
+            continue
+
+        if line.startswith('msgctxt'):
+            if section == 'msgstr':
+                add(msgctxt, msgid, msgstr, fuzzy)
+                fuzzy = False
+            section = 'msgctxt'
+            line = line[7:]
+            msgctxt = ''
+        elif line.startswith('msgid_plural'):
+            section = 'msgid'
+            line = line[12:]
+            msgid += '\0'
+        elif line.startswith('msgid'):
+            if section == 'msgstr':
+                add(msgctxt, msgid, msgstr, fuzzy)
+                msgctxt = None
+                fuzzy = False
+            section = 'msgid'
+            line = line[5:]
+            msgid = msgstr = ''
+        elif line.startswith('msgstr'):
+            section = 'msgstr'
+            if line.startswith('msgstr['):
+                line = line.split(']', 1)[1]
+                if msgstr:
+                    msgstr += '\0'
+            else:
+                line = line[6:]
+
+        line = line.strip()
+        if not line:
+            continue
+        value = ast.literal_eval(line)
+        if section == 'msgctxt':
+            msgctxt += value
+        elif section == 'msgid':
+            msgid += value
+        elif section == 'msgstr':
+            msgstr += value
+        else:
+            raise ValueError('unexpected line %r' % line)
+    po_file.close()
+
+    if section == 'msgstr':
+        add(msgctxt, msgid, msgstr, fuzzy)
+    return messages
+
+
+def _replace_file(path, data):
+    """Write data to a new file and rename it over path
+
+    Installing with --mode=hardlink links to the built files, which must
+    be replaced by a rebuild, not overwritten.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+
+def _write_mo(messages, mo_path):
+    """Write a {msgid: msgstr} dictionary as a GNU .mo file"""
+    keys = sorted(messages.keys())
+    ids = ''
+    strs = ''
+    offsets = []
+    for key in keys:
+        offsets.append((len(ids), len(key), len(strs), len(messages[key])))
+        ids += key + '\0'
+        strs += messages[key] + '\0'
+
+    # The header is 7 32-bit words, followed by the key and value
+    # tables, each with a (length, offset) pair per message.
+    keys_start = 7 * 4 + 16 * len(keys)
+    values_start = keys_start + len(ids)
+    key_table = []
+    value_table = []
+    for id_offset, id_length, str_offset, str_length in offsets:
+        key_table += [id_length, id_offset + keys_start]
+        value_table += [str_length, str_offset + values_start]
+
+    output = struct.pack('Iiiiiii', 0x950412de, 0, len(keys),
+                         7 * 4, 7 * 4 + len(keys) * 8, 0, 0)
+    output += struct.pack('%di' % len(key_table), *key_table)
+    output += struct.pack('%di' % len(value_table), *value_table)
+    output += ids + strs
+
+    _replace_file(mo_path, output)
+
+
+def compile_po(po_path, mo_path):
+    """Compile a .po file to a .mo file without the gettext tools"""
+    _write_mo(_parse_po(po_path), mo_path)
+
+
+def _has_msgfmt():
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        if os.access(os.path.join(path, 'msgfmt'), os.X_OK):
+            return True
+    return False
+
+
 class Config(object):
 
     def __init__(self, source_dir, dist_dir=None, dist_name=None):
@@ -103,13 +397,85 @@ class Config(object):
 
 class Builder(object):
 
-    def __init__(self, config):
+    def __init__(self, config, jobs=None, use_msgfmt=None):
+        """
+        jobs -- number of .po files to compile concurrently, defaults
+            to the number of CPUs
+        use_msgfmt -- whether to compile with msgfmt or with the built
+            in compiler, defaults to msgfmt when it is installed
+        """
         self.config = config
         self.locale_dir = os.path.join(self.config.build_dir, 'locale')
+        self.jobs = jobs or multiprocessing.cpu_count()
+        if use_msgfmt is None:
+            use_msgfmt = _has_msgfmt()
+        self.use_msgfmt = use_msgfmt
+        self._cache_path = os.path.join(self.config.build_dir,
+                                        LOCALE_CACHE_NAME)
 
     def build(self):
         self.build_locale()
 
+    def _read_locale_cache(self):
+        try:
+            with open(self._cache_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_locale_cache(self, cache):
+        with open(self._cache_path, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+
+    def _get_po_checksum(self, file_name):
+        # The activity.linfo contents also depend on the bundle metadata
+        checksum = hashlib.sha1()
+        for value in (self.config.bundle_id, self.config.activity_name,
+                      self.config.summary, self.use_msgfmt):
+            checksum.update('%r\0' % (value,))
+        with open(file_name, 'rb') as f:
+            checksum.update(f.read())
+        return checksum.hexdigest()
+
+    def _get_mo_path(self, lang):
+        return os.path.join(self.locale_dir, lang, 'LC_MESSAGES',
+                            '%s.mo' % self.config.bundle_id)
+
+    def _build_lang(self, lang, file_name):
+        """Compile one .po file and write its activity.linfo
+
+        Returns an error message or None. Runs in a worker thread.
+        """
+        localedir = os.path.join(self.locale_dir, lang)
+        mo_file = self._get_mo_path(lang)
+        mo_path = os.path.dirname(mo_file)
+        if not os.path.isdir(mo_path):
+            os.makedirs(mo_path)
+
+        if self.use_msgfmt:
+            # Replaced once compiled, see _replace_file()
+            temp_file = mo_file + '.tmp'
+            args = ['msgfmt', '--output-file=%s' % temp_file, file_name]
+            retcode = subprocess.call(args)
+            if retcode:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                return 'ERROR - msgfmt failed with return code %i.' % retcode
+            os.rename(temp_file, mo_file)
+        else:
+            try:
+                compile_po(file_name, mo_file)
+            except (IOError, SyntaxError, ValueError), e:
+                return 'ERROR - failed to compile %s: %s' % (file_name, e)
+
+        cat = gettext.GNUTranslations(open(mo_file, 'r'))
+        translated_name = cat.gettext(self.config.activity_name)
+        translated_summary = cat.gettext(self.config.summary)
+        linfo_file = os.path.join(localedir, 'activity.linfo')
+        _replace_file(linfo_file, '[Activity]\nname = %s\nsummary = %s\n' %
+                      (translated_name, translated_summary))
+        return None
+
     def build_locale(self):
         po_dir = os.path.join(self.config.source_dir, 'po')
 
@@ -117,35 +483,54 @@ class Builder(object):
             logging.warn('Missing po/ dir, cannot build_locale')
             return
 
-        if os.path.exists(self.locale_dir):
-            shutil.rmtree(self.locale_dir)
+        cache = self._read_locale_cache()
+        if cache is None:
+            # Unknown state, start from scratch
+            if os.path.exists(self.locale_dir):
+                shutil.rmtree(self.locale_dir)
+            cache = {}
 
+        checksums = {}
         for f in os.listdir(po_dir):
             if not f.endswith('.po') or f == 'pseudo.po':
                 continue
-
-            file_name = os.path.join(po_dir, f)
             lang = f[:-3]
+            checksums[lang] = self._get_po_checksum(os.path.join(po_dir, f))
+
+        # Remove the languages whose .po file is gone
+        for lang in cache.keys():
+            if lang not in checksums:
+                shutil.rmtree(os.path.join(self.locale_dir, lang),
+                              ignore_errors=True)
+                del cache[lang]
+
+        pending = []
+        for lang, checksum in sorted(checksums.items()):
+            linfo_file = os.path.join(self.locale_dir, lang, 'activity.linfo')
+            if cache.get(lang) == checksum and \
+                    os.path.exists(self._get_mo_path(lang)) and \
+                    os.path.exists(linfo_file):
+                continue
+            cache.pop(lang, None)
+            pending.append(lang)
 
-            localedir = os.path.join(self.config.build_dir, 'locale', lang)
-            mo_path = os.path.join(localedir, 'LC_MESSAGES')
-            if not os.path.isdir(mo_path):
-                os.makedirs(mo_path)
-
-            mo_file = os.path.join(mo_path, '%s.mo' % self.config.bundle_id)
-            args = ['msgfmt', '--output-file=%s' % mo_file, file_name]
-            retcode = subprocess.call(args)
-            if retcode:
-                print 'ERROR - msgfmt failed with return code %i.' % retcode
+        pool = ThreadPool(max(1, min(self.jobs, len(pending))))
+        try:
+            results = pool.map(
+                lambda lang: self._build_lang(
+                    lang, os.path.join(po_dir, '%s.po' % lang)),
+                pending)
+        finally:
+            pool.close()
+            pool.join()
+
+        for lang, error in zip(pending, results):
+            if error is not None:
+                print error
+            else:
+                cache[lang] = checksums[lang]
 
-            cat = gettext.GNUTranslations(open(mo_file, 'r'))
-            translated_name = cat.gettext(self.config.activity_name)
-            translated_summary = cat.gettext(self.config.summary)
-            linfo_file = os.path.join(localedir, 'activity.linfo')
-            f = open(linfo_file, 'w')
-            f.write('[Activity]\nname = %s\n' % translated_name)
-            f.write('summary = %s\n' % translated_summary)
-            f.close()
+        self._write_locale_cache(cache)
 
     def get_locale_files(self):
         return list_files(self.locale_dir, IGNORE_DIRS, IGNORE_FILES)
@@ -162,25 +547,54 @@ class Packager(object):
 
     def get_files_in_git(self):
         try:
-            git_ls = subprocess.Popen(['git', 'ls-files'],
+            git_ls = subprocess.Popen(['git', 'ls-files', '-z'],
                                       stdout=subprocess.PIPE,
                                       cwd=self.config.source_dir)
         except OSError:
             logging.warn('Packager: git is not installed, '
                          'fall back to filtered list')
-            return list_files(self.config.source_dir,
-                              IGNORE_DIRS, IGNORE_FILES)
+            return _list_source_files(self.config)
 
         stdout, _ = git_ls.communicate()
         if git_ls.returncode:
             # Fall back to filtered list
             logging.warn('Packager: this is not a git repository, '
                          'fall back to filtered list')
-            return list_files(self.config.source_dir,
-                              IGNORE_DIRS, IGNORE_FILES)
+            return _list_source_files(self.config)
 
         # pylint: disable=E1103
-        return [path.strip() for path in stdout.strip('\n').split('\n')]
+        return [path for path in stdout.split('\0') if path]
+
+
+def _get_zip_date_time():
+    """Return the timestamp of all the members of a package
+
+    Use SOURCE_DATE_EPOCH when set, so that packages are reproducible
+    while still carrying a meaningful date.
+    """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch is None:
+        return (1980, 1, 1, 0, 0, 0)
+    return max(time.gmtime(int(epoch))[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def _compress_member(args):
+    """Read and compress a package member, runs in a worker process
+
+    The data is left uncompressed for ZIP_STORED, and when the package
+    has to be written with ZipFile.writestr().
+    """
+    path, compress_type = args
+    with open(path, 'rb') as f:
+        data = f.read()
+    crc = zlib.crc32(data) & 0xffffffff
+    file_size = len(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return crc, file_size, data, sha256
 
 
 class XOPackager(Packager):
@@ -193,20 +607,140 @@ class XOPackager(Packager):
         self.package_path = os.path.join(self.config.dist_dir,
                                          self.config.xo_name)
 
-    def package(self):
-        bundle_zip = zipfile.ZipFile(self.package_path, 'w',
-                                     zipfile.ZIP_DEFLATED)
-
+    def _get_members(self):
+        members = {}
         for f in self.get_files_in_git():
-            bundle_zip.write(os.path.join(self.config.source_dir, f),
-                             os.path.join(self.config.bundle_root_dir, f))
+            members[os.path.join(self.config.bundle_root_dir, f)] = \
+                os.path.join(self.config.source_dir, f)
 
         for f in self.builder.get_locale_files():
-            bundle_zip.write(os.path.join(self.builder.locale_dir, f),
-                             os.path.join(self.config.bundle_root_dir,
-                                          'locale', f))
+            members[os.path.join(self.config.bundle_root_dir, 'locale', f)] = \
+                os.path.join(self.builder.locale_dir, f)
 
-        bundle_zip.close()
+        # Generated by package()
+        members.pop(self._get_manifest_name(), None)
+
+        return sorted(members.items())
+
+    def _get_manifest_name(self):
+        return os.path.join(self.config.bundle_root_dir, 'activity',
+                            MANIFEST_NAME)
+
+    def _create_zip_info(self, name, path, date_time):
+        zip_info = zipfile.ZipInfo(name, date_time)
+        zip_info.create_system = 3
+        if os.stat(path).st_mode & 0111:
+            zip_info.external_attr = 0100755 << 16
+        else:
+            zip_info.external_attr = 0100644 << 16
+
+        extension = os.path.splitext(name)[1].lower()
+        if extension in STORED_EXTENSIONS:
+            zip_info.compress_type = zipfile.ZIP_STORED
+        else:
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+        return zip_info
+
+    def _can_write_compressed(self, bundle_zip):
+        # Writing already compressed data relies on the internals of
+        # the Python 2.7 zipfile module
+        return all(hasattr(bundle_zip, name)
+                   for name in ('fp', 'filelist', 'NameToInfo',
+                                '_writecheck', '_allowZip64')) and \
+            hasattr(zipfile.ZipInfo, 'FileHeader')
+
+    def _write_member(self, bundle_zip, zip_info, compressed):
+        # Same as ZipFile.writestr() but with already compressed data
+        zip_info.CRC, zip_info.file_size, data, sha256_ = compressed
+        zip_info.compress_size = len(data)
+        zip_info.header_offset = bundle_zip.fp.tell()
+        bundle_zip._writecheck(zip_info)
+        bundle_zip._didModify = True
+        zip64 = zip_info.file_size > zipfile.ZIP64_LIMIT or \
+            zip_info.compress_size > zipfile.ZIP64_LIMIT
+        if zip64 and not bundle_zip._allowZip64:
+            raise zipfile.LargeZipFile('Filesize would require ZIP64 '
+                                       'extensions')
+        bundle_zip.fp.write(zip_info.FileHeader(zip64))
+        bundle_zip.fp.write(data)
+        if zip_info.flag_bits & 0x08:
+            # Data descriptor, after the file data
+            fmt = '<LLQQ' if zip64 else '<LLLL'
+            bundle_zip.fp.write(struct.pack(
+                fmt, zipfile._DD_SIGNATURE, zip_info.CRC,
+                zip_info.compress_size, zip_info.file_size))
+        bundle_zip.fp.flush()
+        bundle_zip.filelist.append(zip_info)
+        bundle_zip.NameToInfo[zip_info.filename] = zip_info
+
+    def _iter_results(self, pool, jobs):
+        # Like pool.imap(), but only a few compressed members wait to
+        # be written at any time
+        pending = collections.deque()
+        jobs = iter(jobs)
+        for job in itertools.islice(jobs, self.builder.jobs * 2):
+            pending.append(pool.apply_async(_compress_member, (job,)))
+        while pending:
+            result = pending.popleft().get()
+            for job in itertools.islice(jobs, 1):
+                pending.append(pool.apply_async(_compress_member, (job,)))
+            yield result
+
+    def package(self):
+        """Write the .xo file
+
+        Members are sorted and get a fixed timestamp and mode so that
+        building the same tree twice gives the same file. They are
+        compressed in parallel by worker processes and written to the
+        package in order, with a bounded number of members in flight.
+
+        The size and SHA-256 of every member are stored in a manifest,
+        written last, that Bundle.verify() checks.
+        """
+        date_time = _get_zip_date_time()
+        members = self._get_members()
+        zip_infos = [self._create_zip_info(name, path, date_time)
+                     for name, path in members]
+        bundle_zip = zipfile.ZipFile(self.package_path, 'w',
+                                     zipfile.ZIP_DEFLATED, allowZip64=True)
+        write_compressed = self._can_write_compressed(bundle_zip)
+        if write_compressed:
+            jobs = [(path, zip_info.compress_type)
+                    for (name_, path), zip_info in zip(members, zip_infos)]
+        else:
+            jobs = [(path, zipfile.ZIP_STORED) for name_, path in members]
+
+        pool = None
+        if self.builder.jobs > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(self.builder.jobs, len(jobs)))
+            results = self._iter_results(pool, jobs)
+        else:
+            results = (_compress_member(job) for job in jobs)
+
+        try:
+            root_length = len(self.config.bundle_root_dir) + 1
+            manifest_files = {}
+            for zip_info, compressed in itertools.izip(zip_infos, results):
+                if write_compressed:
+                    self._write_member(bundle_zip, zip_info, compressed)
+                else:
+                    bundle_zip.writestr(zip_info, compressed[2])
+                manifest_files[zip_info.filename[root_length:]] = \
+                    [zip_info.file_size, compressed[3]]
+
+            manifest = json.dumps({'date_time': date_time,
+                                   'files': manifest_files},
+                                  indent=1, sort_keys=True)
+            zip_info = zipfile.ZipInfo(self._get_manifest_name(), date_time)
+            zip_info.create_system = 3
+            zip_info.external_attr = 0100644 << 16
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+            bundle_zip.writestr(zip_info, manifest)
+        finally:
+            bundle_zip.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
 
 
 class SourcePackager(Packager):
@@ -224,12 +758,44 @@ class SourcePackager(Packager):
         tar.close()
 
 
+# From linux/fs.h
+_FICLONE = 0x40049409
+
+
+def _reflink(source, dest):
+    """Make dest a copy-on-write clone of source, if supported"""
+    with open(source, 'rb') as source_file:
+        with open(dest, 'wb') as dest_file:
+            try:
+                fcntl.ioctl(dest_file.fileno(), _FICLONE, source_file.fileno())
+                return True
+            except IOError:
+                pass
+    os.unlink(dest)
+    return False
+
+
+def _hash_path(path):
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(65536), ''):
+            checksum.update(data)
+    return checksum.digest()
+
+
 class Installer(Packager):
     def __init__(self, builder):
         Packager.__init__(self, builder.config)
         self.builder = builder
 
-    def install(self, prefix):
+    def install(self, prefix, mode='copy'):
+        """Install the activity and its translations in prefix
+
+        mode -- 'copy', 'hardlink' or 'reflink'; files are copied when
+            linking is not possible, for example across filesystems.
+            Files already installed with the same size, mtime and
+            contents are left alone.
+        """
         self.builder.build()
 
         activity_path = os.path.join(prefix, 'share', 'sugar', 'activities',
@@ -252,16 +818,261 @@ class Installer(Packager):
 
             source_to_dest[source_path] = dest_path
 
-        for source, dest in source_to_dest.items():
+        for path in sorted(set([os.path.dirname(dest)
+                                for dest in source_to_dest.values()])):
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        totals = {'copied': 0, 'linked': 0, 'unchanged': 0}
+        for source, dest in sorted(source_to_dest.items()):
             print 'Install %s to %s.' % (source, dest)
+            totals[self._install_file(source, dest, mode)] += \
+                os.stat(source).st_size
+
+        print 'Installed %d files: %d bytes copied, %d bytes linked, ' \
+            '%d bytes unchanged.' % (len(source_to_dest), totals['copied'],
+                                     totals['linked'], totals['unchanged'])
+
+        transaction = InstallTransaction()
+        self.config.bundle.install_mime_type(self.config.source_dir,
+                                             transaction)
+        transaction.commit()
+        transaction.wait()
+
+    def _install_file(self, source, dest, mode):
+        """Install a file, returns 'copied', 'linked' or 'unchanged'"""
+        source_stat = os.stat(source)
+        try:
+            dest_stat = os.lstat(dest)
+        except OSError:
+            dest_stat = None
+
+        if dest_stat is not None:
+            if (dest_stat.st_dev, dest_stat.st_ino) == \
+                    (source_stat.st_dev, source_stat.st_ino):
+                return 'unchanged'
+            if stat.S_ISREG(dest_stat.st_mode) and \
+                    dest_stat.st_size == source_stat.st_size and \
+                    int(dest_stat.st_mtime) == int(source_stat.st_mtime) and \
+                    _hash_path(dest) == _hash_path(source):
+                return 'unchanged'
+            # Never write through an existing file, it could be a hard
+            # link to the source
+            os.unlink(dest)
+
+        if mode == 'hardlink':
+            try:
+                os.link(source, dest)
+                return 'linked'
+            except OSError:
+                pass
+        elif mode == 'reflink':
+            if _reflink(source, dest):
+                shutil.copystat(source, dest)
+                return 'linked'
+
+        shutil.copy2(source, dest)
+        return 'copied'
+
+
+def _iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for sub_test in _iter_tests(test):
+                yield sub_test
+        else:
+            yield test
+
+
+class _TimedTestResult(unittest.TestResult):
+    """Record the outcome and duration of every test"""
+
+    def __init__(self):
+        unittest.TestResult.__init__(self)
+        self.records = []
+        self._start_time = None
+
+    def startTest(self, test):
+        unittest.TestResult.startTest(self, test)
+        self._start_time = time.time()
+
+    def stopTest(self, test):
+        unittest.TestResult.stopTest(self, test)
+        self._start_time = None
+
+    def _record(self, test, outcome, details=None):
+        if self._start_time is None:
+            # Class or module fixture error or skip, not bound to a test
+            duration = 0
+        else:
+            duration = time.time() - self._start_time
+        self.records.append({'id': test.id(),
+                             'outcome': outcome,
+                             'duration': duration,
+                             'details': details})
+
+    def addSuccess(self, test):
+        unittest.TestResult.addSuccess(self, test)
+        self._record(test, 'success')
+
+    def addFailure(self, test, err):
+        unittest.TestResult.addFailure(self, test, err)
+        self._record(test, 'failure', self.failures[-1][1])
+
+    def addError(self, test, err):
+        unittest.TestResult.addError(self, test, err)
+        self._record(test, 'error', self.errors[-1][1])
+
+    def addSkip(self, test, reason):
+        unittest.TestResult.addSkip(self, test, reason)
+        self._record(test, 'skipped', reason)
+
+    def addExpectedFailure(self, test, err):
+        unittest.TestResult.addExpectedFailure(self, test, err)
+        self._record(test, 'expected_failure')
+
+    def addUnexpectedSuccess(self, test):
+        unittest.TestResult.addUnexpectedSuccess(self, test)
+        self._record(test, 'unexpected_success')
 
-            path = os.path.dirname(dest)
-            if not os.path.exists(path):
-                os.makedirs(path)
 
-            shutil.copy(source, dest)
+# Set before the worker processes are forked, they only receive
+# indexes in this list
+_check_tests = []
 
-        self.config.bundle.install_mime_type(self.config.source_dir)
+
+def _start_xvfb():
+    """Start a private X server for a test worker"""
+    read_fd, write_fd = os.pipe()
+    try:
+        xvfb = subprocess.Popen(['Xvfb', '-displayfd', str(write_fd),
+                                 '-nolisten', 'tcp'])
+    except OSError:
+        os.close(read_fd)
+        os.close(write_fd)
+        logging.warn('Xvfb is not installed, integration tests will use '
+                     'the current display')
+        return
+    os.close(write_fd)
+    display = os.fdopen(read_fd).readline().strip()
+    os.environ['DISPLAY'] = ':%s' % display
+    multiprocessing.util.Finalize(None, xvfb.terminate, exitpriority=10)
+
+
+def _run_test_group(indexes):
+    """Run tests from the same TestCase class, in a worker process"""
+    suite = unittest.TestSuite([_check_tests[i] for i in indexes])
+    result = _TimedTestResult()
+    suite.run(result)
+    return result.records
+
+
+class TestRunner(object):
+    """Run a test suite, possibly split across worker processes
+
+    Tests of the same TestCase class always run in the same worker,
+    so that class fixtures keep working. The duration of every test
+    is reported.
+    """
+
+    def __init__(self, jobs=1, verbosity=1, slowest=10, needs_display=False):
+        self.jobs = jobs
+        self.verbosity = verbosity
+        self.slowest = slowest
+        self.needs_display = needs_display
+
+    def _print_record(self, record):
+        if self.verbosity > 1:
+            print '%s ... %s (%.3fs)' % (record['id'], record['outcome'],
+                                         record['duration'])
+        elif self.verbosity == 1:
+            sys.stdout.write({'success': '.', 'failure': 'F',
+                              'error': 'E', 'skipped': 's',
+                              'expected_failure': 'x',
+                              'unexpected_success': 'u'}[record['outcome']])
+            sys.stdout.flush()
+
+    def run(self, suite):
+        """Run the suite, returns the list of test records"""
+        global _check_tests
+
+        _check_tests = list(_iter_tests(suite))
+        groups = {}
+        for index, test in enumerate(_check_tests):
+            groups.setdefault(test.__class__, []).append(index)
+        groups = sorted(groups.values())
+
+        start_time = time.time()
+        records = []
+        if self.jobs > 1 and len(groups) > 1:
+            initializer = _start_xvfb if self.needs_display else None
+            pool = multiprocessing.Pool(min(self.jobs, len(groups)),
+                                        initializer)
+            try:
+                for group_records in pool.imap_unordered(_run_test_group,
+                                                         groups):
+                    for record in group_records:
+                        self._print_record(record)
+                    records.extend(group_records)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for group in groups:
+                group_records = _run_test_group(group)
+                for record in group_records:
+                    self._print_record(record)
+                records.extend(group_records)
+        duration = time.time() - start_time
+        _check_tests = []
+
+        self._print_summary(records, duration)
+        return records
+
+    def _print_summary(self, records, duration):
+        if self.verbosity == 1:
+            print
+
+        counts = {}
+        for record in records:
+            counts[record['outcome']] = counts.get(record['outcome'], 0) + 1
+            if record['outcome'] in ('failure', 'error'):
+                print '=' * 70
+                print '%s: %s' % (record['outcome'].upper(), record['id'])
+                print '-' * 70
+                print record['details']
+
+        if self.slowest:
+            print 'Slowest tests:'
+            for record in sorted(records, key=lambda r: -r['duration'])[
+                    :self.slowest]:
+                print '  %8.3fs  %s' % (record['duration'], record['id'])
+
+        print '-' * 70
+        print 'Ran %d tests in %.3fs' % (len(records), duration)
+        print
+        problems = ['%s=%d' % (outcome, counts[outcome])
+                    for outcome in ('failure', 'error')
+                    if outcome in counts]
+        if problems:
+            print 'FAILED (%s)' % ', '.join(problems)
+        else:
+            print 'OK'
+
+
+def _run_tests(test_path, options, needs_display):
+    all_tests = unittest.defaultTestLoader.discover(test_path)
+    if options.jobs == 1 and options.slowest is None and \
+            options.results is None:
+        unittest.TextTestRunner(verbosity=options.verbose).run(all_tests)
+        return []
+
+    runner = TestRunner(options.jobs, options.verbose,
+                        options.slowest or 0, needs_display)
+    return runner.run(all_tests)
 
 
 def cmd_check(config, options):
@@ -284,24 +1095,31 @@ def cmd_check(config, options):
         integration_test_path = os.path.join(test_path, "integration")
         sys.path.append(config.source_dir)
 
+        results = {}
+
         # Run Tests
         if os.path.isdir(unit_test_path) and run_unit_test:
-            all_tests = unittest.defaultTestLoader.discover(unit_test_path)
-            unittest.TextTestRunner(verbosity=options.verbose).run(all_tests)
+            results['unit'] = _run_tests(unit_test_path, options, False)
         elif not run_unit_test:
             print "Not running unit tests"
         else:
             print 'No "unit" directory found.'
 
         if os.path.isdir(integration_test_path) and run_integration_test:
-            all_tests = unittest.defaultTestLoader.discover(
-                integration_test_path)
-            unittest.TextTestRunner(verbosity=options.verbose).run(all_tests)
+            results['integration'] = _run_tests(integration_test_path,
+                                                options, True)
         elif not run_integration_test:
             print "Not running integration tests"
         else:
             print 'No "integration" directory found.'
 
+        if options.results is not None:
+            with open(options.results, 'w') as f:
+                json.dump({'bundle_id': config.bundle_id,
+                           'version': config.version,
+                           'time': time.time(),
+                           'results': results}, f, indent=1, sort_keys=True)
+
         print "Finished testing"
     else:
         print "Error: No tests/ directory"
@@ -323,13 +1141,44 @@ def cmd_dev(config, options):
             print 'ERROR - A bundle with the same name is already installed.'
 
 
+def _create_builder(config, options):
+    use_msgfmt = False if options.no_msgfmt else None
+    return Builder(config, jobs=options.jobs, use_msgfmt=use_msgfmt)
+
+
 def cmd_dist_xo(config, options):
     """Create a xo bundle package"""
 
-    packager = XOPackager(Builder(config))
+    packager = XOPackager(_create_builder(config, options))
     packager.package()
 
 
+def cmd_dist_delta(config, options):
+    """Create a delta from a previous xo bundle package"""
+
+    old_bundle = ActivityBundle(options.old_xo, translated=False)
+    if old_bundle.get_bundle_id() != config.bundle_id:
+        print 'ERROR - %s is not a bundle of %s.' % (options.old_xo,
+                                                     config.bundle_id)
+        return
+
+    packager = XOPackager(_create_builder(config, options))
+    if os.path.abspath(options.old_xo) == packager.package_path:
+        print 'ERROR - %s would be overwritten, move it first.' % \
+            options.old_xo
+        return
+    packager.package()
+
+    delta_name = '%s-%s-%s.xod' % (config.bundle_name,
+                                   old_bundle.get_activity_version(),
+                                   config.version)
+    delta_path = os.path.join(config.dist_dir, delta_name)
+    size = bundledelta.create_delta(options.old_xo, packager.package_path,
+                                    delta_path)
+    print 'Created %s (%d bytes, %d bytes for the full bundle).' % \
+        (delta_path, size, os.stat(packager.package_path).st_size)
+
+
 def cmd_fix_manifest(config, options):
     '''Add missing files to the manifest (OBSOLETE)'''
 
@@ -348,8 +1197,97 @@ def cmd_dist_source(config, options):
 def cmd_install(config, options):
     """Install the activity in the system"""
 
-    installer = Installer(Builder(config))
-    installer.install(options.prefix)
+    installer = Installer(_create_builder(config, options))
+    installer.install(options.prefix, options.mode)
+
+
+def _extract_messages(file_path):
+    """Run xgettext on a single file, returns (pot, error)"""
+    try:
+        xgettext = subprocess.Popen(XGETTEXT_ARGS + ['--output=-', file_path],
+                                    stdout=subprocess.PIPE)
+    except OSError, e:
+        return None, 'ERROR - could not run xgettext: %s' % e
+
+    stdout, _ = xgettext.communicate()
+    if xgettext.returncode:
+        return None, 'ERROR - xgettext failed on %s with return code %i.' % \
+            (file_path, xgettext.returncode)
+    return stdout, None
+
+
+def _split_pot_entries(pot):
+    """Split a .pot file in (key, comments, lines) entries, skipping the
+    header. The key identifies the message (context and msgids)."""
+    entries = []
+    for block in pot.strip().split('\n\n'):
+        comments = []
+        lines = []
+        key_lines = []
+        in_key = False
+        for line in block.split('\n'):
+            if line.startswith('#'):
+                comments.append(line)
+                continue
+            if not line:
+                continue
+            if not line.startswith('"'):
+                in_key = not line.startswith('msgstr')
+            if in_key:
+                key_lines.append(line)
+            lines.append(line)
+        key = '\n'.join(key_lines)
+        if not key or key == 'msgid ""':
+            continue
+        entries.append((key, comments, lines))
+    return entries
+
+
+def _merge_pot_entries(entries):
+    """Merge entries with the same key, keeping the first seen order"""
+    merged = {}
+    order = []
+    for key, comments, lines in entries:
+        if key not in merged:
+            merged[key] = ([], [], [], lines)
+            order.append(key)
+        extracted, references, flags, lines_ = merged[key]
+        for comment in comments:
+            if comment.startswith('#,'):
+                target = flags
+                values = [flag.strip() for flag in comment[2:].split(',')]
+            elif comment.startswith('#:'):
+                target = references
+                values = comment[2:].split()
+            else:
+                target = extracted
+                values = [comment]
+            for value in values:
+                if value not in target:
+                    target.append(value)
+
+    blocks = []
+    for key in order:
+        extracted, references, flags, lines = merged[key]
+        block = extracted[:]
+        reference_line = '#:'
+        for reference in references:
+            if len(reference_line) + len(reference) >= 79 and \
+                    reference_line != '#:':
+                block.append(reference_line)
+                reference_line = '#:'
+            reference_line += ' ' + reference
+        if references:
+            block.append(reference_line)
+        if flags:
+            block.append('#, %s' % ', '.join(flags))
+        block.extend(lines)
+        blocks.append('\n'.join(block))
+    return '\n\n'.join(blocks) + '\n'
+
+
+def _escape_po_string(text):
+    return re.sub('([\\\\"])', '\\\\\\1', text)
 
 
 def cmd_genpot(config, options):
@@ -361,45 +1299,96 @@ def cmd_genpot(config, options):
     if not os.path.isdir(po_path):
         os.mkdir(po_path)
 
-    python_files = []
-    for root, dirs_dummy, files in os.walk(config.source_dir):
-        for file_name in files:
-            if file_name.endswith('.py'):
-                file_path = os.path.relpath(os.path.join(root, file_name),
-                                            config.source_dir)
-                python_files.append(file_path)
-
-    # First write out a stub .pot file containing just the translated
-    # activity name, then have xgettext merge the rest of the
-    # translations into that. (We can't just append the activity name
-    # to the end of the .pot file afterwards, because that might
-    # create a duplicate msgid.)
-    pot_file = os.path.join('po', '%s.pot' % config.bundle_name)
-    escaped_name = re.sub('([\\\\"])', '\\\\\\1', config.activity_name)
-    f = open(pot_file, 'w')
-    f.write('#: activity/activity.info:2\n')
-    f.write('msgid "%s"\n' % escaped_name)
-    f.write('msgstr ""\n')
+    python_files = sorted([f for f in _list_source_files(config)
+                           if f.endswith('.py')])
+
+    # The messages extracted from each file are cached, keyed by the
+    # file contents, so only the modified files go through xgettext.
+    cache_path = os.path.join(config.build_dir, GENPOT_CACHE_NAME)
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache.get('args') != XGETTEXT_ARGS:
+            cache = None
+    except (IOError, ValueError):
+        cache = None
+    if cache is None:
+        cache = {'args': XGETTEXT_ARGS, 'files': {}}
+
+    checksums = {}
+    pending = []
+    for file_path in python_files:
+        with open(file_path, 'rb') as f:
+            checksums[file_path] = hashlib.sha1(f.read()).hexdigest()
+        cached = cache['files'].get(file_path)
+        if cached is None or cached[0] != checksums[file_path]:
+            pending.append(file_path)
+
+    jobs = options.jobs or multiprocessing.cpu_count()
+    pool = ThreadPool(max(1, min(jobs, len(pending))))
+    try:
+        results = pool.map(_extract_messages, pending)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Writing the pot without the messages of a file would drop their
+    # translations, leave it and the cache as they are instead
+    failed = False
+    for file_path, (pot, error) in zip(pending, results):
+        if error is not None:
+            print error
+            failed = True
+        else:
+            cache['files'][file_path] = [checksums[file_path],
+                                         pot.decode('utf-8')]
+    if failed:
+        print 'ERROR - the pot file was not updated.'
+        sys.exit(1)
+
+    cache['files'] = dict([(file_path, cache['files'][file_path])
+                           for file_path in python_files])
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f)
+
+    # The translated activity name and summary come first, messages
+    # with the same msgid in the sources are merged with them.
+    entries = [('msgid "%s"' % _escape_po_string(config.activity_name),
+                ['#: activity/activity.info:2'],
+                ['msgid "%s"' % _escape_po_string(config.activity_name),
+                 'msgstr ""'])]
     if config.summary is not None:
-        escaped_summary = re.sub('([\\\\"])', '\\\\\\1', config.summary)
-        f.write('#: activity/activity.info:3\n')
-        f.write('msgid "%s"\n' % escaped_summary)
-        f.write('msgstr ""\n')
-    f.close()
+        escaped_summary = _escape_po_string(config.summary)
+        entries.append(('msgid "%s"' % escaped_summary,
+                        ['#: activity/activity.info:3'],
+                        ['msgid "%s"' % escaped_summary, 'msgstr ""']))
+
+    for file_path in python_files:
+        if file_path in cache['files']:
+            pot = cache['files'][file_path][1].encode('utf-8')
+            entries.extend(_split_pot_entries(pot))
 
-    args = ['xgettext', '--join-existing', '--language=Python',
-            '--keyword=_', '--add-comments=TRANS:', '--output=%s' % pot_file]
+    body = _merge_pot_entries(entries)
 
-    args += python_files
-    retcode = subprocess.call(args)
-    if retcode:
-        print 'ERROR - xgettext failed with return code %i.' % retcode
+    # Keep the file untouched, creation date included, when the
+    # messages did not change
+    pot_file = os.path.join('po', '%s.pot' % config.bundle_name)
+    if os.path.exists(pot_file):
+        with open(pot_file) as f:
+            old_pot = f.read()
+        if old_pot.split('\n\n', 1)[-1] == body:
+            return
+
+    with open(pot_file, 'w') as f:
+        f.write(POT_HEADER % time.strftime('%Y-%m-%d %H:%M%z'))
+        f.write('\n')
+        f.write(body)
 
 
 def cmd_build(config, options):
     """Build generated files"""
 
-    builder = Builder(config)
+    builder = _create_builder(config, options)
     builder.build()
 
 
@@ -408,11 +1397,24 @@ def start():
     subparsers = parser.add_subparsers(
         dest="command", help="Options for %(prog)s")
 
+    build_options = argparse.ArgumentParser(add_help=False)
+    build_options.add_argument(
+        "--jobs", "-j", dest="jobs", type=int, default=None,
+        help="number of translations to compile in parallel")
+    build_options.add_argument(
+        "--no-msgfmt", dest="no_msgfmt", action="store_true",
+        help="compile translations without the gettext tools")
+
     install_parser = subparsers.add_parser(
-        "install", help="Install the activity in the system")
+        "install", help="Install the activity in the system",
+        parents=[build_options])
     install_parser.add_argument(
         "--prefix", dest="prefix", default=sys.prefix,
         help="Path for installing")
+    install_parser.add_argument(
+        "--mode", dest="mode", default="copy",
+        choices=["copy", "hardlink", "reflink"],
+        help="how to install the files, linking falls back to copying")
 
     check_parser = subparsers.add_parser(
         "check", help="Run tests for the activity")
@@ -423,13 +1425,32 @@ def start():
                               type=int, choices=range(0, 3),
                               default=1, nargs='?',
                               help="verbosity for the unit tests")
-
-    subparsers.add_parser("dist_xo", help="Create a xo bundle package")
+    check_parser.add_argument("--jobs", "-j", dest="jobs", type=int,
+                              default=1,
+                              help="number of test processes, integration "
+                                   "tests get a Xvfb server each")
+    check_parser.add_argument("--slowest", dest="slowest", type=int,
+                              default=None,
+                              help="report the N slowest tests")
+    check_parser.add_argument("--results", dest="results", default=None,
+                              help="write the results as JSON to a file")
+
+    subparsers.add_parser("dist_xo", help="Create a xo bundle package",
+                          parents=[build_options])
+    delta_parser = subparsers.add_parser(
+        "dist_delta", help="Create a delta from a previous xo bundle package",
+        parents=[build_options])
+    delta_parser.add_argument("old_xo", help="the previous xo bundle package")
     subparsers.add_parser("dist_source", help="Create a tar source package")
-    subparsers.add_parser("build", help="Build generated files")
+    subparsers.add_parser("build", help="Build generated files",
+                          parents=[build_options])
     subparsers.add_parser(
         "fix_manifest", help="Add missing files to the manifest (OBSOLETE)")
-    subparsers.add_parser("genpot", help="Generate the gettext pot file")
+    genpot_parser = subparsers.add_parser(
+        "genpot", help="Generate the gettext pot file")
+    genpot_parser.add_argument(
+        "--jobs", "-j", dest="jobs", type=int, default=None,
+        help="number of files to extract messages from in parallel")
     subparsers.add_parser("dev", help="Setup for development")
 
     options = parser.parse_args()
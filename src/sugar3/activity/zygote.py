@@ -0,0 +1,393 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Pre-forked activity launcher
+
+The zygote is a server process which imports the modules used by
+sugar-activity once, then forks a child for every launch requested by
+the shell over a Unix socket. The child sets up the environment of the
+activity and runs the sugar-activity script in place, skipping the
+interpreter startup and most of the imports.
+
+Set SUGAR_ACTIVITY_ZYGOTE in the shell environment to launch activities
+through the zygote. activityfactory starts it on demand and falls back
+to spawning sugar-activity whenever it is not available.
+
+UNSTABLE.
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import runpy
+import select
+import signal
+import socket
+import subprocess
+import sys
+
+from gi.repository import GObject
+
+from sugar3 import env
+
+ENABLE_ENV = 'SUGAR_ACTIVITY_ZYGOTE'
+
+# Imported before forking, so they must not connect to the display or
+# to the session bus, nor start threads
+PRELOAD_MODULES = [
+    'gettext',
+    'optparse',
+    'dbus',
+    'dbus.service',
+    'dbus.mainloop.glib',
+    'gi.repository.GLib',
+    'gi.repository.GObject',
+    'sugar3.config',
+    'sugar3.logger',
+    'sugar3.startuptrace',
+    'sugar3.activity.activityhandle',
+    'sugar3.bundle.activitybundle',
+]
+
+# Typelibs loaded without importing their overrides, Gtk initializes
+# itself on import
+PRELOAD_TYPELIBS = [
+    ('Gio', '2.0'),
+    ('Gdk', '3.0'),
+    ('GdkPixbuf', '2.0'),
+    ('Pango', '1.0'),
+    ('Gtk', '3.0'),
+]
+
+_SCRIPT_NAME = 'sugar-activity'
+_TIMEOUT = 5
+
+_zygote_process = None
+
+
+def get_socket_path():
+    return env.get_profile_path('activity-zygote')
+
+
+def get_script(command, environ):
+    """Return the sugar-activity script run by command, or None"""
+    program = command[0]
+    if os.path.basename(program) != _SCRIPT_NAME:
+        return None
+    if '/' in program:
+        paths = [program]
+    else:
+        paths = [os.path.join(directory, program)
+                 for directory in environ.get('PATH', '').split(':')]
+    for path in paths:
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
+
+
+def _start_zygote(path):
+    global _zygote_process
+    if _zygote_process is not None and _zygote_process.poll() is None:
+        return
+
+    logging.debug('Starting the activity zygote')
+    log_file = open(env.get_logs_path('activity-zygote.log'), 'w')
+    _zygote_process = subprocess.Popen(
+        [sys.executable, '-m', 'sugar3.activity.zygote', path],
+        close_fds=True, stdin=open(os.devnull), stdout=log_file,
+        stderr=subprocess.STDOUT)
+    log_file.close()
+    GObject.child_watch_add(_zygote_process.pid, _zygote_exit_cb)
+
+
+def _zygote_exit_cb(pid, condition):
+    logging.debug('The activity zygote exited with %d', condition)
+    if _zygote_process is not None and _zygote_process.pid == pid:
+        # Reaps it
+        _zygote_process.poll()
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(_TIMEOUT)
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            _start_zygote(path)
+        else:
+            logging.warning('Cannot connect to the activity zygote: %s', e)
+        return None
+    return sock
+
+
+def _read_line(sock, data=''):
+    while '\n' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data.split('\n', 1)[0]
+
+
+def launch(command, environ, cwd, log_path, exit_cb, user_data):
+    """Launch an activity through the zygote
+
+    Returns the pid of the activity process, or None if the command
+    does not run sugar-activity or the zygote is not available, in
+    which case the caller must spawn it. The output of the activity is
+    appended to log_path. exit_cb(pid, condition, user_data) is called
+    when the process exits, like a GObject child watch.
+    """
+    script = get_script(command, environ)
+    if script is None:
+        return None
+
+    path = get_socket_path()
+    sock = _connect(path)
+    if sock is None:
+        return None
+
+    request = {
+        'script': script,
+        'argv': command,
+        'environ': environ,
+        'cwd': cwd,
+        'log_path': log_path,
+    }
+    try:
+        sock.sendall(json.dumps(request) + '\n')
+        reply = _read_line(sock)
+    except (ValueError, socket.error), e:
+        logging.warning('Cannot launch through the activity zygote: %s', e)
+        sock.close()
+        return None
+
+    if not reply.startswith('pid '):
+        logging.warning('Unexpected activity zygote reply %r', reply)
+        sock.close()
+        return None
+
+    pid = int(reply[4:])
+    sock.setblocking(True)
+    buffer_ = []
+
+    def exit_watch_cb(fd, condition):
+        chunk = ''
+        if condition & GObject.IO_IN:
+            chunk = sock.recv(64)
+            buffer_.append(chunk)
+        if chunk and '\n' not in chunk:
+            return True
+
+        sock.close()
+        data = ''.join(buffer_)
+        if data.startswith('exit '):
+            status = int(data[5:].split('\n', 1)[0])
+        else:
+            logging.warning('Lost track of activity process %d', pid)
+            status = 0
+        exit_cb(pid, status, user_data)
+        return False
+
+    GObject.io_add_watch(sock.fileno(),
+                         GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+                         exit_watch_cb)
+    return pid
+
+
+class _Launch(Exception):
+    """Raised in a forked child to leave the server loop"""
+
+    def __init__(self, request):
+        Exception.__init__(self)
+        self.request = request
+
+
+def _ignore_signal(signum, frame):
+    pass
+
+
+class ZygoteServer(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._children = {}
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            # A stale socket, the client only starts us when
+            # connecting to it failed
+            os.unlink(path)
+        self._socket.bind(path)
+        os.chmod(path, 0600)
+        self._socket.listen(16)
+
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self._wakeup_write)
+        signal.signal(signal.SIGCHLD, _ignore_signal)
+
+    def serve(self):
+        while True:
+            try:
+                readable = select.select(
+                    [self._socket, self._wakeup_read], [], [])[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            if self._wakeup_read in readable:
+                try:
+                    while os.read(self._wakeup_read, 64):
+                        pass
+                except OSError:
+                    pass
+                self._reap_children()
+
+            if self._socket in readable:
+                self._accept()
+
+    def _accept(self):
+        try:
+            connection = self._socket.accept()[0]
+        except socket.error:
+            return
+
+        connection.settimeout(_TIMEOUT)
+        try:
+            line = _read_line(connection)
+            if not line:
+                # Closed without a request, checking that we listen
+                connection.close()
+                return
+            request = json.loads(line)
+        except (ValueError, socket.error), e:
+            logging.warning('Invalid launch request: %s', e)
+            connection.close()
+            return
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            connection.close()
+            raise _Launch(request)
+
+        logging.debug('Launched %s, pid %d', request['argv'], pid)
+        self._children[pid] = connection
+        try:
+            connection.sendall('pid %d\n' % pid)
+        except socket.error:
+            pass
+
+    def _reap_children(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if pid == 0:
+                return
+
+            connection = self._children.pop(pid, None)
+            if connection is not None:
+                try:
+                    connection.sendall('exit %d\n' % status)
+                except socket.error:
+                    pass
+                connection.close()
+
+    def close_in_child(self):
+        """Release the resources of the server in a forked child"""
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self._socket.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+        for connection in self._children.values():
+            connection.close()
+        self._children = {}
+
+
+def _preload():
+    for name in PRELOAD_MODULES:
+        try:
+            __import__(name)
+        except ImportError, e:
+            logging.warning('Cannot preload %s: %s', name, e)
+
+    try:
+        import gi
+        from gi.repository import GIRepository
+        repository = GIRepository.Repository.get_default()
+        for namespace, version in PRELOAD_TYPELIBS:
+            gi.require_version(namespace, version)
+            repository.require(namespace, version, 0)
+    # pylint: disable=W0703
+    except Exception, e:
+        logging.warning('Cannot preload typelibs: %s', e)
+
+
+def _run_activity(request):
+    log_fd = os.open(request['log_path'],
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(null_fd)
+    os.close(log_fd)
+
+    os.environ.clear()
+    for key, value in request['environ'].items():
+        os.environ[key.encode('utf-8')] = value.encode('utf-8')
+    os.chdir(request['cwd'])
+
+    script = request['script'].encode('utf-8')
+    sys.argv = [script] + [arg.encode('utf-8')
+                           for arg in request['argv'][1:]]
+    sys.path[0] = os.path.dirname(script)
+    runpy.run_path(script, run_name='__main__')
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = get_socket_path()
+
+    _preload()
+    server = ZygoteServer(path)
+    try:
+        server.serve()
+    except _Launch, launch_:
+        server.close_in_child()
+        logging.getLogger().handlers = []
+        _run_activity(launch_.request)
+
+
+if __name__ == '__main__':
+    main()
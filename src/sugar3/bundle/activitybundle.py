@@ -24,18 +24,24 @@ from ConfigParser import ConfigParser
 from locale import normalize
 import os
 import shutil
+import subprocess
 import tempfile
 import logging
 
+from gi.repository import GLib
+
 from sugar3 import env
-from sugar3.bundle.bundle import Bundle, \
+from sugar3.bundle.bundle import Bundle, InvalidDeltaException, \
     MalformedBundleException, NotInstalledException
+from sugar3.bundle import bundledelta
 from sugar3.bundle.bundleversion import NormalizedVersion
 from sugar3.bundle.bundleversion import InvalidVersionError
 
 
 _bundle_instances = {}
 
+_MIME_ICONS_DIR = 'icons/sugar/scalable/mimetypes'
+
 
 def _expand_lang(locale):
     # Private method from gettext.py
@@ -86,6 +92,132 @@ def _expand_lang(locale):
     return ret
 
 
+def _get_xdg_data_home():
+    return os.getenv('XDG_DATA_HOME', os.path.expanduser('~/.local/share'))
+
+
+class InstallTransaction(object):
+    """Batch the desktop integration work of several bundle operations
+
+    Installing or uninstalling an activity bundle updates the shared
+    MIME database and the MIME type icon symlinks. When many bundles
+    are processed in a row, pass the same transaction to each
+    ActivityBundle.install() or uninstall() call: symlink changes are
+    recorded and applied on commit(), and update-mime-database runs at
+    most once per MIME directory.
+
+    The transaction can be used as a context manager, it is committed
+    when the block exits without an exception.
+
+    update-mime-database runs in the background and is reaped from the
+    main loop. Callers without a main loop, like command line tools,
+    call wait() after commit().
+    """
+
+    def __init__(self):
+        self._links = {}
+        self._unlinks = {}
+        self._mime_dirs = []
+        self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
+
+    def link(self, src, dst):
+        """Schedule the creation of a symlink dst pointing to src"""
+        if not os.path.isfile(src):
+            return
+        if not os.path.islink(dst) and os.path.exists(dst):
+            raise RuntimeError('Do not remove %s if it was not '
+                               'installed by sugar' % dst)
+        self._unlinks.pop(dst, None)
+        self._links[dst] = src
+
+    def unlink(self, dst, target_prefix=None):
+        """Schedule the removal of the symlink dst
+
+        If target_prefix is not None, the link is only removed when it
+        points inside target_prefix.
+        """
+        src = self._links.get(dst)
+        if src is not None and (target_prefix is None or
+                                src.startswith(target_prefix)):
+            del self._links[dst]
+        self._unlinks[dst] = target_prefix
+
+    def update_mime_database(self, mime_dir):
+        """Schedule a run of update-mime-database on mime_dir"""
+        if mime_dir not in self._mime_dirs:
+            self._mime_dirs.append(mime_dir)
+
+    def commit(self):
+        """Apply the scheduled changes
+
+        The MIME databases of the different directories are updated
+        in parallel, commit() returns without waiting for the updates.
+        """
+        for dst, target_prefix in self._unlinks.items():
+            if not os.path.lexists(dst):
+                continue
+            if target_prefix is not None and not (
+                    os.path.islink(dst) and
+                    os.readlink(dst).startswith(target_prefix)):
+                continue
+            logging.debug('Unlink resource %s', dst)
+            os.remove(dst)
+        self._unlinks = {}
+
+        for dst, src in self._links.items():
+            logging.debug('Link resource %s to %s' % (src, dst))
+            if os.path.lexists(dst):
+                logging.debug('Relink %s', dst)
+                os.unlink(dst)
+            os.symlink(src, dst)
+        self._links = {}
+
+        for mime_dir in self._mime_dirs:
+            try:
+                process = subprocess.Popen(['update-mime-database',
+                                            mime_dir])
+            except OSError, e:
+                logging.error('Could not run update-mime-database: %s', e)
+            else:
+                watch_id = GLib.child_watch_add(
+                    GLib.PRIORITY_DEFAULT, process.pid,
+                    self.__update_exited_cb, (mime_dir, process))
+                self._processes.append((mime_dir, process, watch_id))
+        self._mime_dirs = []
+
+    def __update_exited_cb(self, pid, condition, data):
+        mime_dir, process = data
+        if os.WIFEXITED(condition):
+            process.returncode = os.WEXITSTATUS(condition)
+        else:
+            process.returncode = -os.WTERMSIG(condition)
+        self._processes = [entry for entry in self._processes
+                           if entry[1] is not process]
+        self._check_update(mime_dir, process)
+
+    def _check_update(self, mime_dir, process):
+        if process.returncode != 0:
+            logging.error('update-mime-database %s failed with status %d',
+                          mime_dir, process.returncode)
+
+    def wait(self):
+        """Wait for the MIME database updates started by commit()"""
+        for mime_dir, process, watch_id in self._processes:
+            # Reaped here instead of from the main loop
+            GLib.source_remove(watch_id)
+            process.wait()
+            self._check_update(mime_dir, process)
+        self._processes = []
+
+
 class ActivityBundle(Bundle):
     """A Sugar activity bundle
 
@@ -315,21 +447,30 @@ class ActivityBundle(Bundle):
         """Get whether there should be a visible launcher for the activity"""
         return self._show_launcher
 
-    def install(self):
+    def install(self, transaction=None):
+        """Install the bundle in the user activities directory
+
+        transaction -- an optional InstallTransaction; if given, the
+            MIME database and icon updates are deferred until it is
+            committed, otherwise they are done before returning.
+        """
         install_dir = env.get_user_activities_path()
 
         self._unzip(install_dir)
 
         install_path = os.path.join(install_dir, self._zip_root_dir)
-        self.install_mime_type(install_path)
+        self.install_mime_type(install_path, transaction)
 
         return install_path
 
-    def install_mime_type(self, install_path):
+    def install_mime_type(self, install_path, transaction=None):
         """ Update the mime type database and install the mime type icon
         """
-        xdg_data_home = os.getenv('XDG_DATA_HOME',
-                                  os.path.expanduser('~/.local/share'))
+        own_transaction = transaction is None
+        if own_transaction:
+            transaction = InstallTransaction()
+
+        xdg_data_home = _get_xdg_data_home()
 
         mime_path = os.path.join(install_path, 'activity', 'mimetypes.xml')
         if os.path.isfile(mime_path):
@@ -339,15 +480,13 @@ class ActivityBundle(Bundle):
                 os.makedirs(mime_pkg_dir)
             installed_mime_path = os.path.join(mime_pkg_dir,
                                                '%s.xml' % self._bundle_id)
-            self._symlink(mime_path, installed_mime_path)
-            os.spawnlp(os.P_WAIT, 'update-mime-database',
-                       'update-mime-database', mime_dir)
+            transaction.link(mime_path, installed_mime_path)
+            transaction.update_mime_database(mime_dir)
 
         mime_types = self.get_mime_types()
         if mime_types is not None:
-            installed_icons_dir = \
-                os.path.join(xdg_data_home,
-                             'icons/sugar/scalable/mimetypes')
+            installed_icons_dir = os.path.join(xdg_data_home,
+                                               _MIME_ICONS_DIR)
             if not os.path.isdir(installed_icons_dir):
                 os.makedirs(installed_icons_dir)
 
@@ -356,26 +495,21 @@ class ActivityBundle(Bundle):
                                               mime_type.replace('/', '-'))
                 svg_file = mime_icon_base + '.svg'
                 info_file = mime_icon_base + '.icon'
-                self._symlink(svg_file,
-                              os.path.join(installed_icons_dir,
-                                           os.path.basename(svg_file)))
-                self._symlink(info_file,
-                              os.path.join(installed_icons_dir,
-                                           os.path.basename(info_file)))
-
-    def _symlink(self, src, dst):
-        if not os.path.isfile(src):
-            return
-        if not os.path.islink(dst) and os.path.exists(dst):
-            raise RuntimeError('Do not remove %s if it was not '
-                               'installed by sugar' % dst)
-        logging.debug('Link resource %s to %s' % (src, dst))
-        if os.path.lexists(dst):
-            logging.debug('Relink %s', dst)
-            os.unlink(dst)
-        os.symlink(src, dst)
+                transaction.link(svg_file,
+                                 os.path.join(installed_icons_dir,
+                                              os.path.basename(svg_file)))
+                transaction.link(info_file,
+                                 os.path.join(installed_icons_dir,
+                                              os.path.basename(info_file)))
+
+        if own_transaction:
+            transaction.commit()
+
+    def uninstall(self, force=False, delete_profile=False, transaction=None):
+        """Remove the bundle and its desktop integration
 
-    def uninstall(self, force=False, delete_profile=False):
+        transaction -- an optional InstallTransaction, see install()
+        """
         install_path = self.get_path()
 
         if os.path.islink(install_path):
@@ -384,28 +518,31 @@ class ActivityBundle(Bundle):
             os.unlink(install_path)
             return
 
-        xdg_data_home = os.getenv('XDG_DATA_HOME',
-                                  os.path.expanduser('~/.local/share'))
+        own_transaction = transaction is None
+        if own_transaction:
+            transaction = InstallTransaction()
+
+        xdg_data_home = _get_xdg_data_home()
 
         mime_dir = os.path.join(xdg_data_home, 'mime')
         installed_mime_path = os.path.join(mime_dir, 'packages',
                                            '%s.xml' % self._bundle_id)
-        if os.path.exists(installed_mime_path):
-            os.remove(installed_mime_path)
-            os.spawnlp(os.P_WAIT, 'update-mime-database',
-                       'update-mime-database', mime_dir)
+        if os.path.lexists(installed_mime_path):
+            transaction.unlink(installed_mime_path)
+            transaction.update_mime_database(mime_dir)
 
         mime_types = self.get_mime_types()
         if mime_types is not None:
-            installed_icons_dir = \
-                os.path.join(xdg_data_home,
-                             'icons/sugar/scalable/mimetypes')
-            if os.path.isdir(installed_icons_dir):
-                for f in os.listdir(installed_icons_dir):
-                    path = os.path.join(installed_icons_dir, f)
-                    if os.path.islink(path) and \
-                       os.readlink(path).startswith(install_path):
-                        os.remove(path)
+            # Only the links install_mime_type() could have created
+            # need to be checked, no need to scan the whole directory.
+            installed_icons_dir = os.path.join(xdg_data_home,
+                                               _MIME_ICONS_DIR)
+            for mime_type in mime_types:
+                icon_base = os.path.join(installed_icons_dir,
+                                         mime_type.replace('/', '-'))
+                for path in (icon_base + '.svg', icon_base + '.icon'):
+                    if os.path.islink(path):
+                        transaction.unlink(path, install_path)
 
         if delete_profile:
             bundle_profile_path = env.get_profile_path(self._bundle_id)
@@ -415,9 +552,33 @@ class ActivityBundle(Bundle):
 
         self._uninstall(install_path)
 
+        if own_transaction:
+            transaction.commit()
+
     def is_user_activity(self):
         return self.get_path().startswith(env.get_user_activities_path())
 
+    def apply_delta(self, delta_path, new_path):
+        """Rebuild the .xo of a newer version of this bundle
+
+        delta_path -- a delta created by bundlebuilder's dist_delta
+            command from a previous .xo of this activity
+        new_path -- where to write the new .xo
+
+        This bundle can be the old .xo or its installed directory.
+        Every rebuilt file is verified against the hashes recorded in
+        the delta. Returns the ActivityBundle for new_path.
+        """
+        bundledelta.apply_delta(self, delta_path, new_path)
+
+        bundle = ActivityBundle(new_path)
+        if bundle.get_bundle_id() != self._bundle_id:
+            os.remove(new_path)
+            raise InvalidDeltaException('Delta is for bundle %s, not %s' %
+                                        (bundle.get_bundle_id(),
+                                         self._bundle_id))
+        return bundle
+
 
 def get_bundle_instance(path, translated=True):
     global _bundle_instances
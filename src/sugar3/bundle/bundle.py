@@ -21,10 +21,17 @@ UNSTABLE.
 """
 
 import os
+import hashlib
+import json
 import logging
+import mmap
 import shutil
 import StringIO
+import time
 import zipfile
+from multiprocessing.pool import ThreadPool
+
+MANIFEST_NAME = 'contents.json'
 
 
 class AlreadyInstalledException(Exception):
@@ -51,6 +58,32 @@ class MalformedBundleException(Exception):
     pass
 
 
+class InvalidDeltaException(Exception):
+    pass
+
+
+class NoManifestException(Exception):
+    pass
+
+
+def _hash_file(path):
+    """Return the SHA-256 of a file, or None if it cannot be read"""
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return hashlib.sha256(data).hexdigest()
+        finally:
+            data.close()
+    finally:
+        f.close()
+
+
 class Bundle(object):
     """A Sugar activity, content module, etc.
 
@@ -64,6 +97,7 @@ class Bundle(object):
 
     _zipped_extension = None
     _unzipped_extension = None
+    _infodir = None
 
     def __init__(self, path):
         self._path = path
@@ -154,6 +188,77 @@ class Bundle(object):
                     return True
             return False
 
+    def get_manifest(self):
+        """Get the manifest written by bundlebuilder in the bundle
+
+        Returns a dictionary with a 'files' item mapping each path,
+        relative to the bundle root, to its [size, sha256], or None
+        for bundles without manifest.
+        """
+        manifest_file = self.get_file(os.path.join(self._infodir,
+                                                   MANIFEST_NAME))
+        if manifest_file is None:
+            return None
+        try:
+            return json.load(manifest_file)
+        except ValueError, e:
+            raise MalformedBundleException('Invalid manifest: %s' % e)
+        finally:
+            manifest_file.close()
+
+    def verify(self, quick=False, jobs=4):
+        """Check the bundle files against the bundle manifest
+
+        quick -- only compare the size and modification time of the
+            files, which match the manifest when the bundle was
+            unpacked from its .xo
+        jobs -- number of files hashed in parallel
+
+        Returns the sorted list of paths that are missing or do not
+        match. Files not listed in the manifest are not checked.
+        Raises NoManifestException if the bundle has no manifest.
+        """
+        manifest = self.get_manifest()
+        if manifest is None:
+            raise NoManifestException
+
+        files = manifest['files']
+
+        if self._zip_file is not None:
+            failed = []
+            for path, (size_, sha256) in files.items():
+                f = self.get_file(path)
+                if f is None or \
+                        hashlib.sha256(f.read()).hexdigest() != sha256:
+                    failed.append(path)
+            return sorted(failed)
+
+        if quick:
+            mtime = time.mktime(tuple(manifest['date_time']) + (0, 0, -1))
+            failed = []
+            for path, (size, sha256_) in files.items():
+                try:
+                    stat = os.stat(os.path.join(self._path, path))
+                except OSError:
+                    failed.append(path)
+                    continue
+                # zip timestamps have a two seconds resolution
+                if stat.st_size != size or abs(stat.st_mtime - mtime) > 2:
+                    failed.append(path)
+            return sorted(failed)
+
+        paths = files.keys()
+        pool = ThreadPool(max(1, min(jobs, len(paths))))
+        try:
+            hashes = pool.map(_hash_file, [os.path.join(self._path, path)
+                                           for path in paths])
+        finally:
+            pool.close()
+            pool.join()
+
+        return sorted([path for path, sha256 in zip(paths, hashes)
+                       if sha256 != files[path][1]])
+
     def get_path(self):
         """Get the bundle path."""
         return self._path
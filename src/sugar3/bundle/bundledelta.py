@@ -0,0 +1,336 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Binary deltas between two versions of a zipped bundle
+
+A delta is a zip file holding a delta.json manifest, which describes
+every member of the new bundle, and the data needed to rebuild the
+members that are not already present in the old bundle. Changed
+members are encoded as rsync-style block deltas against the old
+member with the same name.
+
+UNSTABLE.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import zipfile
+
+from sugar3.bundle.bundle import InvalidDeltaException
+
+
+DELTA_FORMAT = 1
+BLOCK_SIZE = 2048
+
+_MANIFEST_NAME = 'delta.json'
+
+_OP_COPY = 'C'
+_OP_LITERAL = 'L'
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _sha256_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _weak_checksum(data, start, end):
+    a = 0
+    b = 0
+    length = end - start
+    for i in xrange(start, end):
+        a += data[i]
+        b += (length - i + start) * data[i]
+    return a & 0xffff, b & 0xffff
+
+
+def _encode_block_delta(old, new, block_size=BLOCK_SIZE):
+    """Return the instructions rebuilding new from the blocks of old
+
+    The instructions are either a run of old blocks to copy or literal
+    data, serialized in a compact binary form.
+    """
+    blocks = {}
+    for index in xrange(len(old) // block_size):
+        block = old[index * block_size:(index + 1) * block_size]
+        weak = _weak_checksum(bytearray(block), 0, block_size)
+        strong = hashlib.md5(block).digest()
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    new_bytes = bytearray(new)
+    length = len(new)
+    ops = []
+
+    def add_copy(index):
+        if ops and ops[-1][0] == _OP_COPY and \
+                ops[-1][1] + ops[-1][2] == index:
+            ops[-1][2] += 1
+        else:
+            ops.append([_OP_COPY, index, 1])
+
+    literal_start = 0
+    pos = 0
+    if blocks and length >= block_size:
+        a, b = _weak_checksum(new_bytes, 0, block_size)
+    while blocks and pos + block_size <= length:
+        candidates = blocks.get((a, b))
+        if candidates is not None:
+            strong = hashlib.md5(new[pos:pos + block_size]).digest()
+            index = candidates.get(strong)
+            if index is not None:
+                if literal_start < pos:
+                    ops.append([_OP_LITERAL, new[literal_start:pos]])
+                add_copy(index)
+                pos += block_size
+                literal_start = pos
+                if pos + block_size <= length:
+                    a, b = _weak_checksum(new_bytes, pos, pos + block_size)
+                continue
+
+        if pos + block_size < length:
+            removed = new_bytes[pos]
+            added = new_bytes[pos + block_size]
+            a = (a - removed + added) & 0xffff
+            b = (b - block_size * removed + a) & 0xffff
+        pos += 1
+
+    if literal_start < length:
+        ops.append([_OP_LITERAL, new[literal_start:]])
+
+    encoded = []
+    for op in ops:
+        if op[0] == _OP_COPY:
+            encoded.append(_OP_COPY + struct.pack('>II', op[1], op[2]))
+        else:
+            encoded.append(_OP_LITERAL + struct.pack('>I', len(op[1])))
+            encoded.append(op[1])
+    return ''.join(encoded)
+
+
+def _decode_block_delta(old, delta, block_size=BLOCK_SIZE):
+    result = []
+    pos = 0
+    try:
+        while pos < len(delta):
+            op = delta[pos]
+            if op == _OP_COPY:
+                index, count = struct.unpack('>II', delta[pos + 1:pos + 9])
+                pos += 9
+                start = index * block_size
+                end = start + count * block_size
+                if end > len(old):
+                    raise InvalidDeltaException('Block copy out of range')
+                result.append(old[start:end])
+            elif op == _OP_LITERAL:
+                size, = struct.unpack('>I', delta[pos + 1:pos + 5])
+                pos += 5
+                result.append(delta[pos:pos + size])
+                pos += size
+            else:
+                raise InvalidDeltaException('Unknown delta instruction')
+    except struct.error:
+        raise InvalidDeltaException('Truncated block delta')
+    return ''.join(result)
+
+
+def _split_root(name):
+    return name.split('/', 1)[1] if '/' in name else name
+
+
+def create_delta(old_path, new_path, delta_path, block_size=BLOCK_SIZE):
+    """Write the delta rebuilding the bundle new_path from old_path
+
+    Both bundles must be zip files. Returns the number of bytes of
+    the delta.
+    """
+    old_zip = zipfile.ZipFile(old_path)
+    new_zip = zipfile.ZipFile(new_path)
+
+    old_members = {}
+    old_by_hash = {}
+    for info in old_zip.infolist():
+        if info.filename.endswith('/'):
+            continue
+        name = _split_root(info.filename)
+        old_members[name] = info
+
+    def read_old(name):
+        return old_zip.read(old_members[name])
+
+    for name in sorted(old_members):
+        old_by_hash.setdefault(_sha256(read_old(name)), name)
+
+    manifest = {
+        'format': DELTA_FORMAT,
+        'block_size': block_size,
+        'old_sha256': _sha256_file(old_path),
+        'new_sha256': _sha256_file(new_path),
+        'members': [],
+    }
+
+    delta_zip = zipfile.ZipFile(delta_path, 'w', zipfile.ZIP_DEFLATED,
+                                allowZip64=True)
+    try:
+        for index, info in enumerate(new_zip.infolist()):
+            data = new_zip.read(info)
+            name = _split_root(info.filename)
+            member = {
+                'name': info.filename,
+                'sha256': _sha256(data),
+                'date_time': list(info.date_time),
+                'external_attr': info.external_attr,
+                'create_system': info.create_system,
+                'compress_type': info.compress_type,
+            }
+
+            if member['sha256'] in old_by_hash:
+                member['op'] = 'copy'
+                member['base'] = old_by_hash[member['sha256']]
+                member['base_sha256'] = member['sha256']
+            elif name in old_members:
+                old_data = read_old(name)
+                delta = _encode_block_delta(old_data, data, block_size)
+                if len(delta) < len(data):
+                    member['op'] = 'patch'
+                    member['base'] = name
+                    member['base_sha256'] = _sha256(old_data)
+                    data = delta
+                else:
+                    member['op'] = 'data'
+            else:
+                member['op'] = 'data'
+
+            if member['op'] != 'copy':
+                member['data'] = 'data/%d' % index
+                delta_zip.writestr(member['data'], data)
+
+            manifest['members'].append(member)
+
+        delta_zip.writestr(_MANIFEST_NAME,
+                           json.dumps(manifest, indent=1, sort_keys=True))
+    finally:
+        delta_zip.close()
+        old_zip.close()
+        new_zip.close()
+
+    return os.stat(delta_path).st_size
+
+
+def read_manifest(delta_path):
+    """Return the manifest of a delta file"""
+    try:
+        delta_zip = zipfile.ZipFile(delta_path)
+    except zipfile.error, e:
+        raise InvalidDeltaException('Error accessing delta %r: %s' %
+                                    (delta_path, e))
+    try:
+        manifest = json.loads(delta_zip.read(_MANIFEST_NAME))
+    except (KeyError, ValueError), e:
+        raise InvalidDeltaException('Invalid delta manifest: %s' % e)
+    finally:
+        delta_zip.close()
+
+    if manifest.get('format') != DELTA_FORMAT:
+        raise InvalidDeltaException('Unsupported delta format %r' %
+                                    manifest.get('format'))
+    return manifest
+
+
+def apply_delta(bundle, delta_path, new_path):
+    """Rebuild a zipped bundle at new_path from bundle and a delta
+
+    bundle can be either the old zipped bundle or an installed copy of
+    it. The old zipped bundle, every member and the rebuilt bundle are
+    checked against the hashes in the delta; on any mismatch
+    InvalidDeltaException is raised and new_path is not created. An
+    installed copy is only checked member by member.
+    """
+    manifest = read_manifest(delta_path)
+    block_size = manifest['block_size']
+
+    old_path = bundle.get_path()
+    if os.path.isfile(old_path) and \
+            _sha256_file(old_path) != manifest['old_sha256']:
+        raise InvalidDeltaException('Delta is not for bundle %r' % old_path)
+
+    def read_base(member):
+        f = bundle.get_file(member['base'])
+        if f is None:
+            raise InvalidDeltaException('Missing base file %s' %
+                                        member['base'])
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if _sha256(data) != member['base_sha256']:
+            raise InvalidDeltaException('Base file %s does not match' %
+                                        member['base'])
+        return data
+
+    new_dir = os.path.dirname(os.path.abspath(new_path))
+    fd, temp_path = tempfile.mkstemp(dir=new_dir, suffix='.part')
+    os.close(fd)
+
+    delta_zip = zipfile.ZipFile(delta_path)
+    new_zip = zipfile.ZipFile(temp_path, 'w', allowZip64=True)
+    complete = False
+    try:
+        try:
+            for member in manifest['members']:
+                if member['op'] == 'copy':
+                    data = read_base(member)
+                elif member['op'] == 'patch':
+                    data = _decode_block_delta(
+                        read_base(member), delta_zip.read(member['data']),
+                        block_size)
+                elif member['op'] == 'data':
+                    data = delta_zip.read(member['data'])
+                else:
+                    raise InvalidDeltaException('Unknown operation %r' %
+                                                member['op'])
+
+                if _sha256(data) != member['sha256']:
+                    raise InvalidDeltaException('Rebuilt %s does not match' %
+                                                member['name'])
+
+                info = zipfile.ZipInfo(member['name'],
+                                       tuple(member['date_time']))
+                info.external_attr = member['external_attr']
+                info.create_system = member['create_system']
+                info.compress_type = member['compress_type']
+                new_zip.writestr(info, data)
+        finally:
+            delta_zip.close()
+            new_zip.close()
+
+        if _sha256_file(temp_path) != manifest['new_sha256']:
+            raise InvalidDeltaException('Rebuilt bundle does not match')
+        complete = True
+    finally:
+        if not complete:
+            os.remove(temp_path)
+
+    os.rename(temp_path, new_path)
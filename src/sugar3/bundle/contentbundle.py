@@ -153,12 +153,12 @@ class ContentBundle(Bundle):
     def get_tags(self):
         return None
 
-    def install(self):
+    def install(self, transaction=None):
         install_path = env.get_user_library_path()
         self._unzip(install_path)
         return os.path.join(install_path, self._zip_root_dir)
 
-    def uninstall(self, force=False, delete_profile=False):
+    def uninstall(self, force=False, delete_profile=False, transaction=None):
         install_dir = self._path
         self._uninstall(install_dir)
 
@@ -1,4 +1,8 @@
+import heapq
+import itertools
+import logging
 import weakref
+from collections import OrderedDict
 try:
     set
 except NameError:
@@ -15,24 +19,52 @@ def _make_id(target):
     return id(target)
 
 
+_NONE_ID = _make_id(None)
+
+
 class Signal(object):
     """Base class for all signals
 
     Internal attributes:
-        receivers -- { receriverkey (id) : weakref(receiver) }
+        receivers -- { senderkey (id) :
+                       { receiverkey (id) :
+                         (order, weakref(receiver), batched) } }
+
+    Receivers are bucketed by sender, so connect, disconnect and the
+    lookup of the receivers of a send do not depend on the number of
+    receivers connected to other senders. order keeps the receivers
+    called in the order they were connected; each bucket keeps a sorted
+    copy of its receivers until it changes.
     """
 
-    def __init__(self, providing_args=None):
+    def __init__(self, providing_args=None, deferred_delay=0):
         """providing_args -- A list of the arguments
                        this signal can pass along in
                        a send() call.
+        deferred_delay -- milliseconds send_deferred() waits before
+                       delivering, 0 to deliver when the main loop is
+                       idle.
         """
-        self.receivers = []
+        self.receivers = {}
+        self._sorted = {}
+        self._order = itertools.count()
         if providing_args is None:
             providing_args = []
         self.providing_args = set(providing_args)
 
-    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None):
+        self.deferred_delay = deferred_delay
+        self._deferred = OrderedDict()
+        self._deferred_count = itertools.count()
+        self._flush_id = 0
+        self._deferred_stats = {
+            'sends': 0,
+            'coalesced': 0,
+            'deliveries': 0,
+            'flushes': 0,
+        }
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None,
+                batched=False):
         """Connect receiver to sender for signal
 
         receiver -- a function or an instance method which is to
@@ -62,22 +94,33 @@ class Signal(object):
             instance of a receiver. This will usually be a string, though it
             may be anything hashable.
 
+        batched -- call the receiver as receiver(signal=signal,
+            emissions=[(sender, named), ...]) instead. send_deferred()
+            emissions are then delivered to it in a single call per
+            batch; send() passes a single emission.
+
         returns None
         """
         if dispatch_uid:
-            lookup_key = (dispatch_uid, _make_id(sender))
+            receiverkey = dispatch_uid
         else:
-            lookup_key = (_make_id(receiver), _make_id(sender))
+            receiverkey = _make_id(receiver)
+        senderkey = _make_id(sender)
+
+        bucket = self.receivers.get(senderkey)
+        if bucket is not None and receiverkey in bucket:
+            return
 
         if weak:
-            receiver = saferef.safeRef(
-                receiver, onDelete=self._remove_receiver)
+            def on_delete(reference):
+                self._remove_receiver(reference, senderkey, receiverkey)
 
-        for r_key, _ in self.receivers:
-            if r_key == lookup_key:
-                break
-        else:
-            self.receivers.append((lookup_key, receiver))
+            receiver = saferef.safeRef(receiver, onDelete=on_delete)
+
+        if bucket is None:
+            bucket = self.receivers[senderkey] = {}
+        bucket[receiverkey] = (next(self._order), receiver, batched)
+        self._sorted.pop(senderkey, None)
 
     def disconnect(self, receiver=None, sender=None, weak=True,
                    dispatch_uid=None):
@@ -98,13 +141,17 @@ class Signal(object):
         """
 
         if dispatch_uid:
-            lookup_key = (dispatch_uid, _make_id(sender))
+            receiverkey = dispatch_uid
         else:
-            lookup_key = (_make_id(receiver), _make_id(sender))
+            receiverkey = _make_id(receiver)
+        senderkey = _make_id(sender)
 
-        for idx, (r_key, _) in enumerate(self.receivers):
-            if r_key == lookup_key:
-                del self.receivers[idx]
+        bucket = self.receivers.get(senderkey)
+        if bucket is not None and receiverkey in bucket:
+            del bucket[receiverkey]
+            if not bucket:
+                del self.receivers[senderkey]
+            self._sorted.pop(senderkey, None)
 
     def send(self, sender, **named):
         """Send signal from sender to all connected receivers.
@@ -126,8 +173,11 @@ class Signal(object):
         if not self.receivers:
             return responses
 
-        for receiver in self._live_receivers(_make_id(sender)):
-            response = receiver(signal=self, sender=sender, **named)
+        for receiver, batched in self._live_receivers(_make_id(sender)):
+            if batched:
+                response = receiver(signal=self, emissions=[(sender, named)])
+            else:
+                response = receiver(signal=self, sender=sender, **named)
             responses.append((receiver, response))
         return responses
 
@@ -156,42 +206,143 @@ class Signal(object):
 
         # Call each receiver with whatever arguments it can accept.
         # Return a list of tuple pairs [(receiver, response), ... ].
-        for receiver in self._live_receivers(_make_id(sender)):
+        for receiver, batched in self._live_receivers(_make_id(sender)):
             try:
-                response = receiver(signal=self, sender=sender, **named)
+                if batched:
+                    response = receiver(signal=self,
+                                        emissions=[(sender, named)])
+                else:
+                    response = receiver(signal=self, sender=sender, **named)
             except Exception, err:
                 responses.append((receiver, err))
             else:
                 responses.append((receiver, response))
         return responses
 
+    def send_deferred(self, sender, coalesce_key=None, **named):
+        """Queue a send() from the main loop
+
+        sender -- the sender of the signal
+        coalesce_key -- emissions from the same sender with the same
+            coalesce_key, for example an object_id, are coalesced until
+            delivered: only the arguments of the last one are sent, at
+            the position of the first one. None never coalesces.
+        named -- named arguments which will be passed to receivers.
+
+        The queued emissions are delivered together when the main loop
+        is idle, or deferred_delay milliseconds after the first one.
+        Every receiver is called once per sender and coalesce_key in
+        that window, except batched receivers which are called once
+        with the list of all the emissions they receive, after the
+        others.
+        Errors raised by receivers are logged.
+        """
+        self._deferred_stats['sends'] += 1
+        if coalesce_key is None:
+            queue_key = next(self._deferred_count)
+        else:
+            queue_key = (_make_id(sender), coalesce_key)
+            if queue_key in self._deferred:
+                self._deferred_stats['coalesced'] += 1
+
+        self._deferred[queue_key] = (sender, named)
+
+        if not self._flush_id:
+            from gi.repository import GLib
+            if self.deferred_delay:
+                self._flush_id = GLib.timeout_add(self.deferred_delay,
+                                                  self._flush_deferred_cb)
+            else:
+                self._flush_id = GLib.idle_add(self._flush_deferred_cb)
+
+    def _flush_deferred_cb(self):
+        self._flush_id = 0
+        self.flush_deferred()
+        return False
+
+    def flush_deferred(self):
+        """Deliver the emissions queued by send_deferred() now"""
+        if self._flush_id:
+            from gi.repository import GLib
+            GLib.source_remove(self._flush_id)
+            self._flush_id = 0
+
+        deferred = self._deferred
+        if not deferred:
+            return
+        self._deferred = OrderedDict()
+        self._deferred_stats['flushes'] += 1
+
+        batches = OrderedDict()
+        for sender, named in deferred.itervalues():
+            for receiver, batched in self._live_receivers(_make_id(sender)):
+                if batched:
+                    batch = batches.setdefault(_make_id(receiver),
+                                               (receiver, []))
+                    batch[1].append((sender, named))
+                    continue
+                self._deferred_stats['deliveries'] += 1
+                try:
+                    receiver(signal=self, sender=sender, **named)
+                except Exception:
+                    logging.exception('Error in deferred receiver %r',
+                                      receiver)
+
+        for receiver, emissions in batches.itervalues():
+            self._deferred_stats['deliveries'] += 1
+            try:
+                receiver(signal=self, emissions=emissions)
+            except Exception:
+                logging.exception('Error in deferred receiver %r', receiver)
+
+    def get_deferred_stats(self):
+        """Return counters on the use of send_deferred()
+
+        sends -- calls to send_deferred()
+        coalesced -- emissions merged into a queued one
+        deliveries -- calls to receivers
+        flushes -- batches delivered
+        """
+        return dict(self._deferred_stats)
+
     def _live_receivers(self, senderkey):
         """Filter sequence of receivers to get resolved, live receivers
 
         This checks for weak references
         and resolves them, then returning only live
-        receivers.
+        receivers, as (receiver, batched) pairs.
         """
-        none_senderkey = _make_id(None)
-
-        for (receiverkey, r_senderkey), receiver in self.receivers:
-            if r_senderkey == none_senderkey or r_senderkey == senderkey:
-                if isinstance(receiver, WEAKREF_TYPES):
-                    # Dereference the weak reference.
-                    receiver = receiver()
-                    if receiver is not None:
-                        yield receiver
-                else:
-                    yield receiver
-
-    def _remove_receiver(self, receiver):
-        """Remove dead receivers from connections."""
-
-        to_remove = []
-        for key, connected_receiver in self.receivers:
-            if connected_receiver == receiver:
-                to_remove.append(key)
-        for key in to_remove:
-            for idx, (r_key, _) in enumerate(self.receivers):
-                if r_key == key:
-                    del self.receivers[idx]
+        entries = self._get_sorted(_NONE_ID)
+        if senderkey != _NONE_ID and senderkey in self.receivers:
+            entries = heapq.merge(entries, self._get_sorted(senderkey))
+
+        for order_, receiver, batched in entries:
+            if isinstance(receiver, WEAKREF_TYPES):
+                # Dereference the weak reference.
+                receiver = receiver()
+                if receiver is not None:
+                    yield receiver, batched
+            else:
+                yield receiver, batched
+
+    def _get_sorted(self, senderkey):
+        # The cached list is replaced, not modified, when receivers
+        # disconnect while being called
+        entries = self._sorted.get(senderkey)
+        if entries is None:
+            entries = sorted(self.receivers.get(senderkey, {}).values())
+            if entries:
+                self._sorted[senderkey] = entries
+        return entries
+
+    def _remove_receiver(self, receiver, senderkey, receiverkey):
+        """Remove a dead receiver from connections."""
+        bucket = self.receivers.get(senderkey)
+        if bucket is None or receiverkey not in bucket:
+            return
+        # The key may have been reused by a new receiver
+        if bucket[receiverkey][1] is receiver:
+            del bucket[receiverkey]
+            if not bucket:
+                del self.receivers[senderkey]
+            self._sorted.pop(senderkey, None)
@@ -13,34 +13,88 @@ def safeRef(target, onDelete=None):
     """Return a *safe* weak reference to a callable target
 
     target -- the object to be weakly referenced, if it's a
-        bound method reference, will create a BoundMethodWeakref,
+        bound method reference, will create a WeakMethod,
         otherwise creates a simple weakref.
     onDelete -- if provided, will have a hard reference stored
         to the callable to be called after the safe reference
         goes out of scope with the reference object, (either a
-        weakref or a BoundMethodWeakref) as argument.
+        weakref or a WeakMethod) as argument.
     """
     if hasattr(target, 'im_self'):
         if target.im_self is not None:
-            # Turn a bound method into a BoundMethodWeakref instance.
-            # Keep track of these instances for lookup by disconnect().
             assert hasattr(target, 'im_func'), \
                 "safeRef target %r has im_self, but no im_func, " \
                 "don't know how to create reference" % (target,)
-            reference = get_bound_method_weakref(
-                target=target,
-                onDelete=onDelete
-            )
-            return reference
+            return WeakMethod(target, onDelete)
     if callable(onDelete):
         return weakref.ref(target, onDelete)
     else:
         return weakref.ref(target)
 
 
+class WeakMethod(weakref.ref):
+    """A weak reference to a bound method
+
+    Like weakref.WeakMethod in Python 3: the reference is to the
+    instance, plus a weak reference to the function, and calling it
+    rebuilds the bound method. callback is called once, with this
+    reference, when either of them dies.
+
+    Unlike BoundMethodWeakref, instances are not shared, keep no names
+    or registry, and only take the space of two weak references.
+    """
+
+    __slots__ = ('_func_ref', '_meth_type', '_alive', '__weakref__')
+
+    def __new__(cls, meth, callback=None):
+        obj = meth.im_self
+        func = meth.im_func
+
+        def _cb(arg):
+            # The reference may be gone already, if it was dropped
+            # before its target
+            self = self_wr()
+            if self is not None and self._alive:
+                self._alive = False
+                if callback is not None:
+                    callback(self)
+
+        self = weakref.ref.__new__(cls, obj, _cb)
+        self._func_ref = weakref.ref(func, _cb)
+        self._meth_type = type(meth)
+        self._alive = True
+        self_wr = weakref.ref(self)
+        return self
+
+    def __init__(self, meth, callback=None):
+        weakref.ref.__init__(self, meth.im_self)
+
+    def __call__(self):
+        obj = weakref.ref.__call__(self)
+        func = self._func_ref()
+        if obj is None or func is None:
+            return None
+        return self._meth_type(func, obj, type(obj))
+
+    def __eq__(self, other):
+        if isinstance(other, WeakMethod):
+            if not self._alive or not other._alive:
+                return self is other
+            return weakref.ref.__eq__(self, other) and \
+                self._func_ref == other._func_ref
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = weakref.ref.__hash__
+
+
 class BoundMethodWeakref(object):
     """'Safe' and reusable weak references to instance methods
 
+    Kept for compatibility, safeRef() returns a WeakMethod.
+
     BoundMethodWeakref objects provide a mechanism for
     referencing a bound method without requiring that the
     method object itself (which is normally a transient
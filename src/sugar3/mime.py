@@ -24,6 +24,10 @@ STABLE.
 import os
 import logging
 import gettext
+import stat
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from gi.repository import GLib
 from gi.repository import GdkPixbuf
@@ -46,11 +50,6 @@ def _get_supported_image_mime_types():
     return mime_types
 
 
-_extensions = {}
-_globs_timestamps = []
-_subclasses = {}
-_subclasses_timestamps = []
-
 _generic_types = [{
     'id': GENERIC_TYPE_TEXT,
     'name': _('Text'),
@@ -119,22 +118,121 @@ def get_all_generic_types():
     return types
 
 
-def get_for_file(file_name):
+_SNIFF_CACHE_SIZE = 4096
+
+# real path -> ((inode, mtime, size), mime type, sniffed), sniffed is
+# False when the type was guessed from the name only
+_sniff_cache = {}
+
+
+def _get_for_file(file_name, guess_first):
     if file_name.startswith('file://'):
         file_name = file_name[7:]
 
     file_name = os.path.realpath(file_name)
 
-    f = Gio.File.new_for_path(file_name)
     try:
-        info = f.query_info(Gio.FILE_ATTRIBUTE_STANDARD_CONTENT_TYPE, 0, None)
-        mime_type = info.get_content_type()
-    except GLib.GError:
-        mime_type = Gio.content_type_guess(file_name, None)[0]
+        file_stat = os.stat(file_name)
+    except OSError:
+        file_stat = None
+
+    if file_stat is not None:
+        key = (file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+        cached = _sniff_cache.get(file_name)
+        if cached is not None and cached[0] == key and \
+                (guess_first or cached[2]):
+            return cached[1]
+
+    mime_type = None
+    if guess_first and file_stat is not None and \
+            stat.S_ISREG(file_stat.st_mode):
+        # The name alone is enough when the guess is certain, this is
+        # what query_info() would find before sniffing the content
+        mime_type, uncertain = Gio.content_type_guess(file_name, None)
+        if uncertain:
+            mime_type = None
+    sniffed = mime_type is None
+
+    if mime_type is None:
+        f = Gio.File.new_for_path(file_name)
+        try:
+            info = f.query_info(Gio.FILE_ATTRIBUTE_STANDARD_CONTENT_TYPE, 0,
+                                None)
+            mime_type = info.get_content_type()
+        except GLib.GError:
+            mime_type = Gio.content_type_guess(file_name, None)[0]
+
+    if file_stat is not None:
+        if len(_sniff_cache) >= _SNIFF_CACHE_SIZE:
+            _sniff_cache.clear()
+        _sniff_cache[file_name] = (key, mime_type, sniffed)
 
     return mime_type
 
 
+def get_for_file(file_name):
+    return _get_for_file(file_name, False)
+
+
+def _map_files(function, file_names, jobs):
+    if len(file_names) < 2 or jobs < 2:
+        return [function(file_name) for file_name in file_names]
+
+    pool = ThreadPool(min(jobs, len(file_names)))
+    try:
+        return pool.map(function, file_names)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_for_files(file_names, jobs=4):
+    """Return the MIME types of many files, in the same order
+
+    The files are classified by a pool of jobs threads. A file whose
+    name gives a certain type is not opened; the others are sniffed
+    with Gio. Results are cached until the inode, modification time
+    or size of a file changes.
+    """
+    return _map_files(lambda file_name: _get_for_file(file_name, True),
+                      list(file_names), jobs)
+
+
+def _try_get_for_file(file_name):
+    try:
+        return _get_for_file(file_name, True)
+    # pylint: disable=W0703
+    except Exception:
+        logging.exception('Could not get the MIME type of %r', file_name)
+        return None
+
+
+def get_for_files_async(file_names, callback, jobs=4):
+    """Classify files like get_for_files() without blocking
+
+    callback is called from the main loop with the list of MIME types,
+    None for the files that could not be classified.
+    """
+    file_names = list(file_names)
+
+    def deliver(mime_types):
+        callback(mime_types)
+        return False
+
+    def run():
+        try:
+            mime_types = _map_files(_try_get_for_file, file_names, jobs)
+        # pylint: disable=W0703
+        except Exception:
+            logging.exception('Could not classify files')
+            mime_types = [None] * len(file_names)
+        GLib.idle_add(deliver, mime_types)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+
 def get_from_file_name(file_name):
     """
     DEPRECATED: 0.102 (removed in 4 releases)
@@ -159,42 +257,6 @@ def get_mime_description(mime_type):
     return Gio.content_type_get_description(mime_type)
 
 
-def get_mime_parents(mime_type):
-    global _subclasses
-    global _subclasses_timestamps
-
-    dirs = _get_mime_data_directories()
-
-    timestamps = []
-    subclasses_path_list = []
-    for f in dirs:
-        subclasses_path = os.path.join(f, 'mime', 'subclasses')
-        try:
-            mtime = os.stat(subclasses_path).st_mtime
-            timestamps.append([subclasses_path, mtime])
-            subclasses_path_list.append(subclasses_path)
-        except OSError:
-            pass
-
-    if timestamps != _subclasses_timestamps:
-        _subclasses = {}
-        for subclasses_path in subclasses_path_list:
-            with open(subclasses_path) as parents_file:
-                for line in parents_file:
-                    subclass, parent = line.split()
-                    if subclass not in _subclasses.keys():
-                        _subclasses[subclass] = [parent]
-                    else:
-                        _subclasses[subclass].append(parent)
-
-        _subclasses_timestamps = timestamps
-
-    if mime_type in _subclasses.keys():
-        return _subclasses[mime_type]
-    else:
-        return []
-
-
 def _get_mime_data_directories():
     dirs = []
 
@@ -210,58 +272,187 @@ def _get_mime_data_directories():
     return dirs
 
 
-def _init_mime_information():
-    global _extensions
-    global _globs_timestamps
+class _MimeDatabase(object):
+    """The parts of the shared MIME database not exposed by Gio
 
-    dirs = _get_mime_data_directories()
+    The globs, subclasses and aliases files of every data directory
+    are loaded once and answered from dictionaries. Their modification
+    times are checked at most every CHECK_INTERVAL seconds, so that
+    newly installed activity MIME types are still picked up.
 
-    timestamps = []
-    globs_path_list = []
-    for f in dirs:
-        globs_path = os.path.join(f, 'mime', 'globs')
-        if os.path.exists(globs_path):
-            mtime = os.stat(globs_path).st_mtime
-            timestamps.append([globs_path, mtime])
-            globs_path_list.append(globs_path)
+    The transitive ancestors of a type are computed on first use and
+    memoized until the files change; the descendants index is built
+    from them the first time it is needed.
+    """
 
-    if timestamps != _globs_timestamps:
-        # Clear the old extensions list
-        _extensions = {}
+    CHECK_INTERVAL = 5
+
+    def __init__(self):
+        self._extensions = {}
+        self._subclasses = {}
+        self._aliases = {}
+        self._ancestors = {}
+        self._descendants = None
+        self._timestamps = None
+        self._last_check = None
+
+    def _get_timestamps(self):
+        timestamps = []
+        for data_dir in _get_mime_data_directories():
+            for name in ('globs', 'subclasses', 'aliases'):
+                path = os.path.join(data_dir, 'mime', name)
+                try:
+                    timestamps.append((path, os.stat(path).st_mtime))
+                except OSError:
+                    pass
+        return timestamps
+
+    def _load(self, timestamps):
+        extensions = {}
+        subclasses = {}
+        aliases = {}
 
         # FIXME Properly support these types in the system. (#4855)
-        _extensions['audio/ogg'] = ['ogg']
-        _extensions['video/ogg'] = ['ogg']
+        extensions['audio/ogg'] = ['ogg']
+        extensions['video/ogg'] = ['ogg']
+
+        for path, mtime_ in timestamps:
+            if path.endswith('globs'):
+                with open(path) as globs_file:
+                    for line in globs_file:
+                        line = line.strip()
+                        if not line or line.startswith('#'):
+                            continue
+                        line_type, glob = line.split(':', 1)
+                        if glob.startswith('*.'):
+                            extensions.setdefault(line_type, []).append(
+                                glob[2:])
+            elif path.endswith('subclasses'):
+                with open(path) as parents_file:
+                    for line in parents_file:
+                        subclass, parent = line.split()
+                        subclasses.setdefault(subclass, []).append(parent)
+            else:
+                with open(path) as aliases_file:
+                    for line in aliases_file:
+                        alias, mime_type = line.split()
+                        aliases.setdefault(alias, mime_type)
+
+        self._extensions = extensions
+        self._subclasses = subclasses
+        self._aliases = aliases
+        self._ancestors = {}
+        self._descendants = None
+        self._timestamps = timestamps
+
+    def _update(self):
+        now = time.time()
+        if self._last_check is not None and \
+                0 <= now - self._last_check < self.CHECK_INTERVAL:
+            return
+        self._last_check = now
+
+        timestamps = self._get_timestamps()
+        if timestamps != self._timestamps:
+            self._load(timestamps)
+
+    def invalidate(self):
+        """Check the database files again on the next lookup"""
+        self._last_check = None
+
+    def get_extensions(self, mime_type):
+        self._update()
+        return self._extensions.get(mime_type, [])
+
+    def get_parents(self, mime_type):
+        self._update()
+        return self._subclasses.get(mime_type, [])
+
+    def unalias(self, mime_type):
+        self._update()
+        return self._aliases.get(mime_type, mime_type)
+
+    def _get_ancestors(self, mime_type):
+        if mime_type in self._ancestors:
+            return self._ancestors[mime_type]
+
+        ancestors = []
+        seen = set([mime_type])
+        pending = [mime_type]
+        while pending:
+            current = pending.pop(0)
+            for parent in self._subclasses.get(current, []):
+                parent = self._aliases.get(parent, parent)
+                if parent not in seen:
+                    seen.add(parent)
+                    ancestors.append(parent)
+                    pending.append(parent)
+
+        result = (ancestors, frozenset(ancestors))
+        self._ancestors[mime_type] = result
+        return result
+
+    def get_ancestors(self, mime_type):
+        """Return the ancestors of mime_type, nearest first"""
+        self._update()
+        return self._get_ancestors(self._aliases.get(mime_type,
+                                                     mime_type))[0]
+
+    def get_descendants(self, mime_type):
+        self._update()
+        if self._descendants is None:
+            descendants = {}
+            for subclass in self._subclasses:
+                subclass = self._aliases.get(subclass, subclass)
+                for ancestor in self._get_ancestors(subclass)[0]:
+                    descendants.setdefault(ancestor, set()).add(subclass)
+            self._descendants = descendants
+        mime_type = self._aliases.get(mime_type, mime_type)
+        return self._descendants.get(mime_type, set())
+
+    def is_subtype(self, mime_type, parent_type):
+        self._update()
+        mime_type = self._aliases.get(mime_type, mime_type)
+        parent_type = self._aliases.get(parent_type, parent_type)
+        return mime_type == parent_type or \
+            parent_type in self._get_ancestors(mime_type)[1]
+
+
+_database = _MimeDatabase()
+
+
+def get_mime_parents(mime_type):
+    return _database.get_parents(mime_type)
+
+
+def get_mime_ancestors(mime_type):
+    """Return every type mime_type is a subclass of, nearest first"""
+    return list(_database.get_ancestors(mime_type))
+
+
+def get_mime_descendants(mime_type):
+    """Return the set of types that are subclasses of mime_type"""
+    return set(_database.get_descendants(mime_type))
 
-        for globs_path in globs_path_list:
-            globs_file = open(globs_path)
-            for line in globs_file.readlines():
-                line = line.strip()
-                if not line.startswith('#'):
-                    line_type, glob = line.split(':')
-                    if glob.startswith('*.'):
-                        if line_type in _extensions:
-                            _extensions[line_type].append(glob[2:])
-                        else:
-                            _extensions[line_type] = [glob[2:]]
 
-        _globs_timestamps = timestamps
+def is_subtype(mime_type, parent_type):
+    """Return True if mime_type is parent_type or one of its subclasses
+
+    Aliases are resolved on both sides.
+    """
+    return _database.is_subtype(mime_type, parent_type)
 
 
 def get_primary_extension(mime_type):
-    _init_mime_information()
-    if mime_type in _extensions:
-        return _extensions[mime_type][0]
+    extensions = _database.get_extensions(mime_type)
+    if extensions:
+        return extensions[0]
     else:
         return None
 
 
 def get_extensions_by_mimetype(mime_type):
-    _init_mime_information()
-    if mime_type in _extensions:
-        return _extensions[mime_type]
-    else:
-        return []
+    return _database.get_extensions(mime_type)
 
 
 _MIME_TYPE_BLACK_LIST = [
@@ -314,8 +505,39 @@ def split_uri_list(uri_list):
     return GLib.uri_list_extract_uris(uri_list)
 
 
-def _get_generic_type_for_mime(mime_type):
+def _index_generic_types():
+    generic_types_by_mime = {}
     for generic_type in _generic_types:
-        if mime_type in generic_type['types']:
-            return generic_type
-    return None
+        for mime_type in generic_type['types']:
+            generic_types_by_mime.setdefault(mime_type, generic_type)
+    return generic_types_by_mime
+
+
+_generic_types_by_mime = _index_generic_types()
+
+
+def _get_generic_type_for_mime(mime_type):
+    generic_type = _generic_types_by_mime.get(mime_type)
+    if generic_type is None:
+        generic_type = _generic_types_by_mime.get(
+            _database.unalias(mime_type))
+    return generic_type
+
+
+def find_generic_type(mime_type):
+    """Return the generic type of mime_type or of its nearest ancestor
+
+    Unlike get_mime_icon() and get_mime_description(), which only
+    use the generic type of mime_type itself, subclasses inherit it:
+    text/x-python is Text since it is a subclass of text/plain.
+    Returns an ObjectType, or None.
+    """
+    generic_type = _get_generic_type_for_mime(mime_type)
+    if generic_type is None:
+        for ancestor in _database.get_ancestors(mime_type):
+            generic_type = _generic_types_by_mime.get(ancestor)
+            if generic_type is not None:
+                break
+        else:
+            return None
+    return get_generic_type(generic_type['id'])
@@ -19,10 +19,14 @@
 STABLE.
 """
 
+import collections
+import errno
 import os
+import socket
 import threading
+import time
 import urllib
-import fcntl
+import urlparse
 import tempfile
 
 from gi.repository import GObject
@@ -33,6 +37,43 @@ import SocketServer
 __authinfos = {}
 
 
+def _get_sendfile():
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+
+    try:
+        from sendfile import sendfile
+        return sendfile
+    except ImportError:
+        pass
+
+    try:
+        import ctypes
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        libc_sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if sent < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return sent
+
+    return sendfile
+
+
+_sendfile = _get_sendfile()
+
+_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
 def _add_authinfo(authinfo):
     __authinfos[threading.currentThread()] = authinfo
 
@@ -49,27 +90,112 @@ class GlibTCPServer(SocketServer.TCPServer):
     """GlibTCPServer
 
     Integrate socket accept into glib mainloop.
+
+    Every pending connection is accepted on each wakeup. Request
+    handlers ask for a transfer slot with queue_transfer(); at most
+    max_transfers of them run at the same time (0 means no limit) and
+    the others start in arrival order as slots are released.
     """
 
     allow_reuse_address = True
-    request_queue_size = 20
+    request_queue_size = 128
+    max_transfers = 10
 
     def __init__(self, server_address, RequestHandlerClass):
         SocketServer.TCPServer.__init__(self, server_address,
                                         RequestHandlerClass)
         self.socket.setblocking(0)  # Set nonblocking
 
+        self._waiting_transfers = collections.deque()
+        self._active_transfers = 0
+        self._connections = 0
+        self._connections_total = 0
+        self._requests_total = 0
+        self._bytes_sent = 0
+        self._start_time = time.time()
+
         # Watch the listener socket for data
         GObject.io_add_watch(self.socket, GObject.IO_IN, self._handle_accept)
 
     def _handle_accept(self, source, condition):
-        """Process incoming data on the server's socket by doing an accept()
-        via handle_request()."""
+        """Accept all the pending connections on the server's socket"""
         if not (condition & GObject.IO_IN):
             return True
-        self.handle_request()
+
+        while True:
+            try:
+                request, client_address = self.get_request()
+            except socket.error:
+                # EAGAIN once the backlog is empty
+                break
+
+            self._connections += 1
+            self._connections_total += 1
+            if not self.verify_request(request, client_address):
+                self.connection_closed()
+                request.close()
+                continue
+            try:
+                self.process_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+                self.connection_closed()
+                request.close()
         return True
 
+    def queue_transfer(self, callback):
+        """Call callback once a transfer slot is free
+
+        The slot must be released with transfer_done().
+        """
+        if self.max_transfers and \
+                self._active_transfers >= self.max_transfers:
+            self._waiting_transfers.append(callback)
+        else:
+            self._active_transfers += 1
+            callback()
+
+    def cancel_transfer(self, callback):
+        """Remove a callback still waiting for a transfer slot"""
+        try:
+            self._waiting_transfers.remove(callback)
+        except ValueError:
+            pass
+
+    def transfer_done(self):
+        self._active_transfers -= 1
+        while self._waiting_transfers and \
+                (not self.max_transfers or
+                 self._active_transfers < self.max_transfers):
+            self._active_transfers += 1
+            self._waiting_transfers.popleft()()
+
+    def request_handled(self):
+        self._requests_total += 1
+
+    def add_bytes_sent(self, count):
+        self._bytes_sent += count
+
+    def connection_closed(self):
+        self._connections -= 1
+
+    def get_stats(self):
+        """Return a dict describing the activity of the server
+
+        throughput is the average number of bytes sent per second since
+        the server was created.
+        """
+        elapsed = max(time.time() - self._start_time, 0.001)
+        return {
+            'connections': self._connections,
+            'connections_total': self._connections_total,
+            'requests_total': self._requests_total,
+            'active_transfers': self._active_transfers,
+            'queued_transfers': len(self._waiting_transfers),
+            'bytes_sent': self._bytes_sent,
+            'throughput': self._bytes_sent / elapsed,
+        }
+
     def close_request(self, request):
         """Called to clean up an individual request."""
         # let the request be closed by the request handler when its done
@@ -82,32 +208,198 @@ class GlibTCPServer(SocketServer.TCPServer):
         pass
 
 
+class _RequestReader(object):
+    """Buffered reader of the requests sent on a connection
+
+    Unlike the file objects of sockets, it tells whether it holds data
+    read ahead, pipelined requests the main loop can not see anymore.
+    """
+
+    def __init__(self, sock, bufsize=8192):
+        self._sock = sock
+        self._bufsize = bufsize
+        self._buffer = ''
+        self.closed = False
+
+    def has_data(self):
+        return bool(self._buffer)
+
+    def _fill(self):
+        while True:
+            try:
+                data = self._sock.recv(self._bufsize)
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self._buffer += data
+            return bool(data)
+
+    def readline(self, size=-1):
+        while '\n' not in self._buffer and \
+                (size < 0 or len(self._buffer) < size) and self._fill():
+            pass
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+        self._buffer = ''
+
+
 class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     """RequestHandler class that integrates with Glib mainloop.  It writes
        the specified file to the client in chunks, returning control to the
        mainloop between chunks.
+
+       Regular files are copied to the socket with sendfile() when the
+       platform has it. The chunk size grows while the socket accepts
+       whole chunks and shrinks back on short writes, between CHUNK_SIZE
+       and MAX_CHUNK_SIZE.
+
+       Connections are kept open for further requests, as HTTP/1.1
+       allows, until they have been idle for KEEP_ALIVE_TIMEOUT seconds.
+       Requests are only read once the main loop saw data for them, or
+       when they were read ahead with the previous one.
     """
 
     CHUNK_SIZE = 4096
+    MAX_CHUNK_SIZE = 1024 * 1024
+    KEEP_ALIVE_TIMEOUT = 15
+
+    protocol_version = 'HTTP/1.1'
 
     def __init__(self, request, client_address, server):
         self._file = None
         self._srcid = 0
+        self._timeout_id = 0
+        self._queued = False
+        self._transferring = False
+        self._closed = False
+        self._offset = 0
+        self._remaining = None
+        self._content_length = None
+        self._pending = ''
+        self._chunk_size = self.CHUNK_SIZE
+        self._use_sendfile = False
         SimpleHTTPServer.SimpleHTTPRequestHandler.__init__(
             self, request, client_address, server)
 
+    def setup(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+        # Read whole packets, not a byte at a time
+        self.rfile.close()
+        self.rfile = _RequestReader(self.connection)
+
     def log_request(self, code='-', size='-'):
         pass
 
+    def handle(self):
+        self.close_connection = 1
+        self._wait_for_request()
+
+    def _wait_for_request(self):
+        self.connection.setblocking(1)
+        if self.rfile.has_data():
+            # Already read, the socket will not wake us up for it
+            self._srcid = GObject.idle_add(self._handle_request, None,
+                                           GObject.IO_IN)
+            return
+        self._srcid = GObject.io_add_watch(self.connection, GObject.IO_IN |
+                                           GObject.IO_ERR | GObject.IO_HUP,
+                                           self._handle_request)
+        self._timeout_id = GObject.timeout_add_seconds(
+            self.KEEP_ALIVE_TIMEOUT, self._keep_alive_timeout_cb)
+
+    def _keep_alive_timeout_cb(self):
+        self._timeout_id = 0
+        self.close_connection = 1
+        self._cleanup()
+        return False
+
+    def _handle_request(self, source, condition):
+        self._srcid = 0
+        if self._timeout_id:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = 0
+
+        self.close_connection = 1
+        self.raw_requestline = ''
+        if condition & GObject.IO_IN:
+            try:
+                self.handle_one_request()
+            except socket.error:
+                self.close_connection = 1
+            if self.raw_requestline:
+                self.server.request_handled()
+
+        if not (self._file or self._srcid):
+            # The whole response was sent already
+            self._cleanup()
+        return False
+
     def do_GET(self):
         """Serve a GET request."""
         self._file = self.send_head()
         if self._file:
-            self._srcid = GObject.io_add_watch(self.wfile, GObject.IO_OUT |
-                                               GObject.IO_ERR,
-                                               self._send_next_chunk)
-        else:
-            self._cleanup()
+            self._queued = True
+            self.server.queue_transfer(self._start_transfer)
+
+    def _start_transfer(self):
+        self._queued = False
+        self._transferring = True
+        self.wfile.flush()
+        self.connection.setblocking(0)
+
+        self._offset = 0
+        self._remaining = None
+        self._pending = ''
+        self._chunk_size = self.CHUNK_SIZE
+        self._use_sendfile = False
+
+        if hasattr(self._file, 'fileno'):
+            self._offset = self._file.tell()
+            self._remaining = self._content_length
+            if self._remaining is None:
+                self._remaining = os.fstat(self._file.fileno()).st_size - \
+                    self._offset
+            self._use_sendfile = _sendfile is not None
+
+        self._srcid = GObject.io_add_watch(self.wfile, GObject.IO_OUT |
+                                           GObject.IO_ERR,
+                                           self._send_next_chunk)
+
+    def _write_chunk(self, count):
+        """Write at most count bytes of the file, return the number sent"""
+        fd = self.connection.fileno()
+        if self._use_sendfile:
+            try:
+                return _sendfile(fd, self._file.fileno(), self._offset, count)
+            except OSError, e:
+                # Not supported for this file, copy it by hand instead
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                self._use_sendfile = False
+                self._file.seek(self._offset)
+
+        if not self._pending:
+            self._pending = self._file.read(count)
+            if not self._pending:
+                return 0
+        sent = os.write(fd, self._pending)
+        self._pending = self._pending[sent:]
+        return sent
 
     def _send_next_chunk(self, source, condition):
         if condition & GObject.IO_ERR:
@@ -116,29 +408,114 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         if not (condition & GObject.IO_OUT):
             self._cleanup()
             return False
-        data = self._file.read(self.CHUNK_SIZE)
-        count = os.write(self.wfile.fileno(), data)
-        if count != len(data) or len(data) != self.CHUNK_SIZE:
+
+        count = self._chunk_size
+        if self._remaining is not None:
+            count = min(count, self._remaining)
+
+        try:
+            sent = self._write_chunk(count)
+        except (IOError, OSError), e:
+            if e.errno in _RETRY_ERRNOS:
+                return True
             self._cleanup()
             return False
+
+        if sent == 0:
+            # End of the file, or it shrank while being sent
+            self._cleanup()
+            return False
+
+        self.server.add_bytes_sent(sent)
+        self._offset += sent
+        if self._remaining is not None:
+            self._remaining -= sent
+            if self._remaining <= 0:
+                self._cleanup()
+                return False
+
+        if sent >= count:
+            self._chunk_size = min(self._chunk_size * 2, self.MAX_CHUNK_SIZE)
+        else:
+            self._chunk_size = max(self._chunk_size // 2, self.CHUNK_SIZE)
         return True
 
     def _cleanup(self):
+        """End the current response, then wait for the next request or
+        close the connection"""
         if self._file:
             self._file.close()
             self._file = None
         if self._srcid > 0:
             GObject.source_remove(self._srcid)
             self._srcid = 0
+        if self._timeout_id > 0:
+            GObject.source_remove(self._timeout_id)
+            self._timeout_id = 0
+        if self._queued:
+            self.server.cancel_transfer(self._start_transfer)
+            self._queued = False
+        if self._transferring:
+            self._transferring = False
+            self.server.transfer_done()
+        if self._remaining:
+            # Interrupted, the client can not find the next response
+            self.close_connection = 1
+        self._remaining = None
+
+        if self._closed:
+            return
+        if not self.close_connection and not self.wfile.closed:
+            self._wait_for_request()
+            return
+
+        self._closed = True
         if not self.wfile.closed:
             self.wfile.flush()
         self.wfile.close()
         self.rfile.close()
+        self.connection.close()
+        self.server.connection_closed()
 
     def finish(self):
         """Close the sockets when we're done, not before"""
         pass
 
+    def _parse_range(self, size):
+        """Return the (first, last) bytes requested by the Range header
+
+        Only a single byte range is supported. None means the whole
+        file must be sent, False that the range can not be satisfied.
+        """
+        value = self.headers.getheader('Range')
+        if not value:
+            return None
+
+        unit, sep_, ranges = value.strip().partition('=')
+        if unit.strip().lower() != 'bytes' or ',' in ranges:
+            return None
+        first, sep, last = ranges.strip().partition('-')
+        if not sep:
+            return None
+
+        try:
+            if not first:
+                # suffix range, the last bytes of the file
+                length = int(last)
+                if length <= 0 or size == 0:
+                    return False
+                return max(size - length, 0), size - 1
+            first = int(first)
+            last = int(last) if last else size - 1
+        except ValueError:
+            return None
+
+        if first >= size:
+            return False
+        if first > last:
+            return None
+        return first, min(last, size - 1)
+
     def send_head(self):
         """Common code for GET and HEAD commands.
 
@@ -149,8 +526,12 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         and must be closed by the caller under all circumstances), or
         None, in which case the caller has nothing further to do.
 
+        A single byte range can be requested with the Range header,
+        optionally guarded by If-Range with the ETag of the file.
+
         ** [dcbw] modified to send Content-disposition filename too
         """
+        self._content_length = None
         path = self.translate_path(self.path)
         if not path or not os.path.exists(path):
             self.send_error(404, 'File not found')
@@ -174,17 +555,107 @@ class ChunkedGlibHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         except IOError:
             self.send_error(404, 'File not found')
             return None
-        self.send_response(200)
+
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        etag = '"%x-%x-%x"' % (stat.st_ino, int(stat.st_mtime), size)
+
+        byte_range = self._parse_range(size)
+        if_range = self.headers.getheader('If-Range')
+        if if_range is not None and if_range.strip() != etag:
+            byte_range = None
+
+        if byte_range is False:
+            f.close()
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        if byte_range is None:
+            self.send_response(200)
+            self._content_length = size
+        else:
+            first, last = byte_range
+            f.seek(first)
+            self._content_length = last - first + 1
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (first, last, size))
         self.send_header('Content-type', ctype)
-        self.send_header('Content-Length', str(os.fstat(f.fileno())[6]))
+        self.send_header('Content-Length', str(self._content_length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified',
+                         self.date_time_string(stat.st_mtime))
         self.send_header('Content-Disposition', 'attachment; filename="%s"' %
                          os.path.basename(path))
+        if self.request_version == 'HTTP/1.0' and not self.close_connection:
+            self.send_header('Connection', 'keep-alive')
         self.end_headers()
         return f
 
 
+class BandwidthLimiter(object):
+    """Token bucket shared by the threads of several downloads
+
+    consume() blocks the calling thread for as long as needed to keep
+    the total below rate bytes per second; bursts are limited to a
+    tenth of a second worth of data. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate=0):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._tokens = 0
+        self._last = time.time()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._rate = rate
+            self._tokens = 0
+            self._last = time.time()
+
+    def get_rate(self):
+        return self._rate
+
+    def consume(self, count, cancelled=None):
+        """Account for count bytes, waiting for the bucket to refill
+
+        cancelled is an optional threading.Event ending the wait.
+        """
+        with self._lock:
+            if not self._rate:
+                return
+            now = time.time()
+            self._tokens = min(self._rate / 10.0, self._tokens +
+                               (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= count
+            delay = -self._tokens / self._rate
+
+        if delay > 0:
+            if cancelled is None:
+                time.sleep(delay)
+            else:
+                cancelled.wait(delay)
+
+
 class GlibURLDownloader(GObject.GObject):
-    """Grabs a URL in chunks, returning to the mainloop after each chunk"""
+    """Grabs a URL from a worker thread, reporting to the mainloop
+
+    Resolving the host, connecting, waiting for the headers and
+    reading the body all happen in a thread, so the main loop never
+    blocks. Signals are emitted from the main loop; progress at most
+    every PROGRESS_INTERVAL seconds.
+
+    The read size starts at CHUNK_SIZE and doubles up to MAX_CHUNK_SIZE
+    while reads complete quickly. When the server sends a
+    Content-Length the download is only finished once that many bytes
+    were received. A BandwidthLimiter can be given to share a bandwidth
+    cap with other downloads.
+    """
 
     __gsignals__ = {
         'finished': (GObject.SignalFlags.RUN_FIRST, None,
@@ -195,39 +666,145 @@ class GlibURLDownloader(GObject.GObject):
                      ([GObject.TYPE_PYOBJECT])),
     }
 
-    CHUNK_SIZE = 4096
+    CHUNK_SIZE = 16384
+    MAX_CHUNK_SIZE = 256 * 1024
+    PROGRESS_INTERVAL = 0.1
+
+    # Reads slower than this shrink the read size again
+    _SLOW_READ = 0.5
 
-    def __init__(self, url, destdir=None):
+    def __init__(self, url, destdir=None, limiter=None):
         self._url = url
         if not destdir:
             destdir = tempfile.gettempdir()
         self._destdir = destdir
-        self._srcid = 0
+        self._limiter = limiter
         self._fname = None
         self._outf = None
+        self._temporary = False
         self._suggested_fname = None
         self._info = None
         self._written = 0
+        self._size = None
+        self._etag = None
+        self._running = False
+        self._cancelled = threading.Event()
         GObject.GObject.__init__(self)
 
-    def start(self, destfile=None, destfd=None):
-        self._info = urllib.urlopen(self._url)
+    def start(self, destfile=None, destfd=None, resume=False, etag=None,
+              size=None):
+        """Start the download
+
+        With resume, the data already in destfile is kept and only the
+        rest of the resource is requested. The partial data must be
+        identified by the etag or the size, as returned by get_etag()
+        and get_size() for the interrupted download: the whole resource
+        is downloaded again when it changed in between, or when neither
+        is given.
+        """
         self._outf = None
         self._fname = None
+        self._temporary = False
         if destfd and not destfile:
             raise ValueError('Must provide destination file too when'
                              ' specifying file descriptor')
+        if resume and (not destfile or destfd):
+            raise ValueError('Can only resume a download to a destination'
+                             ' file')
+
+        offset = 0
+        if resume and (etag or size is not None):
+            path = os.path.abspath(os.path.expanduser(destfile))
+            if os.path.exists(path):
+                offset = os.stat(path).st_size
+
+        self._written = 0
+        self._size = None
+        self._running = True
+        self._cancelled.clear()
+        thread = threading.Thread(target=self._download,
+                                  args=(destfile, destfd, offset, etag,
+                                        size))
+        thread.daemon = True
+        thread.start()
+
+    def get_etag(self):
+        """Return the ETag of the resource, to resume the download later"""
+        return self._etag
+
+    def get_size(self):
+        """Return the size of the resource, or None while it is unknown"""
+        return self._size
+
+    def get_written(self):
+        """Return the number of bytes in the destination file so far"""
+        return self._written
+
+    def cancel(self):
+        """Stop the download
+
+        Once the worker thread noticed, a temporary destination file is
+        removed, while a destfile given to start() keeps the data
+        received so far, to resume the download later. No further
+        signal is emitted.
+        """
+        if not self._running:
+            raise RuntimeError('Download already canceled or stopped')
+        self._running = False
+        self._cancelled.set()
+
+    def _open(self, destfile, destfd, offset, etag, size):
+        """Send the request and open the destination, in the worker"""
+        opener = urllib.FancyURLopener()
+        if offset:
+            opener.addheader('Range', 'bytes=%d-' % offset)
+            if etag:
+                opener.addheader('If-Range', etag)
+
+        self._info = opener.open(self._url)
+        headers = self._info.headers
+        self._etag = headers.getheader('ETag')
+
+        complete = False
+        if offset:
+            content_range = headers.getheader('Content-Range', '')
+            total = content_range.rpartition('/')[2]
+            if not etag and total != str(size):
+                # Without If-Range a changed resource is only told
+                # apart by its size
+                if self._info.getcode() != 200:
+                    self._info.close()
+                    return self._open(destfile, destfd, 0, None, None)
+            elif self._info.getcode() == 206 and \
+                    content_range.startswith('bytes %d-' % offset):
+                self._written = offset
+            elif self._info.getcode() == 416 and total == str(offset):
+                # Nothing left to download
+                self._written = offset
+                complete = True
+            elif self._info.getcode() != 200:
+                raise IOError('Can not resume download of %s, status %d' %
+                              (self._url, self._info.getcode()))
+
+        if complete:
+            self._size = offset
+        elif headers.getheader('Content-Length', '').isdigit():
+            self._size = self._written + \
+                int(headers.getheader('Content-Length'))
+
         if destfile:
             self._suggested_fname = os.path.basename(destfile)
             self._fname = os.path.abspath(os.path.expanduser(destfile))
             if destfd:
                 # Use the user-supplied destination file descriptor
                 self._outf = destfd
+            elif self._written:
+                self._outf = os.open(self._fname, os.O_WRONLY | os.O_APPEND)
             else:
                 self._outf = os.open(self._fname, os.O_RDWR |
                                      os.O_TRUNC | os.O_CREAT, 0644)
         else:
-            fname = self._get_filename_from_headers(self._info.headers)
+            fname = self._get_filename_from_headers(headers)
             self._suggested_fname = fname
             garbage_, path = urllib.splittype(self._url)
             garbage_, path = urllib.splithost(path or "")
@@ -236,16 +813,81 @@ class GlibURLDownloader(GObject.GObject):
             suffix = os.path.splitext(path)[1]
             (self._outf, self._fname) = tempfile.mkstemp(suffix=suffix,
                                                          dir=self._destdir)
+            self._temporary = True
+        return not complete
 
-        fcntl.fcntl(self._info.fp.fileno(), fcntl.F_SETFD, os.O_NDELAY)
-        self._srcid = GObject.io_add_watch(self._info.fp.fileno(),
-                                           GObject.IO_IN | GObject.IO_ERR,
-                                           self._read_next_chunk)
+    def _download(self, destfile, destfd, offset, etag, size):
+        try:
+            if self._open(destfile, destfd, offset, etag, size):
+                self._read_body()
+        except Exception, err:
+            if isinstance(err, OSError) and self._outf is not None:
+                message = 'Error writing to download file.'
+            else:
+                message = 'Error downloading file: %r' % err
+            GObject.idle_add(self._stopped_cb, message)
+        else:
+            GObject.idle_add(self._stopped_cb, None)
 
-    def cancel(self):
-        if self._srcid == 0:
-            raise RuntimeError('Download already canceled or stopped')
-        self.cleanup(remove=True)
+    def _read_body(self):
+        chunk_size = self.CHUNK_SIZE
+        last_progress = 0
+        while not self._cancelled.is_set():
+            if self._size is not None:
+                if self._written >= self._size:
+                    break
+                count = min(chunk_size, self._size - self._written)
+            else:
+                count = chunk_size
+
+            if self._limiter is not None:
+                count = min(count, max(self._limiter.get_rate() // 10,
+                                       self.CHUNK_SIZE))
+                self._limiter.consume(count, self._cancelled)
+                if self._cancelled.is_set():
+                    break
+
+            read_start = time.time()
+            data = self._info.read(count)
+            now = time.time()
+            if not data:
+                if self._size is not None:
+                    raise IOError('Connection closed after %d of %d bytes' %
+                                  (self._written, self._size))
+                break
+
+            while data:
+                written = os.write(self._outf, data)
+                data = data[written:]
+                self._written += written
+
+            if now - read_start > self._SLOW_READ:
+                chunk_size = max(chunk_size // 2, self.CHUNK_SIZE)
+            else:
+                chunk_size = min(chunk_size * 2, self.MAX_CHUNK_SIZE)
+
+            if now - last_progress >= self.PROGRESS_INTERVAL:
+                last_progress = now
+                GObject.idle_add(self._progress_cb, self._written)
+
+    def _progress_cb(self, written):
+        if self._running:
+            self.emit('progress', written)
+        return False
+
+    def _stopped_cb(self, message):
+        if self._cancelled.is_set():
+            self.cleanup(remove=True)
+        elif message is not None:
+            self._running = False
+            self.cleanup(remove=True)
+            self.emit('error', message)
+        else:
+            self._running = False
+            self.cleanup()
+            self.emit('progress', self._written)
+            self.emit('finished', self._fname, self._suggested_fname)
+        return False
 
     def _get_filename_from_headers(self, headers):
         if 'Content-Disposition' not in headers:
@@ -263,46 +905,179 @@ class GlibURLDownloader(GObject.GObject):
             fname = fname[:len(fname) - 1]
         return fname
 
-    def _read_next_chunk(self, source, condition):
-        if condition & GObject.IO_ERR:
-            self.cleanup(remove=True)
-            self.emit('error', 'Error downloading file.')
-            return False
-        elif not (condition & GObject.IO_IN):
-            # shouldn't get here, but...
-            return True
+    def cleanup(self, remove=False):
+        """Close the connection and the destination file
 
-        try:
-            data = self._info.fp.read(self.CHUNK_SIZE)
-            count = os.write(self._outf, data)
-            self._written += len(data)
-
-            # error writing data to file?
-            if count < len(data):
-                self.cleanup(remove=True)
-                self.emit('error', 'Error writing to download file.')
-                return False
+        With remove, the destination file is deleted if the downloader
+        created it as a temporary file. Files chosen by the caller are
+        kept, so that interrupted downloads can be resumed.
+        """
+        if self._info is not None:
+            self._info.close()
+        self._info = None
+        if self._outf is not None:
+            os.close(self._outf)
+            if remove and self._temporary:
+                os.remove(self._fname)
+        self._outf = None
 
-            self.emit('progress', self._written)
 
-            # done?
-            if len(data) < self.CHUNK_SIZE:
-                self.cleanup()
-                self.emit('finished', self._fname, self._suggested_fname)
-                return False
-        except Exception, err:
-            self.cleanup(remove=True)
-            self.emit('error', 'Error downloading file: %r' % err)
+def _get_download_key(url, destfile):
+    if destfile:
+        destfile = os.path.abspath(os.path.expanduser(destfile))
+    return url, destfile
+
+
+class _Download(object):
+
+    def __init__(self, url, destfile):
+        self.url = url
+        self.destfile = destfile
+        self.key = _get_download_key(url, destfile)
+        self.host = urlparse.urlsplit(url).netloc
+        self.downloader = None
+        self.written = 0
+        self.size = None
+
+
+class DownloadManager(GObject.GObject):
+    """Queue of GlibURLDownloader downloads
+
+    At most max_downloads downloads run at the same time, and no more
+    than max_per_host of them from the same host; the others wait in
+    the order they were added. Adding a download identical to a queued
+    or running one, same URL and destination, does not start a new
+    one. A download to a temporary file and one to a given file are
+    not identical, even for the same URL, since both files must be
+    written. All the downloads share a bandwidth cap of max_rate bytes per
+    second, 0 meaning no cap.
+
+    progress reports the bytes received and the known total size of
+    every download since the manager last became idle.
+    """
+
+    __gsignals__ = {
+        'download-finished': (GObject.SignalFlags.RUN_FIRST, None,
+                              ([GObject.TYPE_PYOBJECT, GObject.TYPE_PYOBJECT,
+                                GObject.TYPE_PYOBJECT])),
+        'download-error': (GObject.SignalFlags.RUN_FIRST, None,
+                           ([GObject.TYPE_PYOBJECT, GObject.TYPE_PYOBJECT])),
+        'progress': (GObject.SignalFlags.RUN_FIRST, None,
+                     ([GObject.TYPE_PYOBJECT, GObject.TYPE_PYOBJECT])),
+        'idle': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+    }
+
+    def __init__(self, destdir=None, max_downloads=4, max_per_host=2,
+                 max_rate=0):
+        GObject.GObject.__init__(self)
+        self._destdir = destdir
+        self.max_downloads = max_downloads
+        self.max_per_host = max_per_host
+        self._limiter = BandwidthLimiter(max_rate)
+        self._queue = collections.deque()
+        self._active = []
+        self._downloads = {}
+        self._done_written = 0
+        self._done_size = 0
+
+    def set_max_rate(self, max_rate):
+        self._limiter.set_rate(max_rate)
+
+    def get_max_rate(self):
+        return self._limiter.get_rate()
+
+    def add(self, url, destfile=None):
+        """Queue the download of url, to destfile or a temporary file
+
+        Returns False if the same download was already queued or
+        running.
+        """
+        download = _Download(url, destfile)
+        if download.key in self._downloads:
             return False
+        self._downloads[download.key] = download
+        self._queue.append(download)
+        self._start_next()
         return True
 
-    def cleanup(self, remove=False):
-        if self._srcid > 0:
-            GObject.source_remove(self._srcid)
-            self._srcid = 0
-        del self._info
-        self._info = None
-        os.close(self._outf)
-        if remove:
-            os.remove(self._fname)
-        self._outf = None
+    def cancel(self, url, destfile=None):
+        download = self._downloads.pop(_get_download_key(url, destfile),
+                                       None)
+        if download is None:
+            return
+        if download in self._queue:
+            self._queue.remove(download)
+        else:
+            self._active.remove(download)
+            download.downloader.cancel()
+            self._start_next()
+        self._check_idle()
+
+    def get_pending(self):
+        """Return the number of queued and running downloads"""
+        return len(self._downloads)
+
+    def _host_count(self, host):
+        return len([download for download in self._active
+                    if download.host == host])
+
+    def _start_next(self):
+        for download in list(self._queue):
+            if len(self._active) >= self.max_downloads:
+                break
+            if download not in self._queue or \
+                    self._host_count(download.host) >= self.max_per_host:
+                continue
+            self._queue.remove(download)
+            self._start(download)
+
+    def _start(self, download):
+        downloader = GlibURLDownloader(download.url, self._destdir,
+                                       self._limiter)
+        downloader.connect('progress', self._progress_cb, download)
+        downloader.connect('finished', self._finished_cb, download)
+        downloader.connect('error', self._error_cb, download)
+        download.downloader = downloader
+        self._active.append(download)
+        try:
+            downloader.start(download.destfile)
+        except Exception, e:
+            self._error_cb(downloader, 'Error downloading file: %r' % e,
+                           download)
+
+    def _emit_progress(self):
+        written = self._done_written
+        size = self._done_size
+        for download in self._active:
+            written += download.written
+            size += download.size or 0
+        self.emit('progress', written, size)
+
+    def _progress_cb(self, downloader, written, download):
+        download.written = written
+        download.size = downloader.get_size()
+        self._emit_progress()
+
+    def _download_done(self, download):
+        self._active.remove(download)
+        del self._downloads[download.key]
+        self._done_written += download.written
+        self._done_size += download.size or download.written
+        self._start_next()
+
+    def _check_idle(self):
+        if not self._downloads:
+            self._done_written = 0
+            self._done_size = 0
+            self.emit('idle')
+
+    def _finished_cb(self, downloader, fname, suggested_fname, download):
+        download.written = downloader.get_written()
+        self._download_done(download)
+        self.emit('download-finished', download.url, fname, suggested_fname)
+        self._check_idle()
+
+    def _error_cb(self, downloader, message, download):
+        self._download_done(download)
+        self.emit('download-error', download.url, message)
+        self._check_idle()
@@ -0,0 +1,348 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""Activity startup timeline tracer
+
+When SUGAR_STARTUP_TRACE is set in the environment, sugar-activity
+records how long each startup phase and each slow module import takes,
+from the moment the shell spawned the process to the first frame drawn
+by the activity window. Every launch writes a startup-*.trace file into
+the logs directory.
+
+Run this module to aggregate the traces of several launches:
+
+    python -m sugar3.startuptrace [trace file or directory...]
+
+UNSTABLE.
+"""
+
+import __builtin__
+import json
+import os
+import sys
+import time
+
+ENABLE_ENV = 'SUGAR_STARTUP_TRACE'
+LAUNCH_TIME_ENV = 'SUGAR_STARTUP_TRACE_LAUNCH'
+
+# Imports faster than this, in seconds, are not recorded
+IMPORT_THRESHOLD = 0.001
+
+_TRACE_FORMAT = 1
+
+
+def _get_monotonic():
+    try:
+        import ctypes
+
+        class _Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long),
+                        ('tv_nsec', ctypes.c_long)]
+
+        clock_gettime = ctypes.CDLL('libc.so.6').clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+
+    clock_monotonic = 1
+
+    def monotonic():
+        # Allocated per call, the import hook may run in several threads
+        timespec = _Timespec()
+        clock_gettime(clock_monotonic, ctypes.byref(timespec))
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+    return monotonic
+
+
+_monotonic = None
+
+
+def monotonic():
+    """Return the time of the system wide monotonic clock"""
+    global _monotonic
+    if _monotonic is None:
+        _monotonic = _get_monotonic()
+    return _monotonic()
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+class _Phase(object):
+
+    def __init__(self, tracer, name):
+        self._tracer = tracer
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._tracer.phases.append((self._name, self._start, monotonic()))
+        return False
+
+
+class _Tracer(object):
+
+    def __init__(self):
+        self.origin = monotonic()
+        self.launch = None
+        self.phases = []
+        self.marks = []
+        self.imports = []
+        self._import_depth = 0
+        self._original_import = None
+
+        # The launch time comes from the monotonic clock of the shell,
+        # it can not be compared with time.time() used as fallback
+        if LAUNCH_TIME_ENV in os.environ and _monotonic is not time.time:
+            try:
+                self.launch = float(os.environ[LAUNCH_TIME_ENV])
+            except ValueError:
+                pass
+
+    def install_import_hook(self):
+        self._original_import = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def remove_import_hook(self):
+        if self._original_import is not None:
+            __builtin__.__import__ = self._original_import
+            self._original_import = None
+
+    def _import(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self._original_import(name, *args, **kwargs)
+
+        start = monotonic()
+        self._import_depth += 1
+        try:
+            return self._original_import(name, *args, **kwargs)
+        finally:
+            self._import_depth -= 1
+            elapsed = monotonic() - start
+            if elapsed >= IMPORT_THRESHOLD:
+                self.imports.append((name, self._import_depth, elapsed))
+
+    def get_trace(self, bundle_id):
+        # Times are in milliseconds from the spawn of the process, or
+        # from the start of the tracer when the shell did not pass it
+        base = self.origin if self.launch is None else self.launch
+
+        def ms(timestamp):
+            return round((timestamp - base) * 1000, 2)
+
+        phases = [(name, ms(start), ms(end))
+                  for name, start, end in self.phases]
+        if self.launch is not None:
+            phases.insert(0, ('spawn', 0, ms(self.origin)))
+
+        return {
+            'format': _TRACE_FORMAT,
+            'bundle_id': bundle_id,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'phases': phases,
+            'marks': [(name, ms(timestamp))
+                      for name, timestamp in self.marks],
+            'imports': [(name, depth, round(elapsed * 1000, 2))
+                        for name, depth, elapsed in self.imports],
+        }
+
+
+_tracer = None
+
+
+def start():
+    """Start tracing if SUGAR_STARTUP_TRACE is set
+
+    Call it as early as possible, imports done before are not traced.
+    """
+    global _tracer
+    if _tracer is not None or not os.environ.get(ENABLE_ENV):
+        return
+    _tracer = _Tracer()
+    _tracer.install_import_hook()
+
+
+def is_enabled():
+    return _tracer is not None
+
+
+def phase(name):
+    """Return a context manager recording the duration of a phase"""
+    if _tracer is None:
+        return _null_phase
+    return _Phase(_tracer, name)
+
+
+def mark(name):
+    """Record the time at which a point of the startup is reached"""
+    if _tracer is not None:
+        _tracer.marks.append((name, monotonic()))
+
+
+def finish(bundle_id=None):
+    """Stop tracing and write the trace file
+
+    Returns the path of the trace file, or None if tracing was not
+    enabled or the file could not be written.
+    """
+    global _tracer
+    if _tracer is None:
+        return None
+    tracer = _tracer
+    _tracer = None
+    tracer.remove_import_hook()
+
+    if bundle_id is None:
+        bundle_id = os.environ.get('SUGAR_BUNDLE_ID', 'unknown')
+
+    from sugar3 import env
+    logs_path = env.get_logs_path()
+    path = os.path.join(logs_path, 'startup-%s-%d.trace' %
+                        (bundle_id, os.getpid()))
+    try:
+        if not os.path.isdir(logs_path):
+            os.makedirs(logs_path)
+        with open(path, 'w') as f:
+            json.dump(tracer.get_trace(bundle_id), f,
+                      separators=(',', ':'))
+    except (IOError, OSError):
+        return None
+    return path
+
+
+def finish_on_first_frame(window, bundle_id=None):
+    """Mark the first frame drawn by window and write the trace"""
+    if _tracer is None:
+        return
+
+    def draw_cb(widget, cr):
+        widget.disconnect(handler_id)
+        mark('first-frame')
+        finish(bundle_id)
+        return False
+
+    handler_id = window.connect_after('draw', draw_cb)
+
+
+def load_traces(paths):
+    """Return the traces read from files and directories of traces"""
+    traces = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = [os.path.join(path, name)
+                     for name in sorted(os.listdir(path))
+                     if name.startswith('startup-') and
+                     name.endswith('.trace')]
+        else:
+            names = [path]
+        for name in names:
+            try:
+                with open(name) as f:
+                    trace = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if trace.get('format') == _TRACE_FORMAT:
+                traces.append(trace)
+    return traces
+
+
+def _summarize(values):
+    values = sorted(values)
+    count = len(values)
+    return {
+        'count': count,
+        'mean': sum(values) / count,
+        'median': values[count // 2],
+        'max': values[-1],
+    }
+
+
+def aggregate(traces):
+    """Return per phase, mark and import statistics over traces
+
+    The result maps 'phases', 'marks' and 'imports' to lists of
+    (name, stats) sorted by decreasing mean, stats being a dict with
+    count, mean, median and max in milliseconds. Only top level
+    imports are reported, their time includes nested imports.
+    """
+    durations = {}
+    marks = {}
+    imports = {}
+    for trace in traces:
+        for name, start, end in trace['phases']:
+            durations.setdefault(name, []).append(end - start)
+        for name, timestamp in trace['marks']:
+            marks.setdefault(name, []).append(timestamp)
+        for name, depth, elapsed in trace['imports']:
+            if depth == 0:
+                imports.setdefault(name, []).append(elapsed)
+
+    def summarize_all(values):
+        stats = [(name, _summarize(times)) for name, times in values.items()]
+        stats.sort(key=lambda item: item[1]['mean'], reverse=True)
+        return stats
+
+    return {
+        'phases': summarize_all(durations),
+        'marks': summarize_all(marks),
+        'imports': summarize_all(imports),
+    }
+
+
+def _print_report(traces, max_imports=15):
+    report = aggregate(traces)
+    print '%d launches' % len(traces)
+    for title, stats in (('Phase', report['phases']),
+                         ('Mark', report['marks']),
+                         ('Import', report['imports'][:max_imports])):
+        print
+        print '%-40s %5s %9s %9s %9s' % (title, 'n', 'mean', 'median',
+                                         'max')
+        for name, values in stats:
+            print '%-40s %5d %9.1f %9.1f %9.1f' % (
+                name, values['count'], values['mean'], values['median'],
+                values['max'])
+
+
+def main():
+    paths = sys.argv[1:]
+    if not paths:
+        from sugar3 import env
+        paths = [env.get_logs_path()]
+    traces = load_traces(paths)
+    if not traces:
+        print 'No startup traces found.'
+        sys.exit(1)
+    _print_report(traces)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import fcntl
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from gi.repository import GLib
+
+from sugar3.activity import activityfactory
+
+
+class Bundle(object):
+
+    def __init__(self, bundle_id, path):
+        self._bundle_id = bundle_id
+        self._path = path
+
+    def get_bundle_id(self):
+        return self._bundle_id
+
+    def get_path(self):
+        return self._path
+
+
+@unittest.skipIf(activityfactory._close_fds is None,
+                 'close_range() with CLOSE_RANGE_CLOEXEC is not available')
+class TestCloseFds(unittest.TestCase):
+
+    def test_close_fds(self):
+        files = [open(os.devnull) for i in range(10)]
+        cloexec = files[0].fileno()
+        fcntl.fcntl(cloexec, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                activityfactory._close_fds()
+                for fd in os.listdir('/proc/self/fd'):
+                    fd = int(fd)
+                    try:
+                        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                    except IOError:
+                        continue
+                    if fd > 2 and not flags & fcntl.FD_CLOEXEC:
+                        break
+                else:
+                    # Marked descriptors are left for the exec to close
+                    os.fstat(cloexec)
+                    status = 0
+            finally:
+                os._exit(status)
+
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        for f in files:
+            f.close()
+
+    def test_preexec(self):
+        with open(os.devnull) as f:
+            child = subprocess.Popen(
+                ['ls', '/proc/self/fd/%d' % f.fileno()],
+                preexec_fn=activityfactory._close_fds,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            child.communicate()
+            self.assertNotEqual(child.returncode, 0)
+
+        # Errors are still reported through the pipe of subprocess
+        self.assertRaises(OSError, subprocess.Popen, ['/nonexistent'],
+                          preexec_fn=activityfactory._close_fds)
+
+
+class TestEnvironment(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._old_environ = os.environ.copy()
+        os.environ['SUGAR_HOME'] = self._temp_dir
+        os.environ['SUGAR_PROFILE'] = 'test'
+        os.environ['SUGAR_LOGS_DIR'] = os.path.join(self._temp_dir, 'logs')
+        os.mkdir(os.environ['SUGAR_LOGS_DIR'])
+        self._bundle = Bundle('org.sugarlabs.Test', '/usr/share/sugar')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self._old_environ)
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_environment_async(self):
+        loop = GLib.MainLoop()
+        result = []
+
+        def reply_handler(environ):
+            result.append(environ)
+            loop.quit()
+
+        def error_handler(error):
+            result.append(error)
+            loop.quit()
+
+        activityfactory.get_environment_async(self._bundle, reply_handler,
+                                              error_handler)
+        loop.run()
+
+        root = os.path.join(self._temp_dir, 'test', 'org.sugarlabs.Test')
+        self.assertEqual(result[0]['SUGAR_ACTIVITY_ROOT'], root)
+        self.assertEqual(result[0]['SUGAR_BUNDLE_PATH'], '/usr/share/sugar')
+        self.assertEqual(sorted(os.listdir(root)),
+                         ['data', 'instance', 'tmp'])
+        self.assertEqual(activityfactory.get_environment(self._bundle),
+                         result[0])
+
+    def test_open_log_file(self):
+        logs_path = os.environ['SUGAR_LOGS_DIR']
+        for name in ('org.sugarlabs.Test-1.log', 'org.sugarlabs.Test-7.log',
+                     'org.sugarlabs.Other-Test-2.log', 'shell.log'):
+            open(os.path.join(logs_path, name), 'w').close()
+
+        def open_log_file(bundle_id):
+            path, f = activityfactory.open_log_file(
+                Bundle(bundle_id, self._temp_dir))
+            f.close()
+            return os.path.basename(path)
+
+        self.assertEqual(open_log_file('org.sugarlabs.Test'),
+                         'org.sugarlabs.Test-8.log')
+        self.assertEqual(open_log_file('org.sugarlabs.Other-Test'),
+                         'org.sugarlabs.Other-Test-3.log')
+
+        # Created by another process
+        open(os.path.join(logs_path, 'org.sugarlabs.Test-9.log'),
+             'w').close()
+        self.assertEqual(open_log_file('org.sugarlabs.Test'),
+                         'org.sugarlabs.Test-10.log')
+        self.assertEqual(open_log_file('org.sugarlabs.New'),
+                         'org.sugarlabs.New-1.log')
+
+    def test_zygote_exit_not_reaped(self):
+        # Stands for an activity forked by the zygote, which is not a
+        # child of the shell
+        child = subprocess.Popen(['sleep', '5'])
+        self.addCleanup(child.wait)
+        self.addCleanup(child.kill)
+        log_path = os.path.join(self._temp_dir, 'activity.log')
+
+        activityfactory._zygote_exit_cb(
+            child.pid, 0, (None, open(log_path, 'w'), 'activity-id'))
+        self.assertIsNone(child.poll())
+        with open(log_path) as f:
+            self.assertIn('Exited with status 0, pid %d' % child.pid,
+                          f.read())
@@ -14,12 +14,18 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import logging
 import os
+import shutil
 import unittest
 import subprocess
+import tempfile
+
+from gi.repository import GLib
 
 from sugar3.bundle.helpers import bundle_from_dir, bundle_from_archive
 from sugar3.bundle.activitybundle import ActivityBundle
+from sugar3.bundle.activitybundle import InstallTransaction
 from sugar3.bundle.contentbundle import ContentBundle
 
 tests_dir = os.path.dirname(__file__)
@@ -47,3 +53,86 @@ class TestBundle(unittest.TestCase):
         subprocess.check_call(["zip", "-r", "sample-1.xol", "sample.content"])
         bundle = bundle_from_archive("./sample-1.xol")
         self.assertIsInstance(bundle, ContentBundle)
+
+
+class TestInstallTransaction(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._icon_path = os.path.join(self._tmp_dir, 'icon.svg')
+        open(self._icon_path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_links_deferred_until_commit(self):
+        link_path = os.path.join(self._tmp_dir, 'link.svg')
+        transaction = InstallTransaction()
+        transaction.link(self._icon_path, link_path)
+        self.assertFalse(os.path.lexists(link_path))
+        transaction.commit()
+        self.assertEqual(os.readlink(link_path), self._icon_path)
+
+    def test_unlink_cancels_pending_link(self):
+        link_path = os.path.join(self._tmp_dir, 'link.svg')
+        with InstallTransaction() as transaction:
+            transaction.link(self._icon_path, link_path)
+            transaction.unlink(link_path, self._tmp_dir)
+        self.assertFalse(os.path.lexists(link_path))
+
+    def test_unlink_keeps_foreign_links(self):
+        link_path = os.path.join(self._tmp_dir, 'link.svg')
+        os.symlink(self._icon_path, link_path)
+        with InstallTransaction() as transaction:
+            transaction.unlink(link_path, '/nonexistent')
+        self.assertTrue(os.path.islink(link_path))
+
+    def _use_update_command(self, script):
+        # Replace update-mime-database on the PATH
+        bin_dir = os.path.join(self._tmp_dir, 'bin')
+        os.mkdir(bin_dir)
+        script_path = os.path.join(bin_dir, 'update-mime-database')
+        with open(script_path, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(script_path, 0755)
+
+        old_path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + ':' + old_path
+        self.addCleanup(os.environ.__setitem__, 'PATH', old_path)
+
+    def test_mime_database_updated_once(self):
+        calls_path = os.path.join(self._tmp_dir, 'calls')
+        self._use_update_command('echo "$1" >> %s\n' % calls_path)
+
+        mime_dir = os.path.join(self._tmp_dir, 'mime')
+        with InstallTransaction() as transaction:
+            transaction.update_mime_database(mime_dir)
+            transaction.update_mime_database(mime_dir)
+        transaction.wait()
+
+        with open(calls_path) as f:
+            self.assertEqual(f.read().splitlines(), [mime_dir])
+
+    def test_mime_database_update_reaped(self):
+        self._use_update_command('exit 3\n')
+        errors = []
+        loop = GLib.MainLoop()
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                errors.append(record.getMessage())
+                loop.quit()
+
+        handler = Handler(logging.ERROR)
+        logging.getLogger().addHandler(handler)
+        self.addCleanup(logging.getLogger().removeHandler, handler)
+
+        mime_dir = os.path.join(self._tmp_dir, 'mime')
+        with InstallTransaction() as transaction:
+            transaction.update_mime_database(mime_dir)
+        # Reaped from the main loop, commit() did not wait
+        self.assertEqual(errors, [])
+        GLib.timeout_add_seconds(10, loop.quit)
+        loop.run()
+
+        self.assertEqual(errors, ['update-mime-database %s failed with '
+                                  'status 3' % mime_dir])
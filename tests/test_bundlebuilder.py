@@ -22,6 +22,10 @@ import tempfile
 import tarfile
 import zipfile
 
+from sugar3.activity import bundlebuilder
+from sugar3.bundle.activitybundle import ActivityBundle
+from sugar3.bundle.bundle import InvalidDeltaException
+
 tests_dir = os.path.dirname(__file__)
 data_dir = os.path.join(tests_dir, "data")
 
@@ -88,6 +92,7 @@ class TestGit(unittest.TestCase):
         stripped_filenames = self._strip_root_dir(filenames)
         expected = self._source_files[:]
         expected.extend(self._get_all_locale_files())
+        expected.append("activity/contents.json")
         self.assertItemsEqual(stripped_filenames, expected)
 
         os.chdir(cwd)
@@ -125,6 +130,203 @@ class TestGit(unittest.TestCase):
 
         os.chdir(cwd)
 
+    def test_dist_xo_reproducible(self):
+        repo_path = self._create_repo()
+        cwd = os.getcwd()
+        os.chdir(repo_path)
+
+        setup_path = os.path.join(repo_path, "setup.py")
+        xo_path = os.path.join(repo_path, "dist", "Sample-1.xo")
+
+        subprocess.call([setup_path, "dist_xo"])
+        with open(xo_path, "rb") as f:
+            first = f.read()
+
+        os.utime(os.path.join(repo_path, "activity.py"), (0, 0))
+        subprocess.call([setup_path, "dist_xo", "--jobs", "1"])
+        with open(xo_path, "rb") as f:
+            self.assertEqual(f.read(), first)
+
+        info = zipfile.ZipFile(xo_path).getinfo(
+            "Sample.activity/activity/activity-sample.svg")
+        self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+
+        os.chdir(cwd)
+
+    def test_dist_delta(self):
+        repo_path = self._create_repo()
+        cwd = os.getcwd()
+        os.chdir(repo_path)
+
+        setup_path = os.path.join(repo_path, "setup.py")
+        subprocess.call([setup_path, "dist_xo"])
+        old_xo_path = os.path.join(tempfile.mkdtemp(), "Sample-1.xo")
+        shutil.move(os.path.join(repo_path, "dist", "Sample-1.xo"),
+                    old_xo_path)
+
+        info_path = os.path.join(repo_path, "activity", "activity.info")
+        with open(info_path) as f:
+            info = f.read()
+        with open(info_path, "w") as f:
+            f.write(info.replace("activity_version = 1",
+                                 "activity_version = 2"))
+        with open(os.path.join(repo_path, "activity.py"), "a") as f:
+            f.write("\n# A change\n")
+
+        subprocess.call([setup_path, "dist_delta", old_xo_path])
+        delta_path = os.path.join(repo_path, "dist", "Sample-1-2.xod")
+        self.assertTrue(os.path.exists(delta_path))
+
+        new_xo_path = os.path.join(tempfile.mkdtemp(), "Sample-2.xo")
+        bundle = ActivityBundle(old_xo_path).apply_delta(delta_path,
+                                                         new_xo_path)
+        self.assertEqual(bundle.get_activity_version(), "2")
+
+        expected = zipfile.ZipFile(os.path.join(repo_path, "dist",
+                                                "Sample-2.xo"))
+        rebuilt = zipfile.ZipFile(new_xo_path)
+        self.assertEqual(rebuilt.namelist(), expected.namelist())
+        for name in expected.namelist():
+            self.assertEqual(rebuilt.read(name), expected.read(name))
+
+        os.chdir(cwd)
+
+    def test_dist_delta_wrong_base(self):
+        repo_path = self._create_repo()
+        cwd = os.getcwd()
+        os.chdir(repo_path)
+
+        setup_path = os.path.join(repo_path, "setup.py")
+        subprocess.call([setup_path, "dist_xo"])
+        old_xo_path = os.path.join(tempfile.mkdtemp(), "Sample-1.xo")
+        shutil.copyfile(os.path.join(repo_path, "dist", "Sample-1.xo"),
+                        old_xo_path)
+
+        with open(os.path.join(repo_path, "activity.py"), "a") as f:
+            f.write("\n# A change\n")
+        subprocess.call([setup_path, "dist_delta", old_xo_path])
+        delta_path = os.path.join(repo_path, "dist", "Sample-1-1.xod")
+
+        # Every member used by the delta is still there
+        wrong_xo_path = os.path.join(tempfile.mkdtemp(), "Sample-1.xo")
+        shutil.copyfile(old_xo_path, wrong_xo_path)
+        with zipfile.ZipFile(wrong_xo_path, "a") as wrong_zip:
+            wrong_zip.writestr("Sample.activity/extra.txt", "extra")
+
+        new_xo_path = os.path.join(tempfile.mkdtemp(), "Sample-2.xo")
+        self.assertRaises(InvalidDeltaException,
+                          ActivityBundle(wrong_xo_path).apply_delta,
+                          delta_path, new_xo_path)
+        self.assertFalse(os.path.exists(new_xo_path))
+        self.assertEqual(os.listdir(os.path.dirname(new_xo_path)), [])
+
+        os.chdir(cwd)
+
+    def test_verify(self):
+        repo_path = self._create_repo()
+        cwd = os.getcwd()
+        os.chdir(repo_path)
+
+        setup_path = os.path.join(repo_path, "setup.py")
+        subprocess.call([setup_path, "dist_xo"])
+        xo_path = os.path.join(repo_path, "dist", "Sample-1.xo")
+
+        self.assertEqual(ActivityBundle(xo_path).verify(), [])
+
+        install_dir = tempfile.mkdtemp()
+        subprocess.check_call(["unzip", "-q", xo_path, "-d", install_dir])
+        bundle = ActivityBundle(os.path.join(install_dir, "Sample.activity"))
+        self.assertEqual(bundle.verify(), [])
+        self.assertEqual(bundle.verify(quick=True), [])
+
+        with open(os.path.join(install_dir, "Sample.activity",
+                               "activity.py"), "a") as f:
+            f.write("# Modified\n")
+        os.remove(os.path.join(install_dir, "Sample.activity", "setup.py"))
+        self.assertEqual(bundle.verify(), ["activity.py", "setup.py"])
+        self.assertEqual(bundle.verify(quick=True),
+                         ["activity.py", "setup.py"])
+
+        os.chdir(cwd)
+
+    def test_install_hardlink(self):
+        repo_path = self._create_repo()
+        install_path = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(repo_path)
+
+        setup_path = os.path.join(repo_path, "setup.py")
+        subprocess.call([setup_path, "install", "--prefix", install_path,
+                         "--mode", "hardlink"])
+
+        source = os.stat(os.path.join(repo_path, "activity.py"))
+        installed = os.stat(os.path.join(install_path, "share", "sugar",
+                                         "activities", "Sample.activity",
+                                         "activity.py"))
+        self.assertEqual((installed.st_dev, installed.st_ino),
+                         (source.st_dev, source.st_ino))
+
+        os.chdir(cwd)
+
+    def test_install_hardlink_rebuild(self):
+        repo_path = self._create_repo()
+        install_path = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(repo_path)
+
+        setup_path = os.path.join(repo_path, "setup.py")
+        subprocess.call([setup_path, "install", "--prefix", install_path,
+                         "--mode", "hardlink", "--no-msgfmt"])
+
+        installed_paths = [
+            os.path.join(install_path, "share", self._share_locale_files[0]),
+            os.path.join(install_path, "share", "sugar", "activities",
+                         "Sample.activity", self._activity_locale_files[0])]
+        installed = []
+        for path in installed_paths:
+            with open(path, "rb") as f:
+                installed.append(f.read())
+
+        po_path = os.path.join(repo_path, "po", "es.po")
+        with open(po_path) as f:
+            po = f.read()
+        with open(po_path, "w") as f:
+            f.write(po.replace('msgid "Sample"\nmsgstr ""',
+                               'msgid "Sample"\nmsgstr "Muestra"'))
+        subprocess.call([setup_path, "build", "--no-msgfmt"])
+
+        with open(os.path.join(repo_path,
+                               self._activity_locale_files[0])) as f:
+            self.assertIn("Muestra", f.read())
+        for path, content in zip(installed_paths, installed):
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), content)
+
+        os.chdir(cwd)
+
+    def test_build_incremental(self):
+        repo_path = self._create_repo()
+        cwd = os.getcwd()
+        os.chdir(repo_path)
+
+        setup_path = os.path.join(repo_path, "setup.py")
+        subprocess.call([setup_path, "build", "--no-msgfmt"])
+
+        mo_path = os.path.join(repo_path, self._share_locale_files[0])
+        mtime = int(os.stat(mo_path).st_mtime)
+        os.utime(mo_path, (mtime - 10, mtime - 10))
+
+        subprocess.call([setup_path, "build", "--no-msgfmt"])
+        self.assertEqual(os.stat(mo_path).st_mtime, mtime - 10)
+
+        with open(os.path.join(repo_path, "po", "es.po"), "a") as f:
+            f.write('\n# new comment\n')
+
+        subprocess.call([setup_path, "build", "--no-msgfmt"])
+        self.assertNotEqual(os.stat(mo_path).st_mtime, mtime - 10)
+
+        os.chdir(cwd)
+
     def _test_dev(self, source_path, build_path):
         activities_path = tempfile.mkdtemp()
 
@@ -243,3 +445,123 @@ class TestGit(unittest.TestCase):
         repo_path = self._create_repo()
         build_path = tempfile.mkdtemp()
         self._test_genpot(repo_path, build_path)
+        self.assertTrue(os.path.exists(
+            os.path.join(build_path, bundlebuilder.MANIFEST_CACHE_NAME)))
+
+    def test_genpot_failure(self):
+        repo_path = self._create_repo()
+        cwd = os.getcwd()
+        os.chdir(repo_path)
+
+        pot_path = os.path.join(repo_path, "po", "Sample.pot")
+        with open(pot_path) as f:
+            pot = f.read()
+
+        bin_path = tempfile.mkdtemp()
+        xgettext_path = os.path.join(bin_path, "xgettext")
+        with open(xgettext_path, "w") as f:
+            f.write("#!/bin/sh\nexit 1\n")
+        os.chmod(xgettext_path, 0755)
+
+        env = dict(os.environ)
+        env["PATH"] = bin_path + os.pathsep + env.get("PATH", "")
+        setup_path = os.path.join(repo_path, "setup.py")
+        with open(os.devnull, "w") as devnull:
+            returncode = subprocess.call([setup_path, "genpot"], env=env,
+                                         stdout=devnull)
+        self.assertNotEqual(returncode, 0)
+
+        with open(pot_path) as f:
+            self.assertEqual(f.read(), pot)
+        self.assertFalse(os.path.exists(
+            os.path.join(repo_path, bundlebuilder.GENPOT_CACHE_NAME)))
+
+        os.chdir(cwd)
+
+
+class TestListFiles(unittest.TestCase):
+    def _create_tree(self, paths):
+        base_dir = tempfile.mkdtemp()
+        for path in paths:
+            path = os.path.join(base_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        return base_dir
+
+    def test_ignore_patterns(self):
+        base_dir = self._create_tree(["activity.py", "activity.pyc",
+                                      "lib/module.py", "lib/module.py~",
+                                      "lib/.git/config", "dist/Sample-1.xo"])
+        files = bundlebuilder.list_files(base_dir, bundlebuilder.IGNORE_DIRS,
+                                         bundlebuilder.IGNORE_FILES)
+        self.assertItemsEqual(files, ["activity.py", "lib/module.py"])
+
+    def test_cache(self):
+        base_dir = self._create_tree(["activity.py", "lib/module.py"])
+        cache_path = os.path.join(tempfile.mkdtemp(), "manifest")
+
+        files = bundlebuilder.list_files(base_dir, cache_path=cache_path)
+        self.assertItemsEqual(files, ["activity.py", "lib/module.py"])
+        self.assertEqual(bundlebuilder.list_files(base_dir,
+                                                  cache_path=cache_path),
+                         files)
+
+        os.mkdir(os.path.join(base_dir, "lib", "new"))
+        open(os.path.join(base_dir, "lib", "new", "file.py"), "w").close()
+        # Make sure the directory mtime changes on coarse filesystems
+        os.utime(os.path.join(base_dir, "lib"), (0, 0))
+        files = bundlebuilder.list_files(base_dir, cache_path=cache_path)
+        self.assertItemsEqual(files, ["activity.py", "lib/module.py",
+                                      "lib/new/file.py"])
+
+
+class TestGenpot(unittest.TestCase):
+    def test_merge_pot_entries(self):
+        first = ('#, fuzzy\nmsgid ""\nmsgstr ""\n'
+                 '"Content-Type: text/plain; charset=CHARSET\\n"\n\n'
+                 '#: a.py:1\nmsgid "One"\nmsgstr ""\n\n'
+                 '#. TRANS: a comment\n#: a.py:2\n#, python-format\n'
+                 'msgid "%s files"\nmsgstr ""\n')
+        second = ('#: b.py:5\nmsgid "One"\nmsgstr ""\n\n'
+                  '#: b.py:7\nmsgctxt "menu"\nmsgid "One"\nmsgstr ""\n')
+
+        entries = bundlebuilder._split_pot_entries(first)
+        entries.extend(bundlebuilder._split_pot_entries(second))
+        self.assertEqual(bundlebuilder._merge_pot_entries(entries),
+                         '#: a.py:1 b.py:5\nmsgid "One"\nmsgstr ""\n\n'
+                         '#. TRANS: a comment\n#: a.py:2\n#, python-format\n'
+                         'msgid "%s files"\nmsgstr ""\n\n'
+                         '#: b.py:7\nmsgctxt "menu"\nmsgid "One"\n'
+                         'msgstr ""\n')
+
+
+class TestTimedTestResult(unittest.TestCase):
+    def test_class_fixtures(self):
+        class SkippedClass(unittest.TestCase):
+            @classmethod
+            def setUpClass(cls):
+                raise unittest.SkipTest("not available")
+
+            def test_skipped(self):
+                pass
+
+        class FailingClass(unittest.TestCase):
+            @classmethod
+            def setUpClass(cls):
+                raise ValueError("broken fixture")
+
+            def test_failing(self):
+                pass
+
+        suite = unittest.TestSuite()
+        for test_case in (SkippedClass, FailingClass):
+            suite.addTests(
+                unittest.defaultTestLoader.loadTestsFromTestCase(test_case))
+        result = bundlebuilder._TimedTestResult()
+        suite.run(result)
+
+        self.assertEqual([record["outcome"] for record in result.records],
+                         ["skipped", "error"])
+        self.assertEqual([record["duration"] for record in result.records],
+                         [0, 0])
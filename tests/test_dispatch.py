@@ -0,0 +1,172 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import gc
+import unittest
+
+from gi.repository import GLib
+
+from sugar3.dispatch import Signal
+
+
+class Receiver(object):
+
+    def __init__(self, name, calls):
+        self._name = name
+        self._calls = calls
+
+    def __call__(self, signal, sender, **kwargs):
+        self._calls.append(self._name)
+
+    def method(self, signal, sender, **kwargs):
+        self._calls.append(self._name)
+
+
+class TestSignal(unittest.TestCase):
+
+    def test_order(self):
+        signal = Signal()
+        sender = object()
+        calls = []
+        receivers = [Receiver(i, calls) for i in range(4)]
+
+        signal.connect(receivers[0], sender=sender)
+        signal.connect(receivers[1])
+        signal.connect(receivers[2], sender=sender)
+        signal.connect(receivers[3], sender=object())
+        signal.connect(receivers[0], sender=sender)
+
+        signal.send(sender)
+        self.assertListEqual(calls, [0, 1, 2])
+
+        del calls[:]
+        signal.send(None)
+        self.assertListEqual(calls, [1])
+
+    def test_disconnect(self):
+        signal = Signal()
+        calls = []
+        first = Receiver('first', calls)
+        second = Receiver('second', calls)
+
+        def disconnect(signal, sender, **kwargs):
+            signal.disconnect(disconnect)
+            signal.disconnect(first)
+
+        signal.connect(disconnect)
+        signal.connect(first)
+        signal.connect(second, dispatch_uid='second')
+
+        signal.send(None)
+        self.assertListEqual(calls, ['first', 'second'])
+
+        del calls[:]
+        signal.disconnect(dispatch_uid='second')
+        signal.send(None)
+        self.assertListEqual(calls, [])
+        self.assertEqual(signal.receivers, {})
+
+    def test_weak(self):
+        signal = Signal()
+        sender = object()
+        calls = []
+        receiver = Receiver('receiver', calls)
+        signal.connect(receiver.method, sender=sender)
+        signal.connect(Receiver('strong', calls), weak=False)
+
+        del receiver
+        gc.collect()
+
+        signal.send(sender)
+        self.assertListEqual(calls, ['strong'])
+        self.assertListEqual(signal.receivers.keys(), [id(None)])
+
+    def test_send_deferred(self):
+        signal = Signal()
+        sender = object()
+        calls = []
+
+        def receiver(signal, sender, object_id, value):
+            calls.append((object_id, value))
+
+        signal.connect(receiver)
+        signal.send_deferred(sender, coalesce_key='a', object_id='a',
+                             value=1)
+        signal.send_deferred(sender, coalesce_key='b', object_id='b',
+                             value=1)
+        signal.send_deferred(sender, coalesce_key='a', object_id='a',
+                             value=2)
+        signal.send_deferred(None, coalesce_key='a', object_id='a',
+                             value=3)
+        self.assertListEqual(calls, [])
+
+        loop = GLib.MainLoop()
+        GLib.idle_add(loop.quit)
+        loop.run()
+
+        self.assertListEqual(calls, [('a', 2), ('b', 1), ('a', 3)])
+        self.assertDictEqual(signal.get_deferred_stats(),
+                             {'sends': 4, 'coalesced': 1, 'deliveries': 3,
+                              'flushes': 1})
+
+        del calls[:]
+        signal.send_deferred(None, object_id='c', value=1)
+        signal.send_deferred(None, object_id='c', value=2)
+        signal.flush_deferred()
+        self.assertListEqual(calls, [('c', 1), ('c', 2)])
+
+    def test_send_deferred_key_argument(self):
+        signal = Signal()
+        calls = []
+
+        def receiver(signal, sender, key):
+            calls.append(key)
+
+        signal.connect(receiver)
+        signal.send_deferred(None, key='a')
+        signal.send_deferred(None, coalesce_key='b', key='b')
+        signal.flush_deferred()
+        self.assertListEqual(calls, ['a', 'b'])
+
+    def test_send_deferred_batched(self):
+        signal = Signal()
+        sender = object()
+        calls = []
+        batches = []
+
+        def receiver(signal, sender, object_id, value):
+            calls.append((object_id, value))
+
+        def batched_receiver(signal, emissions):
+            batches.append([(named['object_id'], named['value'])
+                            for sender_, named in emissions])
+
+        signal.connect(receiver)
+        signal.connect(batched_receiver, batched=True)
+        for i in range(10):
+            signal.send_deferred(sender, coalesce_key=i, object_id=i, value=1)
+        signal.send_deferred(sender, coalesce_key=0, object_id=0, value=2)
+        signal.flush_deferred()
+
+        # One call per key, but a single one for the batched receiver
+        self.assertEqual(len(calls), 10)
+        self.assertListEqual(batches,
+                             [[(0, 2)] + [(i, 1) for i in range(1, 10)]])
+        self.assertEqual(signal.get_deferred_stats()['deliveries'], 11)
+
+        del batches[:]
+        signal.send(sender, object_id=20, value=1)
+        self.assertListEqual(batches, [[(20, 1)]])
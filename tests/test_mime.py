@@ -18,8 +18,12 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import shutil
+import tempfile
 import unittest
 
+from gi.repository import GLib
+
 from sugar3 import mime
 
 tests_dir = os.path.dirname(__file__)
@@ -39,10 +43,126 @@ class TestMime(unittest.TestCase):
         self.assertListEqual(mime.get_mime_parents("application/octet-stream"),
                              [])
 
+    def _use_data_home(self, files):
+        data_home = tempfile.mkdtemp()
+        os.mkdir(os.path.join(data_home, 'mime'))
+        self._write_data_files(data_home, files)
+
+        old_data_home = os.environ.get('XDG_DATA_HOME')
+        os.environ['XDG_DATA_HOME'] = data_home
+
+        def restore():
+            if old_data_home is None:
+                del os.environ['XDG_DATA_HOME']
+            else:
+                os.environ['XDG_DATA_HOME'] = old_data_home
+            mime._database.invalidate()
+            shutil.rmtree(data_home)
+
+        self.addCleanup(restore)
+        mime._database.invalidate()
+        return data_home
+
+    def _write_data_files(self, data_home, files):
+        for name, content in files.items():
+            with open(os.path.join(data_home, 'mime', name), 'w') as f:
+                f.write(content)
+
+    def test_get_mime_parents_reload(self):
+        data_home = self._use_data_home({})
+        self.assertListEqual(mime.get_mime_parents('text/x-sample'), [])
+
+        self._write_data_files(data_home,
+                               {'subclasses': 'text/x-sample text/plain\n'})
+        mime._database.invalidate()
+
+        self.assertListEqual(mime.get_mime_parents('text/x-sample'),
+                             ['text/plain'])
+
+    def test_mime_hierarchy(self):
+        self._use_data_home({
+            'subclasses': 'text/x-sample-child text/x-sample\n'
+                          'text/x-sample text/x-sample-base\n'
+                          'text/x-sample-base text/plain\n',
+            'aliases': 'text/x-sample-alias text/x-sample\n',
+        })
+
+        self.assertListEqual(mime.get_mime_ancestors('text/x-sample-child'),
+                             ['text/x-sample', 'text/x-sample-base',
+                              'text/plain'])
+        self.assertListEqual(mime.get_mime_ancestors('text/x-sample-alias'),
+                             ['text/x-sample-base', 'text/plain'])
+        self.assertSetEqual(mime.get_mime_descendants('text/x-sample-base'),
+                            set(['text/x-sample', 'text/x-sample-child']))
+
+        self.assertTrue(mime.is_subtype('text/x-sample-child', 'text/plain'))
+        self.assertTrue(mime.is_subtype('text/x-sample-child',
+                                        'text/x-sample-alias'))
+        self.assertTrue(mime.is_subtype('text/plain', 'text/plain'))
+        self.assertFalse(mime.is_subtype('text/plain', 'text/x-sample'))
+
+    def test_find_generic_type(self):
+        # From the shared-mime-info database of the system
+        self.assertEqual(mime.find_generic_type('text/x-python').type_id,
+                         mime.GENERIC_TYPE_TEXT)
+        self.assertEqual(mime.find_generic_type('text/plain').type_id,
+                         mime.GENERIC_TYPE_TEXT)
+        self.assertIsNone(mime.find_generic_type('inode/directory'))
+
+        # The icon of the type itself is still used
+        self.assertEqual(mime.get_mime_icon('text/x-python'),
+                         'text-x-python')
+
+    def test_get_primary_extension(self):
+        self.assertEqual(mime.get_primary_extension('application/pdf'),
+                         'pdf')
+        self.assertEqual(mime.get_primary_extension('application/x-none'),
+                         None)
+
     def test_get_for_file(self):
         self.assertEqual(mime.get_for_file(os.path.join(data_dir, "mime.svg")),
                          'image/svg+xml')
 
+    def test_get_for_files(self):
+        svg_path = os.path.join(data_dir, "mime.svg")
+        self.assertListEqual(mime.get_for_files([svg_path, data_dir,
+                                                 'file://' + svg_path]),
+                             ['image/svg+xml', 'inode/directory',
+                              'image/svg+xml'])
+
+    def test_get_for_file_after_guess(self):
+        # PNG data behind a text file name
+        path = os.path.join(tempfile.mkdtemp(), 'image.txt')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(os.path.join(data_dir, 'mime.svg')) as f:
+            svg = f.read()
+        with open(path, 'wb') as f:
+            f.write('\x89PNG\r\n\x1a\n\0\0\0\rIHDR' + '\0' * 17 + svg)
+
+        mime._sniff_cache.clear()
+        sniffed = mime.get_for_file(path)
+        mime._sniff_cache.clear()
+
+        # A guess from the name does not replace sniffing the content
+        guessed = mime.get_for_files([path])
+        self.assertEqual(mime.get_for_file(path), sniffed)
+        self.assertEqual(mime.get_for_files([path]), guessed)
+
+    def test_get_for_files_async(self):
+        svg_path = os.path.join(data_dir, "mime.svg")
+        loop = GLib.MainLoop()
+        result = []
+
+        def callback(mime_types):
+            result.append(mime_types)
+            loop.quit()
+
+        # The NUL byte makes classifying the file raise
+        mime.get_for_files_async([svg_path, "invalid\0name", svg_path],
+                                 callback)
+        loop.run()
+        self.assertEqual(result, [['image/svg+xml', None, 'image/svg+xml']])
+
     def test_from_file_name(self):
         self.assertEqual(mime.get_from_file_name('test.pdf'),
                          'application/pdf')
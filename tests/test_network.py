@@ -0,0 +1,406 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import httplib
+
+from gi.repository import GObject
+
+from sugar3 import network
+
+
+class TestNetwork(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._data = os.urandom(300 * 1024)
+        with open(os.path.join(self._temp_dir, 'data.bin'), 'wb') as f:
+            f.write(self._data)
+        open(os.path.join(self._temp_dir, 'empty.bin'), 'wb').close()
+
+        # Serve from a child process, so that blocking clients can be
+        # used in the tests
+        read_fd, write_fd = os.pipe()
+        self._server_pid = os.fork()
+        if self._server_pid == 0:
+            os.close(read_fd)
+            os.chdir(self._temp_dir)
+            server = network.GlibTCPServer(
+                ('127.0.0.1', 0), network.ChunkedGlibHTTPRequestHandler)
+            os.write(write_fd, '%d\n' % server.server_address[1])
+            os.close(write_fd)
+            try:
+                GObject.MainLoop().run()
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            self._port = int(f.readline())
+        self._url = 'http://127.0.0.1:%d/data.bin' % self._port
+
+    def tearDown(self):
+        os.kill(self._server_pid, signal.SIGTERM)
+        os.waitpid(self._server_pid, 0)
+        shutil.rmtree(self._temp_dir)
+
+    def _request(self, method='GET', headers=None, path='/data.bin'):
+        connection = httplib.HTTPConnection('127.0.0.1', self._port)
+        connection.request(method, path, headers=headers or {})
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response, body
+
+    def _serve_truncated(self, size):
+        """Return the URL of a server sending only size bytes of the data"""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        def serve():
+            connection = listener.accept()[0]
+            connection.recv(4096)
+            connection.sendall('HTTP/1.0 200 OK\r\nContent-Length: %d\r\n'
+                               '\r\n' % len(self._data))
+            connection.sendall(self._data[:size])
+            connection.close()
+            listener.close()
+
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:%d/data.bin' % listener.getsockname()[1]
+
+    def _run_download(self, url, destfile, **kwargs):
+        result = {}
+        loop = GObject.MainLoop()
+
+        def finished_cb(downloader, fname, suggested_fname):
+            result['fname'] = fname
+            loop.quit()
+
+        def error_cb(downloader, message):
+            result['error'] = message
+            result['size'] = downloader.get_size()
+            loop.quit()
+
+        downloader = network.GlibURLDownloader(url)
+        downloader.connect('finished', finished_cb)
+        downloader.connect('error', error_cb)
+        downloader.start(destfile, **kwargs)
+        loop.run()
+        return result
+
+    def _download(self, destfile, **kwargs):
+        result = self._run_download(self._url, destfile, **kwargs)
+        self.assertNotIn('error', result)
+        with open(result['fname'], 'rb') as f:
+            return f.read()
+
+    def test_range(self):
+        response, body = self._request()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Accept-Ranges'), 'bytes')
+        self.assertEqual(body, self._data)
+
+        response, body = self._request(headers={'Range': 'bytes=100-199'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Range'),
+                         'bytes 100-199/%d' % len(self._data))
+        self.assertEqual(body, self._data[100:200])
+
+        response, body = self._request(headers={'Range': 'bytes=-10'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, self._data[-10:])
+
+        response, body = self._request(
+            headers={'Range': 'bytes=%d-' % len(self._data)})
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader('Content-Range'),
+                         'bytes */%d' % len(self._data))
+
+        # No byte of an empty file can be selected
+        response, body = self._request(headers={'Range': 'bytes=-10'},
+                                       path='/empty.bin')
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes */0')
+
+    def test_if_range(self):
+        etag = self._request('HEAD')[0].getheader('ETag')
+
+        response, body = self._request(headers={'Range': 'bytes=100-',
+                                                'If-Range': etag})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, self._data[100:])
+
+        response, body = self._request(headers={'Range': 'bytes=100-',
+                                                'If-Range': '"outdated"'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, self._data)
+
+    def test_resume_download(self):
+        etag = self._request('HEAD')[0].getheader('ETag')
+        destfile = os.path.join(self._temp_dir, 'download.bin')
+
+        with open(destfile, 'wb') as f:
+            f.write(self._data[:12345])
+        self.assertEqual(self._download(destfile, resume=True, etag=etag),
+                         self._data)
+
+        # Already complete
+        self.assertEqual(self._download(destfile, resume=True, etag=etag),
+                         self._data)
+
+        # The resource changed, the partial data must be dropped
+        with open(destfile, 'wb') as f:
+            f.write('x' * 12345)
+        self.assertEqual(self._download(destfile, resume=True,
+                                        etag='"outdated"'),
+                         self._data)
+
+    def test_resume_interrupted_download(self):
+        destfile = os.path.join(self._temp_dir, 'download.bin')
+
+        result = self._run_download(self._serve_truncated(12345), destfile)
+        self.assertIn('error', result)
+        with open(destfile, 'rb') as f:
+            self.assertEqual(f.read(), self._data[:12345])
+        self.assertEqual(result['size'], len(self._data))
+
+        self.assertEqual(self._download(destfile, resume=True,
+                                        size=result['size']),
+                         self._data)
+
+        # Without etag or size the partial data can not be checked
+        with open(destfile, 'wb') as f:
+            f.write('x' * 12345)
+        self.assertEqual(self._download(destfile, resume=True), self._data)
+
+        # The size changed, the partial data must be dropped
+        with open(destfile, 'wb') as f:
+            f.write('x' * 12345)
+        self.assertEqual(self._download(destfile, resume=True,
+                                        size=len(self._data) + 1),
+                         self._data)
+
+
+class TestGlibTCPServer(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._data = os.urandom(1024 * 1024)
+        with open(os.path.join(self._temp_dir, 'data.bin'), 'wb') as f:
+            f.write(self._data)
+
+        self._old_cwd = os.getcwd()
+        os.chdir(self._temp_dir)
+        self._server = network.GlibTCPServer(
+            ('127.0.0.1', 0), network.ChunkedGlibHTTPRequestHandler)
+        self._port = self._server.server_address[1]
+
+    def tearDown(self):
+        self._server.socket.close()
+        os.chdir(self._old_cwd)
+        shutil.rmtree(self._temp_dir)
+
+    def _run_clients(self, clients):
+        """Run every client in a thread while the main loop serves them"""
+        loop = GObject.MainLoop()
+        errors = []
+        finished = []
+
+        def run(client):
+            try:
+                client()
+            except Exception, e:
+                errors.append(e)
+            finally:
+                GObject.idle_add(check_done)
+
+        def check_done():
+            finished.append(True)
+            if len(finished) == len(threads):
+                loop.quit()
+            return False
+
+        threads = [threading.Thread(target=run, args=(client,))
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        loop.run()
+        self.assertListEqual(errors, [])
+
+    def test_keep_alive(self):
+        bodies = []
+
+        def client():
+            connection = httplib.HTTPConnection('127.0.0.1', self._port)
+            for i in range(3):
+                connection.request('GET', '/data.bin')
+                bodies.append(connection.getresponse().read())
+            connection.close()
+
+        self._run_clients([client])
+        self.assertEqual(bodies, [self._data] * 3)
+
+        stats = self._server.get_stats()
+        self.assertEqual(stats['connections_total'], 1)
+        self.assertEqual(stats['requests_total'], 3)
+        self.assertEqual(stats['bytes_sent'], 3 * len(self._data))
+
+    def test_pipelining(self):
+        bodies = []
+
+        def client():
+            sock = socket.create_connection(('127.0.0.1', self._port))
+            # Both requests are likely read at once by the server
+            sock.sendall('GET /data.bin HTTP/1.1\r\nHost: test\r\n\r\n' * 2)
+            for i in range(2):
+                response = httplib.HTTPResponse(sock)
+                response.begin()
+                bodies.append(response.read())
+            sock.close()
+
+        self._run_clients([client])
+        self.assertEqual(bodies, [self._data] * 2)
+        self.assertEqual(self._server.get_stats()['requests_total'], 2)
+
+    def test_concurrent_transfers(self):
+        self._server.max_transfers = 2
+        bodies = []
+
+        def client():
+            connection = httplib.HTTPConnection('127.0.0.1', self._port)
+            connection.request('GET', '/data.bin')
+            bodies.append(connection.getresponse().read())
+            connection.close()
+
+        self._run_clients([client] * 12)
+        self.assertEqual(bodies, [self._data] * 12)
+
+        stats = self._server.get_stats()
+        self.assertEqual(stats['connections_total'], 12)
+        self.assertEqual(stats['active_transfers'], 0)
+        self.assertEqual(stats['queued_transfers'], 0)
+
+    def test_download(self):
+        # The server runs in the same main loop as the downloader
+        url = 'http://127.0.0.1:%d/data.bin' % self._port
+        downloader = network.GlibURLDownloader(url, self._temp_dir)
+        loop = GObject.MainLoop()
+        progress = []
+        result = []
+
+        def progress_cb(downloader, written):
+            progress.append(written)
+
+        def finished_cb(downloader, fname, suggested_fname):
+            result.append((fname, suggested_fname))
+            loop.quit()
+
+        def error_cb(downloader, message):
+            result.append(message)
+            loop.quit()
+
+        downloader.connect('progress', progress_cb)
+        downloader.connect('finished', finished_cb)
+        downloader.connect('error', error_cb)
+        downloader.start()
+        loop.run()
+
+        fname, suggested_fname = result[0]
+        self.assertEqual(suggested_fname, 'data.bin')
+        self.assertTrue(fname.endswith('.bin'))
+        with open(fname, 'rb') as f:
+            self.assertEqual(f.read(), self._data)
+        self.assertEqual(progress[-1], len(self._data))
+        self.assertEqual(downloader.get_size(), len(self._data))
+
+    def _run_manager(self, manager, urls):
+        loop = GObject.MainLoop()
+        finished = {}
+        active = []
+
+        def finished_cb(manager, url, fname, suggested_fname):
+            with open(fname, 'rb') as f:
+                finished[url] = f.read()
+
+        def error_cb(manager, url, message):
+            finished[url] = message
+
+        def progress_cb(manager, written, size):
+            active.append(len(manager._active))
+
+        manager.connect('download-finished', finished_cb)
+        manager.connect('download-error', error_cb)
+        manager.connect('progress', progress_cb)
+        manager.connect('idle', lambda manager: loop.quit())
+        for url in urls:
+            manager.add(url)
+        loop.run()
+        return finished, active
+
+    def test_download_manager(self):
+        for i in range(5):
+            shutil.copy('data.bin', 'data%d.bin' % i)
+        urls = ['http://127.0.0.1:%d/data%d.bin' % (self._port, i)
+                for i in range(5)]
+
+        manager = network.DownloadManager(self._temp_dir, max_per_host=2)
+        finished, active = self._run_manager(manager, urls + urls[:2])
+
+        self.assertEqual(finished, dict((url, self._data) for url in urls))
+        self.assertEqual(max(active), 2)
+        self.assertEqual(self._server.get_stats()['requests_total'], 5)
+
+    def test_download_manager_cancel(self):
+        url = 'http://127.0.0.1:%d/data.bin' % self._port
+        manager = network.DownloadManager(self._temp_dir, max_downloads=1)
+        idle = []
+        manager.connect('idle', lambda manager: idle.append(True))
+
+        destfile = os.path.join(self._temp_dir, 'download.bin')
+        self.assertTrue(manager.add(url, destfile))
+        self.assertFalse(manager.add(url, './download.bin'))
+        self.assertTrue(manager.add(url))
+        self.assertEqual(manager.get_pending(), 2)
+
+        # The queued one, then the running one
+        manager.cancel(url)
+        self.assertEqual(idle, [])
+        manager.cancel(url, './download.bin')
+        self.assertEqual(idle, [True])
+        self.assertEqual(manager.get_pending(), 0)
+
+    def test_download_manager_rate(self):
+        with open('small.bin', 'wb') as f:
+            f.write(self._data[:256 * 1024])
+        url = 'http://127.0.0.1:%d/small.bin' % self._port
+
+        manager = network.DownloadManager(self._temp_dir,
+                                          max_rate=512 * 1024)
+        start = time.time()
+        finished, active_ = self._run_manager(manager, [url])
+        self.assertEqual(finished, {url: self._data[:256 * 1024]})
+        self.assertGreater(time.time() - start, 0.3)
@@ -0,0 +1,104 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from sugar3 import startuptrace
+
+
+class TestStartupTrace(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._old_environ = os.environ.copy()
+        self._logs_dir = os.path.join(self._temp_dir, 'logs')
+        os.environ['SUGAR_LOGS_DIR'] = self._logs_dir
+        os.environ[startuptrace.ENABLE_ENV] = '1'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self._old_environ)
+        shutil.rmtree(self._temp_dir)
+
+    def _trace_launch(self, launch_delay):
+        os.environ[startuptrace.LAUNCH_TIME_ENV] = \
+            '%.6f' % (startuptrace.monotonic() - launch_delay)
+        sys.modules.pop('wave', None)
+
+        startuptrace.start()
+        self.assertTrue(startuptrace.is_enabled())
+        old_threshold = startuptrace.IMPORT_THRESHOLD
+        startuptrace.IMPORT_THRESHOLD = 0
+        try:
+            with startuptrace.phase('imports'):
+                import wave
+                wave
+            startuptrace.mark('first-frame')
+        finally:
+            startuptrace.IMPORT_THRESHOLD = old_threshold
+        return startuptrace.finish('org.sugarlabs.Test')
+
+    def test_trace(self):
+        path = self._trace_launch(0.5)
+        self.assertFalse(startuptrace.is_enabled())
+        self.assertTrue(os.path.basename(path).startswith(
+            'startup-org.sugarlabs.Test-'))
+        self.assertEqual(os.path.dirname(path), self._logs_dir)
+
+        trace, = startuptrace.load_traces([path])
+        self.assertListEqual([phase[0] for phase in trace['phases']],
+                             ['spawn', 'imports'])
+        self.assertGreaterEqual(trace['phases'][0][2], 500)
+        self.assertIn(['wave', 0], [i[:2] for i in trace['imports']])
+
+        # Nothing is recorded once finished
+        with startuptrace.phase('late'):
+            startuptrace.mark('late')
+        self.assertIsNone(startuptrace.finish())
+
+    def test_trace_without_monotonic_clock(self):
+        old_monotonic = startuptrace._monotonic
+        startuptrace._monotonic = time.time
+        try:
+            path = self._trace_launch(0.5)
+        finally:
+            startuptrace._monotonic = old_monotonic
+
+        # The launch time can not be compared with the fallback clock
+        trace, = startuptrace.load_traces([path])
+        self.assertListEqual([phase[0] for phase in trace['phases']],
+                             ['imports'])
+
+    def test_aggregate(self):
+        # Every launch runs in the same process here, keep their traces
+        for i, delay in enumerate([0.1, 0.3, 0.2]):
+            path = self._trace_launch(delay)
+            os.rename(path, path.replace('.trace', '-%d.trace' % i))
+
+        traces = startuptrace.load_traces([self._logs_dir])
+        report = startuptrace.aggregate(traces)
+
+        phases = dict(report['phases'])
+        self.assertEqual(phases['spawn']['count'], 3)
+        self.assertAlmostEqual(phases['spawn']['median'], 200, delta=20)
+        self.assertGreaterEqual(phases['spawn']['max'], 300)
+        self.assertEqual(dict(report['marks'])['first-frame']['count'], 3)
+        self.assertIn('wave', dict(report['imports']))
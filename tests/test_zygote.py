@@ -0,0 +1,102 @@
+# Copyright (C) 2014, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from gi.repository import GObject
+
+from sugar3.activity import zygote
+
+_SCRIPT = """
+import os
+import sys
+
+print repr((sys.argv, os.getcwd(), os.environ.get('TEST_VALUE')))
+sys.exit(int(sys.argv[1]))
+"""
+
+
+class TestZygote(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._old_environ = os.environ.copy()
+        os.environ['SUGAR_HOME'] = self._temp_dir
+
+        self._bin_dir = os.path.join(self._temp_dir, 'bin')
+        os.mkdir(self._bin_dir)
+        with open(os.path.join(self._bin_dir, 'sugar-activity'), 'w') as f:
+            f.write(_SCRIPT)
+
+        path = zygote.get_socket_path()
+        self._zygote = subprocess.Popen(
+            [sys.executable, '-m', 'sugar3.activity.zygote', path],
+            env=dict(os.environ, PYTHONPATH=':'.join(sys.path)))
+        # The socket file exists from bind(), wait for listen()
+        while True:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                time.sleep(0.01)
+            else:
+                break
+            finally:
+                probe.close()
+
+    def tearDown(self):
+        self._zygote.terminate()
+        self._zygote.wait()
+        os.environ.clear()
+        os.environ.update(self._old_environ)
+        shutil.rmtree(self._temp_dir)
+
+    def _launch(self, status):
+        environ = {'PATH': self._bin_dir, 'TEST_VALUE': 'value'}
+        log_path = os.path.join(self._temp_dir, 'activity.log')
+        result = []
+        loop = GObject.MainLoop()
+
+        def exit_cb(pid, condition, user_data):
+            result.append((pid, condition, user_data))
+            loop.quit()
+
+        pid = zygote.launch(['sugar-activity', str(status)], environ,
+                            self._temp_dir, log_path, exit_cb, 'data')
+        self.assertIsNotNone(pid)
+        loop.run()
+
+        self.assertEqual(result, [(pid, status << 8, 'data')])
+        with open(log_path) as f:
+            return f.read()
+
+    def test_launch(self):
+        script = os.path.join(self._bin_dir, 'sugar-activity')
+        expected = ([script, '0'], self._temp_dir, 'value')
+        self.assertEqual(self._launch(0), repr(expected) + '\n')
+        self._launch(3)
+
+    def test_fallback(self):
+        self.assertIsNone(zygote.launch(['other-activity'], os.environ,
+                                        self._temp_dir, os.devnull,
+                                        None, None))